@@ -0,0 +1,117 @@
+from datetime import datetime
+from typing import Any, List, Tuple
+from config import Config
+
+# Alerts tracked per device in alert_state; an event is written each time one is raised or cleared
+TONER_LOW = 'toner_low'
+OFFLINE = 'offline'
+OFFLINE_SUSTAINED = 'offline_sustained'
+
+# Serializes event ids with commit order, so consumers reading "id > last seen" never skip
+# an event committed late by a concurrent save
+LOCK_EVENTS = "SELECT pg_advisory_xact_lock(hashtext('kyoscan_alert_events'))"
+
+# Compare the alert flags of the given devices with their recorded state and write transitions.
+# A device coming back online also clears its sustained-offline alert
+EVALUATE_ALERTS = """
+    WITH observed (device_id, alert, active, value) AS (
+        SELECT c.device_id, a.alert, a.active, a.value
+        FROM device_current_state c
+        CROSS JOIN LATERAL (VALUES
+            ('toner_low', c.toner_alert, c.toner_level::text),
+            ('offline', c.offline_alert, c.status::text)
+        ) a(alert, active, value)
+        WHERE c.device_id = ANY(%(device_ids)s::integer[])
+    ), changed AS (
+        SELECT o.device_id, o.alert, o.active IS TRUE AS active, o.value
+        FROM observed o
+        LEFT JOIN alert_state s ON s.device_id = o.device_id AND s.alert = o.alert
+        WHERE (o.active IS TRUE) IS DISTINCT FROM (s.active IS TRUE)
+    ), stored AS (
+        INSERT INTO alert_state (device_id, alert, active, since)
+        SELECT device_id, alert, active, %(timestamp)s FROM changed
+        ON CONFLICT (device_id, alert) DO UPDATE SET active = EXCLUDED.active, since = EXCLUDED.since
+    ), back_online AS (
+        UPDATE alert_state SET active = FALSE, since = %(timestamp)s
+        WHERE alert = 'offline_sustained' AND active
+          AND device_id IN (SELECT device_id FROM changed WHERE alert = 'offline' AND NOT active)
+        RETURNING device_id
+    )
+    INSERT INTO alert_events (device_id, alert, event, at, value)
+    SELECT device_id, alert, CASE WHEN active THEN 'raised' ELSE 'cleared' END, %(timestamp)s, value
+    FROM changed
+    UNION ALL
+    SELECT device_id, 'offline_sustained', 'cleared', %(timestamp)s, NULL
+    FROM back_online
+"""
+
+# Raise the sustained-offline alert of devices offline for at least the configured hours;
+# these devices may not have changed, so this looks at every active offline alert (indexed)
+RAISE_SUSTAINED_OFFLINE = """
+    WITH due AS (
+        SELECT s.device_id, s.since
+        FROM alert_state s
+        WHERE s.alert = 'offline' AND s.active
+          AND s.since <= %(timestamp)s - %(hours)s * INTERVAL '1 hour'
+          AND NOT EXISTS (
+              SELECT 1 FROM alert_state x
+              WHERE x.device_id = s.device_id AND x.alert = 'offline_sustained' AND x.active
+          )
+    ), stored AS (
+        INSERT INTO alert_state (device_id, alert, active, since)
+        SELECT device_id, 'offline_sustained', TRUE, %(timestamp)s FROM due
+        ON CONFLICT (device_id, alert) DO UPDATE SET active = EXCLUDED.active, since = EXCLUDED.since
+    )
+    INSERT INTO alert_events (device_id, alert, event, at, value)
+    SELECT device_id, 'offline_sustained', 'raised', %(timestamp)s, 'offline since ' || date_trunc('second', since)
+    FROM due
+"""
+
+SELECT_EVENTS = """
+    SELECT e.id, e.device_id, d.serial_number, c.device_name, e.alert, e.event, e.at, e.value
+    FROM alert_events e
+    JOIN devices d ON d.id = e.device_id
+    LEFT JOIN device_current_state c ON c.device_id = e.device_id
+    WHERE e.id > %s
+    ORDER BY e.id
+    LIMIT %s
+"""
+
+class AlertEngine:
+    """
+    Turns device_current_state changes into alert transitions.
+
+    Runs inside the save transaction, after the current state upserts, and only
+    looks at the devices whose row actually changed (plus the active offline
+    alerts, for the sustained-offline check). The toner threshold is applied when
+    the toner_alert flag is computed (Config.ALERT_TONER_THRESHOLD); alert_state
+    keeps what is raised per device and alert_events the raised/cleared history
+    that consumers read incrementally.
+    """
+
+    def __init__(self, offline_hours: float = 48):
+        self.offline_hours = offline_hours
+
+    @classmethod
+    def from_config(cls) -> "AlertEngine":
+        """Create an engine with the Config alert settings."""
+        return cls(Config.ALERT_OFFLINE_HOURS)
+
+    def statements(self, device_ids: List[int], timestamp: datetime) -> List[Tuple[str, Any]]:
+        """
+        Statements to run, in order, in the transaction that changed these devices.
+
+        Returned as (query, params) pairs so Database and AsyncDatabase can both
+        execute them, right after LOCK_EVENTS; the rowcount of each is the
+        number of events written.
+
+        :param device_ids: Devices whose current state row was inserted or changed
+        :param timestamp: Timestamp of the save, recorded on the events
+        :return: List of (query, params)
+        """
+
+        statements = []
+        if device_ids:
+            statements.append((EVALUATE_ALERTS, {'device_ids': sorted(set(device_ids)), 'timestamp': timestamp}))
+        statements.append((RAISE_SUSTAINED_OFFLINE, {'timestamp': timestamp, 'hours': self.offline_hours}))
+        return statements
@@ -0,0 +1,289 @@
+import asyncio
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+import psycopg
+from psycopg_pool import AsyncConnectionPool
+from alerts import AlertEngine, LOCK_EVENTS
+from config import Config
+from database import (
+    SELECT_DEVICE_BY_SERIAL, UPDATE_DEVICE_MAC, INSERT_DEVICE, SELECT_DEVICE_BY_NAME, SELECT_LAST_CONFIG,
+    INSERT_HISTORY, INSERT_LOG, INSERT_LOG_DELTA, UPSERT_CURRENT_STATE, STAGING_COLUMNS, CREATE_STAGING,
+    UPSERT_STAGED_DEVICES, RESOLVE_STAGED, INSERT_STAGED_HISTORY, UPSERT_STAGED_CURRENT_STATE, TOUCH_STAGED_LAST_SEEN,
+    INSERT_STAGED_LOGS, INSERT_STAGED_LOGS_DELTA, ENSURE_PARTITIONS, SET_SAVE_TIMEOUT, CLAIM_BATCH,
+    config_changed, log_params, current_state_params, staging_row
+)
+from metrics import get_registry
+
+metrics = get_registry()
+
+# Transient conflicts between concurrent batches; the whole batch is retried
+RETRYABLE_ERRORS = (psycopg.errors.DeadlockDetected, psycopg.errors.SerializationFailure)
+
+class AsyncDatabase:
+    """
+    Pooled asyncio counterpart of Database, built on psycopg 3.
+
+    save_printer_data has the same semantics and runs the same SQL, but every
+    call borrows its own connection from a bounded pool, so concurrent writers
+    save separate batches without blocking the event loop. Connections are
+    checked before being handed out and replaced in the background when the
+    server goes away. Per-printer statements are prepared on each connection.
+
+    Unlike Database, it does not use a DeviceCache: concurrent transactions
+    would see each other's uncommitted devices through it.
+    """
+
+    def __init__(self, config: Config, min_size: int = 1, max_size: int = 4, timeout: float = 30.0,
+                 alert_engine: Optional[AlertEngine] = None):
+        db_config = config.get_db_config()
+        self.alert_engine = alert_engine
+        self.max_size = max_size
+        self.timeout = timeout
+        self.partitions_month = None
+        self.pool = AsyncConnectionPool(
+            kwargs={
+                "dbname": db_config["database"],
+                "host": db_config["host"],
+                "port": db_config["port"],
+                "user": db_config["user"],
+                "password": db_config["password"],
+                "connect_timeout": Config.DB_CONNECT_TIMEOUT,
+            },
+            min_size=min_size,
+            max_size=max_size,
+            timeout=timeout,
+            check=AsyncConnectionPool.check_connection,
+            name="kyoscan",
+            open=False
+        )
+
+    @classmethod
+    def from_config(cls, alert_engine: Optional[AlertEngine] = None) -> "AsyncDatabase":
+        """Build a pool sized from Config."""
+        return cls(Config(), Config.DB_POOL_MIN, Config.DB_POOL_MAX, Config.DB_POOL_TIMEOUT, alert_engine)
+
+    async def open(self, wait: bool = True):
+        """
+        Open the pool.
+
+        :param wait: Wait for its first connections and raise if the database is unreachable;
+                     otherwise the pool keeps connecting in the background and saves fail until it can
+        """
+        await self.pool.open(wait=wait, timeout=self.timeout)
+
+    async def close(self):
+        """Close the pool and every connection in it."""
+        await self.pool.close()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def ensure_partitions(self, timestamp: datetime):
+        """Make sure the monthly partitions for timestamp exist, as in Database.ensure_partitions."""
+        month = (timestamp.year, timestamp.month)
+        if month == self.partitions_month:
+            return
+
+        with metrics.timer("kyoscan_db_phase_seconds", phase="partitions"):
+            async with self.pool.connection() as conn:
+                await conn.execute(ENSURE_PARTITIONS, (timestamp,))
+        self.partitions_month = month
+
+    async def resolve_device_id(self, cursor: psycopg.AsyncCursor, serial: Optional[str], name: str | Any,
+                                mac: Optional[str], timestamp: datetime) -> Optional[int]:
+        """
+        Resolve device ID from database, inserting or updating as needed.
+
+        :param cursor: Database cursor
+        :param serial: Serial number
+        :param name: Device name
+        :param mac: MAC address
+        :return: Device ID or None if unable to resolve
+        """
+
+        if serial:
+            await cursor.execute(SELECT_DEVICE_BY_SERIAL, (serial,), prepare=True)
+            result_row = await cursor.fetchone()
+
+            if result_row:
+                if mac:
+                    await cursor.execute(UPDATE_DEVICE_MAC, (mac, result_row[0]), prepare=True)
+                return result_row[0]
+
+            await cursor.execute(INSERT_DEVICE, (serial, mac, timestamp), prepare=True)
+            return (await cursor.fetchone())[0]
+
+        await cursor.execute(SELECT_DEVICE_BY_NAME, (name,), prepare=True)
+        result_row = await cursor.fetchone()
+        return result_row[0] if result_row else None
+
+    async def should_update_config(self, cursor: psycopg.AsyncCursor, device_id: int, name: str | Any,
+                                   ip: Optional[str], mac: Optional[str], hostname: Optional[str]) -> bool:
+        """
+        Check if device configuration has changed since last recorded.
+
+        :param cursor: Database cursor
+        :param device_id: Device ID
+        :param name: Current device name
+        :param ip: Current IP address
+        :param mac: Current MAC address
+        :param hostname: Current hostname
+        :return: True if config should be updated
+        """
+
+        await cursor.execute(SELECT_LAST_CONFIG, (device_id,), prepare=True)
+        return config_changed(await cursor.fetchone(), name, ip, mac, hostname)
+
+    async def evaluate_alerts(self, cursor: psycopg.AsyncCursor, device_ids: List[int], timestamp: datetime) -> int:
+        """Record alert transitions of the devices changed by the current save, as in Database.evaluate_alerts."""
+        if self.alert_engine is None:
+            return 0
+
+        events = 0
+        with metrics.timer("kyoscan_db_phase_seconds", phase="alerts"):
+            await cursor.execute(LOCK_EVENTS)
+            for query, params in self.alert_engine.statements(device_ids, timestamp):
+                await cursor.execute(query, params)
+                events += cursor.rowcount
+        metrics.inc("kyoscan_alert_events_total", events)
+        return events
+
+    async def _save_rows(self, cursor: psycopg.AsyncCursor, data_list: List[Dict[str, Any]],
+                         timestamp: datetime) -> Tuple[int, List[int], List[Any]]:
+        """Per-printer statements, as in Database.save_printer_data."""
+        saved_count = 0
+        changed = []
+        not_resolved = []
+
+        for data in data_list:
+            name = data.get('Name')
+            ip = data.get('IP')
+            hostname = data.get('Hostname')
+            mac = data.get('Mac')
+
+            with metrics.timer("kyoscan_db_phase_seconds", phase="resolve"):
+                device_id = await self.resolve_device_id(cursor, data.get('Serial'), name, mac, timestamp)
+
+            if not device_id:
+                not_resolved.append(name)
+                continue
+
+            with metrics.timer("kyoscan_db_phase_seconds", phase="history"):
+                if await self.should_update_config(cursor, device_id, name, ip, mac, hostname):
+                    await cursor.execute(INSERT_HISTORY, (device_id, name, ip, mac, hostname, timestamp), prepare=True)
+
+            with metrics.timer("kyoscan_db_phase_seconds", phase="logs"):
+                await cursor.execute(INSERT_LOG_DELTA if Config.DB_DELTA_LOGS else INSERT_LOG,
+                                     log_params(device_id, data, timestamp), prepare=True)
+
+            with metrics.timer("kyoscan_db_phase_seconds", phase="upsert"):
+                await cursor.execute(UPSERT_CURRENT_STATE, current_state_params(device_id, data, timestamp), prepare=True)
+                if cursor.rowcount:
+                    changed.append(device_id)
+
+            saved_count += 1
+
+        return saved_count, changed, not_resolved
+
+    async def _save_bulk(self, cursor: psycopg.AsyncCursor, data_list: List[Dict[str, Any]],
+                         timestamp: datetime) -> Tuple[int, List[int], List[Any]]:
+        """Set-based statements, as in Database.save_printer_data_bulk, with COPY into the staging table."""
+        with metrics.timer("kyoscan_db_phase_seconds", phase="resolve"):
+            await cursor.execute(CREATE_STAGING)
+            async with cursor.copy(f"COPY printer_staging ({', '.join(STAGING_COLUMNS)}) FROM STDIN") as copy:
+                for position, data in enumerate(data_list):
+                    await copy.write_row(staging_row(position, data))
+            await cursor.execute(UPSERT_STAGED_DEVICES, (timestamp,))
+            await cursor.execute(RESOLVE_STAGED)
+            resolved = await cursor.fetchall()
+
+        not_resolved = [name for name, generation in resolved if generation is None]
+        generations = max((generation for _, generation in resolved if generation is not None), default=0)
+        changed = []
+
+        for generation in range(1, generations + 1):
+            with metrics.timer("kyoscan_db_phase_seconds", phase="history"):
+                await cursor.execute(INSERT_STAGED_HISTORY, {'timestamp': timestamp, 'generation': generation})
+
+            with metrics.timer("kyoscan_db_phase_seconds", phase="upsert"):
+                await cursor.execute(UPSERT_STAGED_CURRENT_STATE, {'timestamp': timestamp, 'generation': generation})
+                changed += [row[0] for row in await cursor.fetchall()]
+
+        with metrics.timer("kyoscan_db_phase_seconds", phase="upsert"):
+            await cursor.execute(TOUCH_STAGED_LAST_SEEN, (timestamp,))
+
+        with metrics.timer("kyoscan_db_phase_seconds", phase="logs"):
+            if Config.DB_DELTA_LOGS:
+                await cursor.execute(INSERT_STAGED_LOGS_DELTA, {'timestamp': timestamp})
+            else:
+                await cursor.execute(INSERT_STAGED_LOGS, (timestamp,))
+
+        return len(resolved) - len(not_resolved), changed, not_resolved
+
+    async def save_printer_data(self, data_list: List[Dict[str, Any]], bulk: Optional[bool] = None,
+                                attempts: int = 3, timestamp: Optional[datetime] = None,
+                                batch_id: Optional[str] = None) -> int:
+        """
+        Save printer data to PostgreSQL database in one transaction on a pooled connection.
+
+        Same steps and results as Database.save_printer_data. A batch that hits a
+        deadlock or serialization failure against a concurrent batch is retried.
+
+        :param data_list: List of printer data dictionaries
+        :param bulk: Use the set-based statements (default: Config.DB_BULK_WRITE)
+        :param attempts: Tries per batch on deadlock or serialization failure
+        :param timestamp: Time of the scrape (default: now), e.g. when replaying the spool
+        :param batch_id: Id of a spooled batch; the batch is skipped if it was already saved
+        :return: Number of printers saved
+        """
+
+        save = self._save_bulk if (Config.DB_BULK_WRITE if bulk is None else bulk) else self._save_rows
+        timestamp = timestamp or datetime.now()
+        await self.ensure_partitions(timestamp)
+
+        for attempt in range(1, attempts + 1):
+            try:
+                async with self.pool.connection() as conn:
+                    async with conn.cursor() as cursor:
+                        if Config.DB_STATEMENT_TIMEOUT > 0:
+                            await cursor.execute(SET_SAVE_TIMEOUT, (str(int(Config.DB_STATEMENT_TIMEOUT * 1000)),))
+                        if batch_id is not None:
+                            await cursor.execute(CLAIM_BATCH, (batch_id,))
+                            if not cursor.rowcount:
+                                await conn.rollback()
+                                print(f"Batch {batch_id} was already saved, skipping it.")
+                                return 0
+                        saved_count, changed, not_resolved = await save(cursor, data_list, timestamp)
+                        events = await self.evaluate_alerts(cursor, changed, timestamp)
+                    with metrics.timer("kyoscan_db_phase_seconds", phase="commit"):
+                        await conn.commit()
+                break
+            except RETRYABLE_ERRORS as e:
+                if attempt == attempts:
+                    metrics.inc("kyoscan_db_save_errors_total")
+                    print(f"Error saving printer data: {e}")
+                    raise
+                metrics.inc("kyoscan_db_save_retries_total")
+                await asyncio.sleep(0.1 * attempt)
+            except Exception as e:
+                metrics.inc("kyoscan_db_save_errors_total")
+                print(f"Error saving printer data: {e}")
+                raise
+            finally:
+                stats = self.pool.get_stats()
+                metrics.set_gauge("kyoscan_db_pool_connections", stats.get("pool_size", 0))
+                metrics.set_gauge("kyoscan_db_pool_waiting", stats.get("requests_waiting", 0))
+
+        metrics.inc("kyoscan_db_printers_saved_total", saved_count)
+        metrics.inc("kyoscan_db_printers_unresolved_total", len(not_resolved))
+        metrics.inc("kyoscan_db_current_state_changed_total", len(changed))
+        print(f"\nSaved data for {saved_count} printers.")
+        print(f"Could not resolve device IDs for {len(not_resolved)} printers.")
+        print(f"Current state changed for {len(changed)} printers.")
+        if events:
+            print(f"Raised or cleared {events} alerts.")
+        return saved_count
@@ -0,0 +1,186 @@
+import argparse
+import json
+import random
+import time
+from datetime import datetime
+import psycopg2.extensions
+from bench_scrape import OUTPUT_FILE, git_revision
+from config import Config
+from database import Database
+from device_cache import DeviceCache
+
+# Rows written by this benchmark, removed before each run
+SERIAL_PREFIX = "BENCHDB"
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """Cursor counting statements sent to the server, optionally adding a simulated round-trip time."""
+    round_trips = 0
+    rtt = 0.0
+
+    def execute(self, query, vars=None):
+        CountingCursor.round_trips += 1
+        if CountingCursor.rtt:
+            time.sleep(CountingCursor.rtt)
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        CountingCursor.round_trips += 1
+        if CountingCursor.rtt:
+            time.sleep(CountingCursor.rtt)
+        return super().executemany(query, vars_list)
+
+def make_batches(size, prefix, seed):
+    """
+    Three scrapes of a synthetic fleet: first sighting, then counters moving with
+    some renames, IP changes and partial results, then a batch that also sees
+    some printers twice and some without a serial (resolved by name).
+    """
+    rng = random.Random(seed)
+    printers = [{
+        "Name": f"{prefix}-KM-{i:05d}",
+        "IP": f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}",
+        "Hostname": f"km{i:05d}",
+        "Serial": f"{prefix}{i:08d}",
+        "Mac": f"00:17:C8:{i // 65536 % 256:02X}:{i // 256 % 256:02X}:{i % 256:02X}",
+        "Status": "Online",
+        "Toner": rng.randint(0, 100),
+        "Print_Data": {"copy_bw": rng.randint(0, 10 ** 5), "printer_bw": rng.randint(0, 10 ** 5), "fax_bw": rng.randint(0, 100)},
+        "Scan_Data": {"scan_copy": rng.randint(0, 10 ** 4), "scan_bw": rng.randint(0, 10 ** 4), "scan_other": rng.randint(0, 100)}
+    } for i in range(size)]
+
+    def scrape(printer):
+        data = {**printer,
+                "Toner": max(0, printer["Toner"] - rng.randint(0, 3)),
+                "Print_Data": {key: value + rng.randint(0, 50) for key, value in printer["Print_Data"].items()},
+                "Scan_Data": {key: value + rng.randint(0, 20) for key, value in printer["Scan_Data"].items()}}
+        roll = rng.random()
+        if roll < 0.05:
+            data["Name"] = data["Name"] + "-moved"
+        elif roll < 0.10:
+            data["IP"] = "172.16." + data["IP"].split(".", 2)[2]
+        elif roll < 0.20:
+            data["Toner"] = None
+            data["Scan_Data"] = None
+            data["Missing"] = {"Toner": "timeout", "Scan_Data": "http 503"}
+        elif roll < 0.25:
+            data.update({"Hostname": "N/A", "Mac": None, "Status": "Offline", "Toner": None,
+                         "Print_Data": None, "Scan_Data": None})
+        printer.update({key: data[key] for key in ("Name", "IP", "Toner", "Print_Data", "Scan_Data") if data[key] is not None})
+        return data
+
+    first = [dict(printer) for printer in printers]
+    second = [scrape(printer) for printer in printers]
+    third = [scrape(printer) for printer in printers]
+    third += [scrape(printer) for printer in rng.sample(printers, size // 20)]
+    for data in rng.sample(third, size // 20):
+        data["Serial"] = None
+    return [first, second, third]
+
+def cleanup(conn):
+    """Remove everything a previous run wrote."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT id FROM devices WHERE serial_number LIKE %s", (SERIAL_PREFIX + "%",))
+        ids = [row[0] for row in cur.fetchall()]
+        for table in ("device_current_state", "device_last_seen", "device_logs", "device_logs_hourly", "device_logs_daily",
+                      "device_usage_daily", "device_usage_monthly", "device_history", "device_toner_forecast",
+                      "alert_state", "alert_events"):
+            cur.execute(f"DELETE FROM {table} WHERE device_id = ANY(%s)", (ids,))
+        cur.execute("DELETE FROM devices WHERE id = ANY(%s)", (ids,))
+    conn.commit()
+
+def snapshot(conn, prefix):
+    """Everything saved for one run, with the run prefix and generated ids/timestamps stripped."""
+    strip = lambda value: value.replace(prefix, "") if isinstance(value, str) else value
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT d.serial_number, d.mac_address,
+                   (SELECT array_agg(ARRAY[h.device_name, h.ip_address::text, h.mac_address, h.hostname] ORDER BY h.id)
+                    FROM device_history h WHERE h.device_id = d.id),
+                   (SELECT array_agg(ARRAY[l.status, l.toner_level::text, l.printer_copy_bw::text, l.scanner_copy::text] ORDER BY l.id)
+                    FROM device_logs l WHERE l.device_id = d.id),
+                   (SELECT ARRAY[c.device_name, c.ip_address::text, c.mac_address, c.hostname, c.status, c.toner_level::text,
+                                 c.printer_copy_bw::text, c.printer_printer_bw::text, c.printer_fax_bw::text,
+                                 c.scanner_copy::text, c.scanner_bw::text, c.scanner_other::text,
+                                 c.toner_alert::text, c.offline_alert::text]
+                    FROM device_current_state c WHERE c.device_id = d.id)
+            FROM devices d
+            WHERE d.serial_number LIKE %s
+        """, (prefix + "%",))
+        return {strip(serial): json.loads(json.dumps(rest, default=str).replace(prefix, ""))
+                for serial, *rest in cur.fetchall()}
+
+def log_rows(conn, prefix):
+    """Number of device_logs rows one run wrote."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT count(*) FROM device_logs l JOIN devices d ON d.id = l.device_id WHERE d.serial_number LIKE %s",
+                    (prefix + "%",))
+        return cur.fetchone()[0]
+
+# Mode name -> (serial prefix, bulk, cached)
+MODES = {
+    "per-row": ("R", False, False),
+    "cached": ("C", False, True),
+    "bulk": ("B", True, False),
+}
+
+def run_mode(db, size, mode, args):
+    """Save the synthetic scrapes with one write path and return the measurements."""
+    suffix, bulk, cached = MODES[mode]
+    prefix = SERIAL_PREFIX + suffix
+    batches = make_batches(size, prefix, args.seed)
+    if args.delta:
+        batches.append([dict(data) for data in batches[-1]])  # A poll that reads nothing new
+
+    db.device_cache = DeviceCache() if cached else None
+    CountingCursor.round_trips = 0
+    CountingCursor.rtt = args.rtt / 1000
+    started = time.perf_counter()
+    for batch in batches:
+        db.save_printer_data(batch, bulk=bulk)
+    elapsed = time.perf_counter() - started
+    round_trips = CountingCursor.round_trips
+    CountingCursor.rtt = 0.0
+    db.device_cache = None
+
+    return {
+        "mode": mode,
+        "printers": size,
+        "rows": sum(len(batch) for batch in batches),
+        "round_trips": round_trips,
+        "seconds": round(elapsed, 3),
+        "log_rows": log_rows(db.conn, prefix),
+    }, snapshot(db.conn, prefix)
+
+def main():
+    """Count round-trips and time of each save path, and check they all write the same rows."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--rtt", type=float, default=0.0, help="simulated network round-trip per statement, in ms")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--delta", action="store_true", help="change-only logging, with an extra unchanged poll")
+    args = parser.parse_args()
+    Config.DB_DELTA_LOGS = args.delta
+
+    revision = git_revision()
+    with Database(Config()) as db, OUTPUT_FILE.open("a", encoding="utf-8") as output:
+        if db.conn is None:
+            raise SystemExit("Could not connect to the database.")
+        db.conn.cursor_factory = CountingCursor
+
+        for size in args.sizes:
+            cleanup(db.conn)
+            runs = [run_mode(db, size, mode, args) for mode in MODES]
+            cleanup(db.conn)
+
+            reference = runs[0][1]
+            print(f"\n{size:>6} printers ({runs[0][0]['rows']} rows):")
+            for result, rows in runs:
+                result["match"] = rows == reference
+                print(f"  {result['mode']:<8} {result['round_trips']:>7} round-trips {result['seconds']:>8} s   "
+                      f"{result['log_rows']:>6} log rows   results {'match' if result['match'] else 'DIFFER'}")
+                record = {"revision": revision, "timestamp": datetime.now().isoformat(timespec="seconds"),
+                          "params": {"rtt": args.rtt, "seed": args.seed, "delta": args.delta}, "benchmark": "db", **result}
+                output.write(json.dumps(record) + "\n")
+
+if __name__ == "__main__":
+    main()
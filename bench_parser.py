@@ -0,0 +1,73 @@
+import re
+import timeit
+from pathlib import Path
+from fetcher import parse_printer_info, parse_toner_level, parse_counter_data, PRINT_COUNTER_FIELDS, SCAN_COUNTER_FIELDS
+
+SAMPLES_DIR = Path(__file__).parent / "samples"
+
+### Regex helpers as they were before the shared _pp tokenizer (reference only)
+
+async def legacy_parse_printer_info(text):
+    patterns = {
+        "hostname": r"_pp\.hostName\s*=\s*'([^']*)';",
+        "serial": r"_pp\.serialNumber\s*=\s*'([^']*)';",
+        "mac": r"_pp\.macAddress\s*=\s*'([^']*)';"
+    }
+    return {key: (re.search(pattern, text).group(1) if re.search(pattern, text) else None) for key, pattern in patterns.items()}
+
+async def legacy_parse_toner_level(text):
+    matches = re.findall(r"_pp\.Renaming\.push\(parseInt\('(\d+)',\s*10\)\);", text)
+    return int(matches[0]) if matches else None
+
+async def legacy_parse_counter_data(text, patterns):
+    return {key: (int(match.group(1)) if (match := re.search(pattern, text)) else None) for key, pattern in patterns.items()}
+
+LEGACY_PRINT_PATTERNS = {
+    "copy_bw": r"_pp\.copyBlackWhite\s*=\s*\('(\d+)'\)\.toString\(\);",
+    "printer_bw": r"_pp\.printerBlackWhite\s*=\s*\('(\d+)'\)\.toString\(\);",
+    "fax_bw": r"_pp\.faxBlackWhite\s*=\s*\('(\d+)'\)\.toString\(\);"
+}
+
+LEGACY_SCAN_PATTERNS = {
+    "scan_copy": r"_pp\.scanCopy\s*=\s*parseInt\('(\d+)',\s*10\);",
+    "scan_bw": r"_pp\.scanBlackWhite\s*=\s*parseInt\('(\d+)',\s*10\);",
+    "scan_other": r"_pp\.scanOther\s*=\s*parseInt\('(\d+)',\s*10\);"
+}
+
+def run_sync(coro):
+    """Drive a parse coroutine that never awaits, without event loop overhead."""
+    try:
+        coro.send(None)
+    except StopIteration as stop:
+        return stop.value
+    raise RuntimeError("parse coroutine awaited unexpectedly")
+
+def run_case(label, legacy, current, number):
+    """Check both parsers agree, then time them on the same body."""
+    legacy_result = run_sync(legacy())
+    current_result = run_sync(current())
+    if legacy_result != current_result:
+        raise AssertionError(f"{label}: {legacy_result} != {current_result}")
+
+    legacy_time = timeit.timeit(lambda: run_sync(legacy()), number=number)
+    current_time = timeit.timeit(lambda: run_sync(current()), number=number)
+
+    print(f"{label:<16} legacy {legacy_time / number * 1e6:8.2f} us   "
+          f"tokenizer {current_time / number * 1e6:8.2f} us   "
+          f"speedup {legacy_time / current_time:5.2f}x")
+
+def main(number=20000):
+    """Micro-benchmark the _pp tokenizer against the per-call regex parsers."""
+    config = (SAMPLES_DIR / "DvcConfig_Config.model.htm").read_text()
+    toner = (SAMPLES_DIR / "Hme_Toner.model.htm").read_text()
+    prn = (SAMPLES_DIR / "DvcInfo_Counter_PrnCounter.model.htm").read_text()
+    scan = (SAMPLES_DIR / "DvcInfo_Counter_ScanCounter.model.htm").read_text()
+
+    # re caches compiled patterns, so this measures the steady state of the old code
+    run_case("printer_info", lambda: legacy_parse_printer_info(config), lambda: parse_printer_info(config), number)
+    run_case("toner", lambda: legacy_parse_toner_level(toner), lambda: parse_toner_level(toner), number)
+    run_case("print_counter", lambda: legacy_parse_counter_data(prn, LEGACY_PRINT_PATTERNS), lambda: parse_counter_data(prn, PRINT_COUNTER_FIELDS), number)
+    run_case("scan_counter", lambda: legacy_parse_counter_data(scan, LEGACY_SCAN_PATTERNS), lambda: parse_counter_data(scan, SCAN_COUNTER_FIELDS), number)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import argparse
+import asyncio
+import json
+import statistics
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from fetcher import get_all_printers_data_async, CircuitBreaker
+from limiter import AdaptiveLimiter
+from metrics import get_registry
+from simulator import SimulatedFleet
+
+OUTPUT_FILE = Path(__file__).parent / "bench_output.txt"
+
+def git_revision() -> str:
+    """Short commit hash of the tree being measured, so runs can be compared across commits."""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).parent).stdout.strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of values."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+async def run_once(size, args):
+    """Scrape a simulated fleet once and return the measurements."""
+    fleet = SimulatedFleet(
+        size,
+        latency=args.latency,
+        jitter=args.jitter,
+        timeout_rate=args.timeout_rate,
+        error_rate=args.error_rate,
+        timeout_after=args.timeout_after,
+        dead_rate=args.dead_rate,
+        seed=args.seed
+    )
+
+    get_registry().reset()
+    tracemalloc.start()
+    started = time.perf_counter()
+    results = await get_all_printers_data_async(
+        fleet.printers(),
+        max_concurrent=args.max_concurrent,
+        max_per_host=args.max_per_host,
+        breaker=CircuitBreaker(probe_timeout=0),  # No TCP probe against simulated IPs
+        transport=fleet.transport(),
+        limiter=AdaptiveLimiter(initial_limit=args.max_concurrent, max_limit=args.max_limit) if args.adaptive else None
+    )
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies = fleet.latencies()
+    return {
+        "printers": size,
+        "online": sum(1 for result in results if result['Status'] == "Online"),
+        "requests": fleet.requests,
+        "seconds": round(elapsed, 3),
+        "printers_per_sec": round(size / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 1) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+        "peak_mb": round(peak / 2 ** 20, 1),
+    }
+
+def main():
+    """Benchmark scrape throughput against simulated fleets of increasing size."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--max-concurrent", type=int, default=10)
+    parser.add_argument("--max-per-host", type=int, default=4)
+    parser.add_argument("--adaptive", action="store_true", help="use the AIMD limiter instead of a fixed semaphore")
+    parser.add_argument("--max-limit", type=int, default=100, help="adaptive limiter ceiling")
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--timeout-rate", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--timeout-after", type=float, default=1.0)
+    parser.add_argument("--dead-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    revision = git_revision()
+    with OUTPUT_FILE.open("a", encoding="utf-8") as output:
+        for size in args.sizes:
+            result = asyncio.run(run_once(size, args))
+            print(f"\n{size:>6} printers: {result['printers_per_sec']:>8} printers/s  "
+                  f"p50 {result['p50_ms']} ms  p99 {result['p99_ms']} ms  peak {result['peak_mb']} MB")
+            record = {"revision": revision, "timestamp": datetime.now().isoformat(timespec="seconds"),
+                      "params": {key: value for key, value in vars(args).items() if key != "sizes"}, **result}
+            output.write(json.dumps(record) + "\n")
+
+if __name__ == "__main__":
+    main()
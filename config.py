@@ -7,11 +7,80 @@ class Config:
     """Configuration class for application settings."""
     
     ### Database
+    # "postgres", or "sqlite" for an embedded database file at SQLITE_PATH (edge collectors)
+    DB_BACKEND = os.getenv("DB_BACKEND", "postgres")
+    SQLITE_PATH = os.getenv("SQLITE_PATH", "kyoscan.db")
+    # Edge collectors on SQLite with SHIP_UPSTREAM ship what they saved to the PostgreSQL server
+    # below (DB_HOST, DB_NAME, ...), SHIP_CHUNK_ROWS rows per transaction, after every run and
+    # every SHIP_INTERVAL seconds in daemon mode (see ship.py)
+    SHIP_UPSTREAM = os.getenv("SHIP_UPSTREAM", "false").lower() in ("1", "true", "yes")
+    SHIP_CHUNK_ROWS = int(os.getenv("SHIP_CHUNK_ROWS", 10000))
+    SHIP_INTERVAL = float(os.getenv("SHIP_INTERVAL", 900))
+    # A server that does not answer within these (seconds) fails the save, which is then spooled
+    DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", 10))
+    DB_STATEMENT_TIMEOUT = float(os.getenv("DB_STATEMENT_TIMEOUT", 60))
+    # Batches that cannot be saved are appended to gzip JSONL files in SPOOL_DIR (empty disables)
+    # and replayed, oldest first, once the database is back. Appends are fsynced at most every
+    # SPOOL_FSYNC_INTERVAL seconds; a file is closed past SPOOL_SEGMENT_BYTES
+    SPOOL_DIR = os.getenv("SPOOL_DIR", "spool")
+    SPOOL_FSYNC_INTERVAL = float(os.getenv("SPOOL_FSYNC_INTERVAL", 1.0))
+    SPOOL_SEGMENT_BYTES = int(os.getenv("SPOOL_SEGMENT_BYTES", 16 * 1024 * 1024))
     DB_NAME = os.getenv("DB_NAME", "kyoscan")
     DB_HOST = os.getenv("DB_HOST", "localhost")
     DB_PORT = int(os.getenv("DB_PORT", 5432))
     DB_USER = os.getenv("DB_USER", "user")
     DB_PASSWORD = os.getenv("DB_PASSWORD", "password")
+    # Save each batch with a handful of set-based statements instead of 3-5 per printer
+    DB_BULK_WRITE = os.getenv("DB_BULK_WRITE", "false").lower() in ("1", "true", "yes")
+    # Change-only logging: a poll that reads the same values as the last device_logs row only
+    # moves that row's valid_until (see the device_log_intervals view and kyoscan_log_series)
+    DB_DELTA_LOGS = os.getenv("DB_DELTA_LOGS", "false").lower() in ("1", "true", "yes")
+    # Daemon mode keeps device identities in memory; fully reloaded at least this often (seconds)
+    DEVICE_CACHE_MAX_AGE = float(os.getenv("DEVICE_CACHE_MAX_AGE", 3600))
+    # Pooled asyncio driver (psycopg 3) instead of one blocking psycopg2 connection;
+    # up to DB_POOL_MAX batches are saved concurrently
+    DB_ASYNC = os.getenv("DB_ASYNC", "false").lower() in ("1", "true", "yes")
+    DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", 1))
+    DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", 4))
+    DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+    # device_logs / device_history are partitioned by month; partitions older than this many
+    # months are dropped (0, the default for logs and history, keeps them forever). Hourly rollups
+    # are pruned the same way, daily rollups are kept. The daemon applies retention every
+    # RETENTION_INTERVAL seconds
+    LOG_RETENTION_MONTHS = int(os.getenv("LOG_RETENTION_MONTHS", 0))
+    HISTORY_RETENTION_MONTHS = int(os.getenv("HISTORY_RETENTION_MONTHS", 0))
+    HOURLY_ROLLUP_RETENTION_MONTHS = int(os.getenv("HOURLY_ROLLUP_RETENTION_MONTHS", 3))
+    RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", 86400))
+    # Daemon mode refreshes the device_usage_daily summary every USAGE_REFRESH_INTERVAL seconds
+    USAGE_REFRESH_INTERVAL = float(os.getenv("USAGE_REFRESH_INTERVAL", 900))
+    # Toner depletion forecast (device_toner_forecast), fitted on the daily rollups of the last
+    # FORECAST_WINDOW_DAYS since each cartridge change (a rise of FORECAST_REFILL_JUMP percent);
+    # the daemon recomputes it every FORECAST_INTERVAL seconds
+    FORECAST_WINDOW_DAYS = int(os.getenv("FORECAST_WINDOW_DAYS", 365))
+    FORECAST_MIN_SAMPLES = int(os.getenv("FORECAST_MIN_SAMPLES", 3))
+    FORECAST_REFILL_JUMP = float(os.getenv("FORECAST_REFILL_JUMP", 10))
+    FORECAST_INTERVAL = float(os.getenv("FORECAST_INTERVAL", 3600))
+    # Incremental Parquet ("parquet") or Arrow IPC ("arrow") export of device_logs and
+    # device_history to EXPORT_DIR (empty disables), read EXPORT_CHUNK_ROWS rows at a time;
+    # the daemon appends the new rows every EXPORT_INTERVAL seconds. Needs pyarrow
+    EXPORT_DIR = os.getenv("EXPORT_DIR", "")
+    EXPORT_FORMAT = os.getenv("EXPORT_FORMAT", "parquet")
+    EXPORT_COMPRESSION = os.getenv("EXPORT_COMPRESSION", "zstd")
+    EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", 50000))
+    EXPORT_INTERVAL = float(os.getenv("EXPORT_INTERVAL", 3600))
+
+    ### Address book (methods.AddressBookClient)
+    # Per-printer mirrors of the address book in ADDRESS_BOOK_MIRROR_DIR (empty, the default,
+    # disables them) answer duplicate checks; one older than ADDRESS_BOOK_MIRROR_MAX_AGE seconds
+    # is synced first. A sync only reads the details of new or renamed entries, so every
+    # ADDRESS_BOOK_MIRROR_FULL_REFRESH seconds (0 never) it reads them all, to see SMB hosts
+    # edited in place
+    ADDRESS_BOOK_MIRROR_DIR = os.getenv("ADDRESS_BOOK_MIRROR_DIR", "")
+    ADDRESS_BOOK_MIRROR_MAX_AGE = float(os.getenv("ADDRESS_BOOK_MIRROR_MAX_AGE", 300))
+    ADDRESS_BOOK_MIRROR_FULL_REFRESH = float(os.getenv("ADDRESS_BOOK_MIRROR_FULL_REFRESH", 3600))
+    # Fleet provisioning (provision.py): printers worked on at once, and retries per change
+    PROVISION_CONCURRENCY = int(os.getenv("PROVISION_CONCURRENCY", 20))
+    PROVISION_RETRIES = int(os.getenv("PROVISION_RETRIES", 2))
 
     ### Print Server
     PRINT_SERVER_IP = os.getenv("PRINT_SERVER_IP", "10.3.3.10")
@@ -19,10 +88,52 @@ class Config:
     ### Async Performance
     MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", 10))
     REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", 5.0))
+    MAX_REQUESTS_PER_HOST = int(os.getenv("MAX_REQUESTS_PER_HOST", 4))
+    # Adaptive (AIMD) concurrency: MAX_CONCURRENT_REQUESTS becomes the starting window,
+    # tuned per subnet between CONCURRENCY_MIN and CONCURRENCY_MAX.
+    # SUBNET_BUDGETS caps specific networks, e.g. "10.5.0.0/16=4,10.9.1.0/24=2"
+    ADAPTIVE_CONCURRENCY = os.getenv("ADAPTIVE_CONCURRENCY", "false").lower() in ("1", "true", "yes")
+    CONCURRENCY_MIN = int(os.getenv("CONCURRENCY_MIN", 2))
+    CONCURRENCY_MAX = int(os.getenv("CONCURRENCY_MAX", 100))
+    SUBNET_PREFIX = int(os.getenv("SUBNET_PREFIX", 24))
+    SUBNET_BUDGETS = os.getenv("SUBNET_BUDGETS", "")
+    ENDPOINT_RETRIES = int(os.getenv("ENDPOINT_RETRIES", 2))
+    RETRY_BACKOFF = float(os.getenv("RETRY_BACKOFF", 0.5))
+
+    ### Liveness probe / circuit breaker (PROBE_TIMEOUT=0 disables the probe)
+    PROBE_TIMEOUT = float(os.getenv("PROBE_TIMEOUT", 0.5))
+    PROBE_PORT = int(os.getenv("PROBE_PORT", 443))
+    PROBE_CONCURRENCY = int(os.getenv("PROBE_CONCURRENCY", 100))
+    BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", 1))
+    BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", 300))
+
+    ### Pipeline
+    # "batch" scrapes the whole fleet then saves; "stream" saves while scraping;
+    # "daemon" keeps running and polls each printer on its own interval
+    PIPELINE_MODE = os.getenv("PIPELINE_MODE", "batch")
+    PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 200))
+    PIPELINE_BATCH_SIZE = int(os.getenv("PIPELINE_BATCH_SIZE", 50))
+    PIPELINE_FLUSH_SECONDS = float(os.getenv("PIPELINE_FLUSH_SECONDS", 2.0))
+
+    ### Metrics (METRICS_PORT=0 and an empty METRICS_JSON_PATH disable the exporters)
+    METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+    METRICS_JSON_PATH = os.getenv("METRICS_JSON_PATH", "")
+    METRICS_DUMP_INTERVAL = float(os.getenv("METRICS_DUMP_INTERVAL", 60))
 
     ### Alerting
     ALERT_TONER_THRESHOLD = int(os.getenv("ALERT_TONER_THRESHOLD", 10))
     ALERT_OFFLINE_HOURS = int(os.getenv('ALERT_OFFLINE_HOURS', 48))
+    # Record raised/cleared transitions in alert_events on every save (see alerts.py)
+    ALERT_EVENTS = os.getenv("ALERT_EVENTS", "true").lower() in ("1", "true", "yes")
+
+    ### Daemon polling (PIPELINE_MODE=daemon)
+    POLL_BASE_INTERVAL = float(os.getenv("POLL_BASE_INTERVAL", 900))
+    POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", 120))
+    # Idle/offline printers back off up to a quarter of the offline alert window,
+    # so an outage is still seen several times before it raises an alert
+    POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", ALERT_OFFLINE_HOURS * 3600 / 4))
+    POLL_BUSY_PAGES_PER_HOUR = float(os.getenv("POLL_BUSY_PAGES_PER_HOUR", 60))
+    DISCOVERY_INTERVAL = float(os.getenv("DISCOVERY_INTERVAL", 3600))
 
     @classmethod
     def get_db_config(cls):
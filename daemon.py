@@ -0,0 +1,241 @@
+import asyncio
+import heapq
+import itertools
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from config import Config
+from device_cache import DeviceCache
+from fetcher import get_printers_from_server, create_client, fetch_printer_details, CircuitBreaker
+from limiter import AdaptiveLimiter
+from logger import get_logger
+from pipeline import (
+    write_batches, open_database, apply_retention, refresh_usage, refresh_forecast, export_history, ship_upstream,
+    END_OF_STREAM
+)
+
+def total_pages(data: Dict[str, Any]) -> Optional[int]:
+    """Sum every print and scan counter of a result, or None if none were read."""
+    counters = [value for group in (data.get('Print_Data'), data.get('Scan_Data')) if group
+                for value in group.values() if value is not None]
+    return sum(counters) if counters else None
+
+class PollScheduler:
+    """
+    Per-printer poll schedule kept in a heap ordered by due time.
+
+    Busy printers are polled more often, idle and offline printers back off
+    exponentially up to max_interval. Between polls a printer costs one heap entry.
+    """
+
+    def __init__(self, base_interval: float, min_interval: float, max_interval: float, busy_pages_per_hour: float):
+        self.base_interval = base_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.busy_pages_per_hour = busy_pages_per_hour
+        self.printers: Dict[str, Dict[str, Any]] = {}
+        self._heap: List[Tuple[float, int, str]] = []
+        self._sequence = itertools.count()
+        self.changed = asyncio.Event()
+
+    def sync(self, printer_dict: Dict[str, Optional[str]], now: float):
+        """
+        Add newly discovered printers (due immediately), update IPs and drop removed ones.
+
+        :param printer_dict: Printer name to IP mapping from the print server
+        :param now: Current monotonic time
+        """
+        for name in list(self.printers):
+            if name not in printer_dict:
+                del self.printers[name]  # Its heap entry is dropped when popped
+
+        for name, ip in printer_dict.items():
+            state = self.printers.get(name)
+            if state is None:
+                self.printers[name] = {'ip': ip, 'interval': self.base_interval, 'pages': None, 'polled_at': None, 'due': None}
+                self.schedule(name, now)
+            elif state['ip'] != ip:
+                state['ip'] = ip
+                state['interval'] = self.base_interval
+
+    def schedule(self, name: str, due: float):
+        """Put a printer back on the schedule, replacing any earlier entry."""
+        self.printers[name]['due'] = due
+        heapq.heappush(self._heap, (due, next(self._sequence), name))
+        self.changed.set()
+
+    def pop_due(self, now: float) -> List[str]:
+        """Remove and return every printer whose poll is due."""
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            when, _, name = heapq.heappop(self._heap)
+            state = self.printers.get(name)
+            if state is not None and state['due'] == when:
+                state['due'] = None
+                due.append(name)
+        return due
+
+    def next_due(self) -> Optional[float]:
+        """Return the time of the earliest scheduled poll."""
+        return self._heap[0][0] if self._heap else None
+
+    def record(self, name: str, data: Dict[str, Any], now: float) -> float:
+        """
+        Adapt the printer's interval to a poll result and reschedule it.
+
+        :param name: Printer name
+        :param data: Result of fetch_printer_details
+        :param now: Current monotonic time
+        :return: The new interval in seconds
+        """
+        state = self.printers.get(name)
+        if state is None:
+            return 0.0
+
+        interval = state['interval']
+        pages = total_pages(data)
+
+        if data.get('Status') != "Online" or pages is None:
+            interval = min(interval * 2, self.max_interval)
+        elif state['pages'] is not None and state['polled_at'] is not None:
+            delta = max(pages - state['pages'], 0)  # Counter reset counts as idle
+            hours = max(now - state['polled_at'], 1.0) / 3600
+
+            if delta / hours >= self.busy_pages_per_hour:
+                interval = max(interval / 2, self.min_interval)
+            elif delta == 0:
+                interval = min(interval * 2, self.max_interval)
+            else:
+                interval = min(max(self.base_interval, self.min_interval), self.max_interval)
+
+        if pages is not None:
+            state['pages'] = pages
+            state['polled_at'] = now
+        state['interval'] = interval
+
+        # Jitter keeps printers discovered together from staying in lockstep
+        self.schedule(name, now + interval * random.uniform(0.9, 1.1))
+        return interval
+
+async def run_daemon(printer_dict: Dict[str, Optional[str]]):
+    """
+    Poll every printer on its own adaptive interval until cancelled.
+
+    The HTTP client and the database connection stay open for the whole run and
+    the print server is re-read every Config.DISCOVERY_INTERVAL seconds. Shipping,
+    retention, usage and forecast refreshes and the history export run as
+    background tasks on their own intervals, one run of each at a time.
+
+    :param printer_dict: Initial printer name to IP mapping
+    """
+    logger = get_logger()
+    scheduler = PollScheduler(
+        Config.POLL_BASE_INTERVAL,
+        Config.POLL_MIN_INTERVAL,
+        Config.POLL_MAX_INTERVAL,
+        Config.POLL_BUSY_PAGES_PER_HOUR
+    )
+    scheduler.sync(printer_dict, time.monotonic())
+    next_discovery = time.monotonic() + Config.DISCOVERY_INTERVAL
+    next_retention = time.monotonic()
+    next_usage_refresh = time.monotonic()
+    next_forecast = time.monotonic()
+    next_export = time.monotonic() if Config.EXPORT_DIR else float("inf")
+    next_ship = time.monotonic() if Config.SHIP_UPSTREAM and Config.DB_BACKEND == "sqlite" else float("inf")
+
+    semaphore = AdaptiveLimiter.from_config() if Config.ADAPTIVE_CONCURRENCY else asyncio.Semaphore(Config.MAX_CONCURRENT_REQUESTS)
+    pool_size = Config.CONCURRENCY_MAX if Config.ADAPTIVE_CONCURRENCY else Config.MAX_CONCURRENT_REQUESTS
+    breaker = CircuitBreaker.from_config()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=Config.PIPELINE_QUEUE_SIZE)
+    in_flight = set()
+    maintenance: Dict[str, asyncio.Task] = {}
+
+    async def run_maintenance(label: str, job: Callable[[], Awaitable[Any]]):
+        try:
+            await job()
+        except Exception as e:
+            logger.error(f"{label} failed: {e}")
+
+    def start_maintenance(label: str, job: Callable[[], Awaitable[Any]]):
+        # Polls keep being dispatched while it runs; a job still running from its last interval is not started again
+        running = maintenance.get(label)
+        if running is not None and not running.done():
+            logger.warning(f"{label} is still running, not starting it again.")
+            return
+        maintenance[label] = asyncio.create_task(run_maintenance(label, job))
+
+    async def ship():
+        shipped = await ship_upstream()
+        logger.info(f"Shipped to the central database: {shipped}")
+
+    async def retention():
+        dropped = await apply_retention()
+        if dropped:
+            logger.info(f"Dropped expired partitions: {', '.join(dropped)}")
+
+    async def poll(client, name: str):
+        ip = scheduler.printers[name]['ip'] if name in scheduler.printers else None
+        data = await fetch_printer_details(client, name, ip, semaphore, Config.MAX_REQUESTS_PER_HOST, breaker)
+        scheduler.record(name, data, time.monotonic())
+        await queue.put(data)
+
+    # Device identities and last configs stay in memory between batches
+    async with open_database(device_cache=DeviceCache(Config.DEVICE_CACHE_MAX_AGE)) as db:
+        writer = asyncio.create_task(write_batches(queue, db, Config.PIPELINE_BATCH_SIZE, Config.PIPELINE_FLUSH_SECONDS))
+
+        async with create_client(pool_size, Config.MAX_REQUESTS_PER_HOST, Config.REQUEST_TIMEOUT) as client:
+            try:
+                while True:
+                    now = time.monotonic()
+
+                    if now >= next_discovery:
+                        discovered = await asyncio.to_thread(get_printers_from_server, Config.PRINT_SERVER_IP)
+                        if discovered:
+                            scheduler.sync(discovered, now)
+                        else:
+                            logger.error("Printer discovery failed, keeping the current printer list.")
+                        next_discovery = now + Config.DISCOVERY_INTERVAL
+
+                    # Retention keeps the local rows that are not shipped yet, so the two may overlap
+                    if now >= next_ship:
+                        start_maintenance("Shipping to the central database", ship)
+                        next_ship = now + Config.SHIP_INTERVAL
+
+                    if now >= next_retention:
+                        start_maintenance("Retention", retention)
+                        next_retention = now + Config.RETENTION_INTERVAL
+
+                    if now >= next_usage_refresh:
+                        start_maintenance("Usage refresh", refresh_usage)
+                        next_usage_refresh = now + Config.USAGE_REFRESH_INTERVAL
+
+                    if now >= next_forecast:
+                        start_maintenance("Forecast refresh", refresh_forecast)
+                        next_forecast = now + Config.FORECAST_INTERVAL
+
+                    if now >= next_export:
+                        start_maintenance("History export", export_history)
+                        next_export = now + Config.EXPORT_INTERVAL
+
+                    for name in scheduler.pop_due(now):
+                        task = asyncio.create_task(poll(client, name))
+                        in_flight.add(task)
+                        task.add_done_callback(in_flight.discard)
+
+                    next_due = scheduler.next_due()
+                    wake_at = min(next_discovery, next_retention, next_usage_refresh, next_forecast, next_export,
+                                  next_ship)
+                    if next_due is not None:
+                        wake_at = min(wake_at, next_due)
+                    scheduler.changed.clear()
+                    try:
+                        await asyncio.wait_for(scheduler.changed.wait(), max(wake_at - time.monotonic(), 0))
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                for task in in_flight | set(maintenance.values()):
+                    task.cancel()
+                await asyncio.gather(*in_flight, *maintenance.values(), return_exceptions=True)
+                await queue.put(END_OF_STREAM)
+                saved = await writer
+                logger.info(f"Kyoscan daemon stopped, {saved} printer snapshots saved.")
@@ -1,13 +1,538 @@
 import psycopg2
+import psycopg2.extras
 import re
-from typing import Optional, Dict, Any, List, Union
-from datetime import datetime
+from typing import Optional, Dict, Any, List, Tuple, Union
+from datetime import date, datetime
 from config import Config
+from alerts import AlertEngine, LOCK_EVENTS, SELECT_EVENTS
+from device_cache import DeviceCache
+from export import EXPORT_TABLES, HistoryExporter
+from forecast import TonerForecaster
+from metrics import get_registry
+from storage import Storage
 
-class Database:
-    def __init__(self, config: Config):
+metrics = get_registry()
+
+# device_current_state columns filled by each printer data field
+MISSING_FIELD_COLUMNS = {
+    'Hostname': ('hostname',),
+    'Mac': ('mac_address',),
+    'Toner': ('toner_level', 'toner_alert'),
+    'Print_Data': ('printer_copy_bw', 'printer_printer_bw', 'printer_fax_bw'),
+    'Scan_Data': ('scanner_copy', 'scanner_bw', 'scanner_other'),
+}
+
+### SQL shared by Database (psycopg2) and AsyncDatabase (psycopg 3); both use %s / %(name)s placeholders
+
+SELECT_DEVICE_BY_SERIAL = """
+    SELECT id
+    FROM devices
+    WHERE serial_number = %s
+"""
+
+UPDATE_DEVICE_MAC = """
+    UPDATE devices
+    SET mac_address = %s
+    WHERE id = %s
+"""
+
+## Another collector may have inserted the same serial since we looked
+INSERT_DEVICE = """
+    INSERT INTO devices (serial_number, mac_address, first_seen)
+    VALUES (%s, %s, %s)
+    ON CONFLICT (serial_number) DO UPDATE
+    SET mac_address = COALESCE(NULLIF(EXCLUDED.mac_address, ''), devices.mac_address)
+    RETURNING id, mac_address
+"""
+
+SELECT_DEVICE_BY_NAME = """
+    SELECT device_id
+    FROM device_history
+    WHERE device_name = %s
+    ORDER BY timestamp DESC, id DESC LIMIT 1
+"""
+
+SELECT_LAST_CONFIG = """
+    SELECT device_name, ip_address::text, hostname, mac_address
+    FROM device_history
+    WHERE device_id = %s
+    ORDER BY timestamp DESC, id DESC LIMIT 1
+"""
+
+INSERT_HISTORY = """
+    INSERT INTO device_history (device_id, device_name, ip_address, mac_address, hostname, timestamp)
+    VALUES (%s, %s, %s, %s, %s, %s)
+"""
+
+INSERT_LOG = """
+    INSERT INTO device_logs (
+        device_id, timestamp, status, toner_level,
+        printer_copy_bw, printer_printer_bw, printer_fax_bw,
+        scanner_copy, scanner_bw, scanner_other
+    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+"""
+
+# Change-only logging: a reading equal to the device's latest row of the same month extends
+# that row's valid_until instead of adding a row (same parameters as INSERT_LOG)
+INSERT_LOG_DELTA = """
+    WITH reading (
+        device_id, timestamp, status, toner_level,
+        printer_copy_bw, printer_printer_bw, printer_fax_bw,
+        scanner_copy, scanner_bw, scanner_other
+    ) AS (
+        VALUES (%s::integer, %s::timestamp, %s::varchar, %s::smallint,
+                %s::integer, %s::integer, %s::integer, %s::integer, %s::integer, %s::integer)
+    ), unchanged AS (
+        SELECT latest.id, latest.timestamp
+        FROM reading r
+        CROSS JOIN LATERAL (
+            SELECT * FROM device_logs
+            WHERE device_id = r.device_id AND timestamp >= date_trunc('month', r.timestamp)
+            ORDER BY timestamp DESC, id DESC
+            LIMIT 1
+        ) latest
+        WHERE (latest.status, latest.toner_level, latest.printer_copy_bw, latest.printer_printer_bw,
+               latest.printer_fax_bw, latest.scanner_copy, latest.scanner_bw, latest.scanner_other)
+              IS NOT DISTINCT FROM
+              (r.status, r.toner_level, r.printer_copy_bw, r.printer_printer_bw,
+               r.printer_fax_bw, r.scanner_copy, r.scanner_bw, r.scanner_other)
+    ), extended AS (
+        UPDATE device_logs l SET valid_until = r.timestamp
+        FROM unchanged u, reading r
+        WHERE l.id = u.id AND l.timestamp = u.timestamp AND l.timestamp < r.timestamp
+    )
+    INSERT INTO device_logs (
+        device_id, timestamp, status, toner_level,
+        printer_copy_bw, printer_printer_bw, printer_fax_bw,
+        scanner_copy, scanner_bw, scanner_other
+    )
+    SELECT * FROM reading
+    WHERE NOT EXISTS (SELECT 1 FROM unchanged)
+"""
+
+# Rows are only rewritten when a value changes (last_updated is the time of the last change);
+# every poll just moves device_last_seen.last_seen, a narrow row that is cheap to update.
+# A replayed snapshot older than the last change is not applied
+UPSERT_CURRENT_STATE = """
+    WITH seen AS (
+        INSERT INTO device_last_seen (device_id, last_seen)
+        VALUES (%(device_id)s, %(timestamp)s)
+        ON CONFLICT (device_id) DO UPDATE SET last_seen = GREATEST(device_last_seen.last_seen, EXCLUDED.last_seen)
+    )
+    INSERT INTO device_current_state (
+        device_id, device_name, ip_address, mac_address, hostname, status, toner_level,
+        printer_copy_bw, printer_printer_bw, printer_fax_bw,
+        scanner_copy, scanner_bw, scanner_other, last_updated,
+        toner_alert, offline_alert
+    ) VALUES (
+        %(device_id)s, %(name)s, %(ip)s, %(mac)s, %(hostname)s, %(status)s, %(toner)s,
+        %(copy_bw)s, %(printer_bw)s, %(fax_bw)s,
+        %(scan_copy)s, %(scan_bw)s, %(scan_other)s, %(timestamp)s,
+        %(toner_alert)s, %(offline_alert)s
+    )
+    ON CONFLICT (device_id) DO UPDATE SET
+        device_name = EXCLUDED.device_name,
+        ip_address = EXCLUDED.ip_address,
+        mac_address = CASE WHEN 'mac_address' = ANY(%(kept)s::text[]) THEN device_current_state.mac_address ELSE EXCLUDED.mac_address END,
+        hostname = CASE WHEN 'hostname' = ANY(%(kept)s::text[]) THEN device_current_state.hostname ELSE EXCLUDED.hostname END,
+        status = EXCLUDED.status,
+        toner_level = CASE WHEN 'toner_level' = ANY(%(kept)s::text[]) THEN device_current_state.toner_level ELSE EXCLUDED.toner_level END,
+        printer_copy_bw = CASE WHEN 'printer_copy_bw' = ANY(%(kept)s::text[]) THEN device_current_state.printer_copy_bw ELSE EXCLUDED.printer_copy_bw END,
+        printer_printer_bw = CASE WHEN 'printer_printer_bw' = ANY(%(kept)s::text[]) THEN device_current_state.printer_printer_bw ELSE EXCLUDED.printer_printer_bw END,
+        printer_fax_bw = CASE WHEN 'printer_fax_bw' = ANY(%(kept)s::text[]) THEN device_current_state.printer_fax_bw ELSE EXCLUDED.printer_fax_bw END,
+        scanner_copy = CASE WHEN 'scanner_copy' = ANY(%(kept)s::text[]) THEN device_current_state.scanner_copy ELSE EXCLUDED.scanner_copy END,
+        scanner_bw = CASE WHEN 'scanner_bw' = ANY(%(kept)s::text[]) THEN device_current_state.scanner_bw ELSE EXCLUDED.scanner_bw END,
+        scanner_other = CASE WHEN 'scanner_other' = ANY(%(kept)s::text[]) THEN device_current_state.scanner_other ELSE EXCLUDED.scanner_other END,
+        last_updated = EXCLUDED.last_updated,
+        toner_alert = CASE WHEN 'toner_alert' = ANY(%(kept)s::text[]) THEN device_current_state.toner_alert ELSE EXCLUDED.toner_alert END,
+        offline_alert = EXCLUDED.offline_alert
+    WHERE NOT device_current_state.last_updated > EXCLUDED.last_updated AND (
+          (device_current_state.device_name, device_current_state.ip_address,
+           device_current_state.status, device_current_state.offline_alert)
+          IS DISTINCT FROM (EXCLUDED.device_name, EXCLUDED.ip_address, EXCLUDED.status, EXCLUDED.offline_alert)
+       OR (NOT 'mac_address' = ANY(%(kept)s::text[]) AND device_current_state.mac_address IS DISTINCT FROM EXCLUDED.mac_address)
+       OR (NOT 'hostname' = ANY(%(kept)s::text[]) AND device_current_state.hostname IS DISTINCT FROM EXCLUDED.hostname)
+       OR (NOT 'toner_level' = ANY(%(kept)s::text[]) AND device_current_state.toner_level IS DISTINCT FROM EXCLUDED.toner_level)
+       OR (NOT 'printer_copy_bw' = ANY(%(kept)s::text[]) AND device_current_state.printer_copy_bw IS DISTINCT FROM EXCLUDED.printer_copy_bw)
+       OR (NOT 'printer_printer_bw' = ANY(%(kept)s::text[]) AND device_current_state.printer_printer_bw IS DISTINCT FROM EXCLUDED.printer_printer_bw)
+       OR (NOT 'printer_fax_bw' = ANY(%(kept)s::text[]) AND device_current_state.printer_fax_bw IS DISTINCT FROM EXCLUDED.printer_fax_bw)
+       OR (NOT 'scanner_copy' = ANY(%(kept)s::text[]) AND device_current_state.scanner_copy IS DISTINCT FROM EXCLUDED.scanner_copy)
+       OR (NOT 'scanner_bw' = ANY(%(kept)s::text[]) AND device_current_state.scanner_bw IS DISTINCT FROM EXCLUDED.scanner_bw)
+       OR (NOT 'scanner_other' = ANY(%(kept)s::text[]) AND device_current_state.scanner_other IS DISTINCT FROM EXCLUDED.scanner_other)
+       OR (NOT 'toner_alert' = ANY(%(kept)s::text[]) AND device_current_state.toner_alert IS DISTINCT FROM EXCLUDED.toner_alert))
+    RETURNING device_id
+"""
+
+## Bulk path: the batch goes into a staging table, then every table is written from it
+
+STAGING_COLUMNS = (
+    'ord', 'serial', 'name', 'ip', 'hostname', 'mac', 'status', 'toner',
+    'copy_bw', 'printer_bw', 'fax_bw', 'scan_copy', 'scan_bw', 'scan_other',
+    'toner_alert', 'offline_alert', 'kept'
+)
+
+CREATE_STAGING = """
+    CREATE TEMP TABLE printer_staging (
+        ord INTEGER PRIMARY KEY,
+        serial TEXT, name TEXT, ip TEXT, hostname TEXT, mac TEXT,
+        status TEXT, toner SMALLINT,
+        copy_bw INTEGER, printer_bw INTEGER, fax_bw INTEGER,
+        scan_copy INTEGER, scan_bw INTEGER, scan_other INTEGER,
+        toner_alert BOOLEAN, offline_alert BOOLEAN, kept TEXT[],
+        device_id INTEGER, generation INTEGER
+    ) ON COMMIT DROP
+"""
+
+## New serials take the first row's MAC; a known one only changes to a non-empty MAC,
+## and the last one in the batch wins, as with one UPDATE per row
+UPSERT_STAGED_DEVICES = """
+    INSERT INTO devices (serial_number, mac_address, first_seen)
+    SELECT serial,
+           COALESCE((array_agg(NULLIF(mac, '') ORDER BY ord DESC) FILTER (WHERE NULLIF(mac, '') IS NOT NULL))[1],
+                    (array_agg(mac ORDER BY ord))[1]),
+           %s
+    FROM printer_staging
+    WHERE serial IS NOT NULL
+    GROUP BY serial
+    ON CONFLICT (serial_number) DO UPDATE SET mac_address = EXCLUDED.mac_address
+    WHERE NULLIF(EXCLUDED.mac_address, '') IS NOT NULL
+"""
+
+## Without a serial, fall back to the device an earlier printer in the batch
+## or the latest history entry gave that name. The nth row of a device is
+## generation n; each generation is applied after the previous one.
+RESOLVE_STAGED = """
+    UPDATE printer_staging s
+    SET device_id = r.device_id, generation = r.generation
+    FROM (
+        SELECT ord, device_id,
+               CASE WHEN device_id IS NOT NULL
+                    THEN row_number() OVER (PARTITION BY device_id ORDER BY ord) END AS generation
+        FROM (
+            SELECT s.ord,
+                   CASE WHEN s.serial IS NOT NULL THEN (
+                       SELECT d.id FROM devices d WHERE d.serial_number = s.serial
+                   ) ELSE COALESCE((
+                       SELECT d.id
+                       FROM printer_staging p
+                       JOIN devices d ON d.serial_number = p.serial
+                       WHERE p.name = s.name AND p.ord < s.ord
+                       ORDER BY p.ord DESC LIMIT 1
+                   ), (
+                       SELECT h.device_id
+                       FROM device_history h
+                       WHERE h.device_name = s.name
+                       ORDER BY h.timestamp DESC, h.id DESC LIMIT 1
+                   )) END AS device_id
+            FROM printer_staging s
+        ) resolved
+    ) r
+    WHERE s.ord = r.ord
+    RETURNING s.name, s.generation
+"""
+
+## Same change test as should_update_config: host() drops the /32
+## suffix, a missing hostname or MAC never counts as a change
+INSERT_STAGED_HISTORY = """
+    INSERT INTO device_history (device_id, device_name, ip_address, mac_address, hostname, timestamp)
+    SELECT s.device_id, s.name, s.ip::inet, s.mac, s.hostname, %(timestamp)s
+    FROM printer_staging s
+    LEFT JOIN LATERAL (
+        SELECT TRUE AS found, h.device_name, host(h.ip_address) AS ip, h.hostname, h.mac_address
+        FROM device_history h
+        WHERE h.device_id = s.device_id
+        ORDER BY h.timestamp DESC, h.id DESC LIMIT 1
+    ) last ON TRUE
+    WHERE s.generation = %(generation)s
+      AND (last.found IS NULL
+           OR s.name IS DISTINCT FROM last.device_name
+           OR NULLIF(s.ip, '') IS DISTINCT FROM last.ip
+           OR (s.hostname IS NOT NULL AND s.hostname IS DISTINCT FROM last.hostname)
+           OR (s.mac IS NOT NULL AND s.mac IS DISTINCT FROM last.mac_address))
+    ORDER BY s.ord
+"""
+
+## Kept columns are read from the existing row before the insert,
+## so the conflict branch can take every EXCLUDED value as is
+UPSERT_STAGED_CURRENT_STATE = """
+    INSERT INTO device_current_state (
+        device_id, device_name, ip_address, mac_address, hostname, status, toner_level,
+        printer_copy_bw, printer_printer_bw, printer_fax_bw,
+        scanner_copy, scanner_bw, scanner_other, last_updated,
+        toner_alert, offline_alert
+    )
+    SELECT
+        s.device_id, s.name, s.ip::inet,
+        CASE WHEN cur.device_id IS NOT NULL AND 'mac_address' = ANY(s.kept) THEN cur.mac_address ELSE s.mac END,
+        CASE WHEN cur.device_id IS NOT NULL AND 'hostname' = ANY(s.kept) THEN cur.hostname ELSE s.hostname END,
+        s.status,
+        CASE WHEN cur.device_id IS NOT NULL AND 'toner_level' = ANY(s.kept) THEN cur.toner_level ELSE s.toner END,
+        CASE WHEN cur.device_id IS NOT NULL AND 'printer_copy_bw' = ANY(s.kept) THEN cur.printer_copy_bw ELSE s.copy_bw END,
+        CASE WHEN cur.device_id IS NOT NULL AND 'printer_printer_bw' = ANY(s.kept) THEN cur.printer_printer_bw ELSE s.printer_bw END,
+        CASE WHEN cur.device_id IS NOT NULL AND 'printer_fax_bw' = ANY(s.kept) THEN cur.printer_fax_bw ELSE s.fax_bw END,
+        CASE WHEN cur.device_id IS NOT NULL AND 'scanner_copy' = ANY(s.kept) THEN cur.scanner_copy ELSE s.scan_copy END,
+        CASE WHEN cur.device_id IS NOT NULL AND 'scanner_bw' = ANY(s.kept) THEN cur.scanner_bw ELSE s.scan_bw END,
+        CASE WHEN cur.device_id IS NOT NULL AND 'scanner_other' = ANY(s.kept) THEN cur.scanner_other ELSE s.scan_other END,
+        %(timestamp)s,
+        CASE WHEN cur.device_id IS NOT NULL AND 'toner_alert' = ANY(s.kept) THEN cur.toner_alert ELSE s.toner_alert END,
+        s.offline_alert
+    FROM printer_staging s
+    LEFT JOIN device_current_state cur ON cur.device_id = s.device_id
+    WHERE s.generation = %(generation)s
+    ON CONFLICT (device_id) DO UPDATE SET
+        device_name = EXCLUDED.device_name,
+        ip_address = EXCLUDED.ip_address,
+        mac_address = EXCLUDED.mac_address,
+        hostname = EXCLUDED.hostname,
+        status = EXCLUDED.status,
+        toner_level = EXCLUDED.toner_level,
+        printer_copy_bw = EXCLUDED.printer_copy_bw,
+        printer_printer_bw = EXCLUDED.printer_printer_bw,
+        printer_fax_bw = EXCLUDED.printer_fax_bw,
+        scanner_copy = EXCLUDED.scanner_copy,
+        scanner_bw = EXCLUDED.scanner_bw,
+        scanner_other = EXCLUDED.scanner_other,
+        last_updated = EXCLUDED.last_updated,
+        toner_alert = EXCLUDED.toner_alert,
+        offline_alert = EXCLUDED.offline_alert
+    WHERE NOT device_current_state.last_updated > EXCLUDED.last_updated
+      AND (device_current_state.device_name, device_current_state.ip_address, device_current_state.mac_address,
+           device_current_state.hostname, device_current_state.status, device_current_state.toner_level,
+           device_current_state.printer_copy_bw, device_current_state.printer_printer_bw,
+           device_current_state.printer_fax_bw, device_current_state.scanner_copy, device_current_state.scanner_bw,
+           device_current_state.scanner_other, device_current_state.toner_alert, device_current_state.offline_alert)
+          IS DISTINCT FROM
+          (EXCLUDED.device_name, EXCLUDED.ip_address, EXCLUDED.mac_address, EXCLUDED.hostname, EXCLUDED.status,
+           EXCLUDED.toner_level, EXCLUDED.printer_copy_bw, EXCLUDED.printer_printer_bw, EXCLUDED.printer_fax_bw,
+           EXCLUDED.scanner_copy, EXCLUDED.scanner_bw, EXCLUDED.scanner_other, EXCLUDED.toner_alert,
+           EXCLUDED.offline_alert)
+    RETURNING device_id
+"""
+
+TOUCH_STAGED_LAST_SEEN = """
+    INSERT INTO device_last_seen (device_id, last_seen)
+    SELECT DISTINCT device_id, %s::timestamp
+    FROM printer_staging
+    WHERE device_id IS NOT NULL
+    ON CONFLICT (device_id) DO UPDATE SET last_seen = GREATEST(device_last_seen.last_seen, EXCLUDED.last_seen)
+"""
+
+INSERT_STAGED_LOGS = """
+    INSERT INTO device_logs (
+        device_id, timestamp, status, toner_level,
+        printer_copy_bw, printer_printer_bw, printer_fax_bw,
+        scanner_copy, scanner_bw, scanner_other
+    )
+    SELECT device_id, %s, status, toner, copy_bw, printer_bw, fax_bw, scan_copy, scan_bw, scan_other
+    FROM printer_staging
+    WHERE device_id IS NOT NULL
+    ORDER BY ord
+"""
+
+# Spooled batches carry an id (see spool.py). A replay claims it in the transaction of the save,
+# so a batch that was saved before the replay was interrupted is skipped rather than saved twice
+CLAIM_BATCH = "INSERT INTO saved_batches (batch_id) VALUES (%s) ON CONFLICT DO NOTHING"
+
+# Bounds every statement of a save (Config.DB_STATEMENT_TIMEOUT), so a stalled server fails the
+# batch, which the pipeline then spools, instead of holding it
+SET_SAVE_TIMEOUT = "SELECT set_config('statement_timeout', %s, true)"
+
+# Monthly partitions of device_history and device_logs for this month and the next (see schema.sql)
+ENSURE_PARTITIONS = "SELECT kyoscan_ensure_partitions(%s)"
+
+DROP_PARTITIONS = "SELECT kyoscan_drop_partitions(%s, %s)"
+
+PRUNE_HOURLY_ROLLUP = """
+    DELETE FROM device_logs_hourly
+    WHERE bucket < date_trunc('month', now()) - make_interval(months => %s)
+"""
+
+# INSERT_STAGED_LOGS with change-only logging: the first occurrence of a device is compared
+# with its latest row of the month, later occurrences with the previous one, as INSERT_LOG_DELTA
+# would when run printer by printer
+INSERT_STAGED_LOGS_DELTA = """
+    WITH reading AS (
+        SELECT s.*, lag(s.ord) OVER (PARTITION BY s.device_id ORDER BY s.ord) AS previous_ord
+        FROM printer_staging s
+        WHERE s.device_id IS NOT NULL
+    ), latest AS (
+        SELECT latest.*
+        FROM (SELECT DISTINCT device_id FROM reading) d
+        CROSS JOIN LATERAL (
+            SELECT * FROM device_logs
+            WHERE device_id = d.device_id AND timestamp >= date_trunc('month', %(timestamp)s::timestamp)
+            ORDER BY timestamp DESC, id DESC
+            LIMIT 1
+        ) latest
+    ), compared AS (
+        SELECT r.*, latest.id AS latest_id, latest.timestamp AS latest_timestamp,
+               CASE
+                   WHEN r.previous_ord IS NOT NULL THEN
+                       (p.status, p.toner, p.copy_bw, p.printer_bw, p.fax_bw, p.scan_copy, p.scan_bw, p.scan_other)
+                       IS NOT DISTINCT FROM
+                       (r.status, r.toner, r.copy_bw, r.printer_bw, r.fax_bw, r.scan_copy, r.scan_bw, r.scan_other)
+                   WHEN latest.id IS NOT NULL THEN
+                       (latest.status, latest.toner_level, latest.printer_copy_bw, latest.printer_printer_bw,
+                        latest.printer_fax_bw, latest.scanner_copy, latest.scanner_bw, latest.scanner_other)
+                       IS NOT DISTINCT FROM
+                       (r.status, r.toner, r.copy_bw, r.printer_bw, r.fax_bw, r.scan_copy, r.scan_bw, r.scan_other)
+                   ELSE FALSE
+               END AS unchanged
+        FROM reading r
+        LEFT JOIN printer_staging p ON p.ord = r.previous_ord
+        LEFT JOIN latest ON latest.device_id = r.device_id AND r.previous_ord IS NULL
+    ), extended AS (
+        UPDATE device_logs l SET valid_until = %(timestamp)s
+        FROM compared c
+        WHERE c.unchanged AND c.latest_id IS NOT NULL
+          AND l.id = c.latest_id AND l.timestamp = c.latest_timestamp AND l.timestamp < %(timestamp)s
+    )
+    INSERT INTO device_logs (
+        device_id, timestamp, status, toner_level,
+        printer_copy_bw, printer_printer_bw, printer_fax_bw,
+        scanner_copy, scanner_bw, scanner_other
+    )
+    SELECT device_id, %(timestamp)s, status, toner, copy_bw, printer_bw, fax_bw, scan_copy, scan_bw, scan_other
+    FROM compared
+    WHERE NOT unchanged
+    ORDER BY ord
+"""
+
+## Usage analytics, read from device_usage_daily (see kyoscan_refresh_usage in schema.sql)
+
+REFRESH_USAGE = "SELECT kyoscan_refresh_usage(%s)"
+
+# Bucket sizes accepted by get_usage / get_fleet_usage (date_trunc units)
+USAGE_BUCKETS = ('day', 'week', 'month', 'quarter', 'year')
+
+# Queries below are formatted with the summary they read: device_usage_monthly when the
+# buckets and the range are whole months, else device_usage_daily
+USAGE_SOURCES = {'day': 'device_usage_daily', 'month': 'device_usage_monthly'}
+
+SELECT_USAGE = """
+    WITH buckets AS (
+        SELECT device_id, date_trunc(%(bucket)s, {period})::date AS bucket,
+               sum(printer_copy_bw)::bigint AS printer_copy_bw, sum(printer_printer_bw)::bigint AS printer_printer_bw,
+               sum(printer_fax_bw)::bigint AS printer_fax_bw, sum(scanner_copy)::bigint AS scanner_copy,
+               sum(scanner_bw)::bigint AS scanner_bw, sum(scanner_other)::bigint AS scanner_other,
+               sum(COALESCE(printer_copy_bw, 0) + COALESCE(printer_printer_bw, 0) + COALESCE(printer_fax_bw, 0))::bigint AS pages,
+               sum(COALESCE(scanner_copy, 0) + COALESCE(scanner_bw, 0) + COALESCE(scanner_other, 0))::bigint AS scans,
+               sum(resets)::bigint AS resets
+        FROM {table}
+        WHERE {period} >= %(start)s AND {period} < %(end)s
+          AND (%(device_ids)s::integer[] IS NULL OR device_id = ANY(%(device_ids)s::integer[]))
+        GROUP BY 1, 2
+    )
+    SELECT b.device_id, d.serial_number, c.device_name, b.bucket,
+           b.printer_copy_bw, b.printer_printer_bw, b.printer_fax_bw,
+           b.scanner_copy, b.scanner_bw, b.scanner_other, b.pages, b.scans,
+           (sum(b.pages) OVER (PARTITION BY b.device_id ORDER BY b.bucket))::bigint AS cumulative_pages,
+           b.resets
+    FROM buckets b
+    JOIN devices d ON d.id = b.device_id
+    LEFT JOIN device_current_state c ON c.device_id = b.device_id
+    ORDER BY b.device_id, b.bucket
+"""
+
+SELECT_FLEET_USAGE = """
+    SELECT date_trunc(%(bucket)s, {period})::date AS bucket,
+           count(DISTINCT device_id) AS devices,
+           sum(printer_copy_bw)::bigint AS printer_copy_bw, sum(printer_printer_bw)::bigint AS printer_printer_bw,
+           sum(printer_fax_bw)::bigint AS printer_fax_bw, sum(scanner_copy)::bigint AS scanner_copy,
+           sum(scanner_bw)::bigint AS scanner_bw, sum(scanner_other)::bigint AS scanner_other,
+           sum(COALESCE(printer_copy_bw, 0) + COALESCE(printer_printer_bw, 0) + COALESCE(printer_fax_bw, 0))::bigint AS pages,
+           sum(COALESCE(scanner_copy, 0) + COALESCE(scanner_bw, 0) + COALESCE(scanner_other, 0))::bigint AS scans,
+           (sum(sum(COALESCE(printer_copy_bw, 0) + COALESCE(printer_printer_bw, 0) + COALESCE(printer_fax_bw, 0)))
+               OVER (ORDER BY date_trunc(%(bucket)s, {period})::date))::bigint AS cumulative_pages,
+           sum(resets)::bigint AS resets
+    FROM {table}
+    WHERE {period} >= %(start)s AND {period} < %(end)s
+    GROUP BY 1
+    ORDER BY 1
+"""
+
+### Statement parameters shared by both drivers
+
+def config_changed(last_config: Optional[Tuple], name: str | Any, ip: Optional[str],
+                   mac: Optional[str], hostname: Optional[str]) -> bool:
+    """
+    Compare a printer's configuration with its latest device_history entry.
+
+    :param last_config: (device_name, ip_address, hostname, mac_address) or None if no history
+    :param name: Current device name
+    :param ip: Current IP address
+    :param mac: Current MAC address
+    :param hostname: Current hostname
+    :return: True if config should be updated
+    """
+
+    if not last_config:
+        return True
+
+    last_name, last_ip, last_hostname, last_mac = last_config
+
+    ## Handle /32 suffix from Postgres INET type
+    ip_changed = False
+    if ip and last_ip:
+        clean_last_ip = last_ip.split('/')[0] # Remove /32 if present
+        ip_changed = (ip != clean_last_ip)
+    elif bool(ip) != bool(last_ip): # One is None, the other isn't
+        ip_changed = True
+
+    hostname_changed = (hostname is not None and hostname != last_hostname)
+    mac_changed = (mac is not None and mac != last_mac)
+
+    return (name != last_name) or ip_changed or hostname_changed or mac_changed
+
+def log_params(device_id: int, data: Dict[str, Any], timestamp: datetime) -> Tuple:
+    """Parameters of INSERT_LOG for one printer."""
+    print_data = data.get('Print_Data') or {}
+    scan_data = data.get('Scan_Data') or {}
+    return (
+        device_id, timestamp, data.get('Status'), data.get('Toner'),
+        print_data.get('copy_bw'), print_data.get('printer_bw'), print_data.get('fax_bw'),
+        scan_data.get('scan_copy'), scan_data.get('scan_bw'), scan_data.get('scan_other')
+    )
+
+def current_state_params(device_id: int, data: Dict[str, Any], timestamp: datetime) -> Dict[str, Any]:
+    """Parameters of UPSERT_CURRENT_STATE for one printer."""
+    print_data = data.get('Print_Data') or {}
+    scan_data = data.get('Scan_Data') or {}
+    toner = data.get('Toner')
+    return {
+        'device_id': device_id, 'name': data.get('Name'), 'ip': data.get('IP'), 'mac': data.get('Mac'),
+        'hostname': data.get('Hostname'), 'status': data['Status'], 'toner': toner,
+        'copy_bw': print_data.get('copy_bw'), 'printer_bw': print_data.get('printer_bw'), 'fax_bw': print_data.get('fax_bw'),
+        'scan_copy': scan_data.get('scan_copy'), 'scan_bw': scan_data.get('scan_bw'), 'scan_other': scan_data.get('scan_other'),
+        'timestamp': timestamp,
+        'toner_alert': toner is not None and toner < Config.ALERT_TONER_THRESHOLD,
+        'offline_alert': data.get('Status') == 'Offline',
+        'kept': Database.kept_columns(data.get('Missing'))
+    }
+
+def staging_row(position: int, data: Dict[str, Any]) -> Tuple:
+    """One printer_staging row, in STAGING_COLUMNS order."""
+    print_data = data.get('Print_Data') or {}
+    scan_data = data.get('Scan_Data') or {}
+    toner = data.get('Toner')
+    return (
+        position, data.get('Serial') or None, data.get('Name'), data.get('IP'),
+        data.get('Hostname'), data.get('Mac'), data.get('Status'), toner,
+        print_data.get('copy_bw'), print_data.get('printer_bw'), print_data.get('fax_bw'),
+        scan_data.get('scan_copy'), scan_data.get('scan_bw'), scan_data.get('scan_other'),
+        toner is not None and toner < Config.ALERT_TONER_THRESHOLD,
+        data.get('Status') == 'Offline',
+        Database.kept_columns(data.get('Missing'))
+    )
+
+class Database(Storage):
+    def __init__(self, config: Config, device_cache: Optional[DeviceCache] = None,
+                 alert_engine: Optional[AlertEngine] = None):
         self.config = config.get_db_config()
         self.conn = None
+        self.device_cache = device_cache
+        self.alert_engine = alert_engine
+        self.partitions_month = None
     
     def connect(self):
         """Establish a connection to the PostgreSQL database."""
@@ -19,7 +544,8 @@ class Database:
                     host=self.config["host"],
                     port=self.config["port"],
                     user=self.config["user"],
-                    password=self.config["password"]
+                    password=self.config["password"],
+                    connect_timeout=Config.DB_CONNECT_TIMEOUT
                 )
             except Exception as e:
                 print(f"Database connection error: {e}")
@@ -43,9 +569,9 @@ class Database:
             else:
                 self.conn.rollback()
             self.close()
-    
-    def resolve_device_id(self, cursor, serial: Optional[str], name: str | Any, 
-                          ip: Optional[str], hostname: Optional[str], 
+
+    def resolve_device_id(self, cursor, serial: Optional[str], name: str | Any,
+                          ip: Optional[str], hostname: Optional[str],
                           mac: Optional[str], timestamp: datetime) -> Optional[int]:
         """
         Resolve device ID from database, inserting or updating as needed.
@@ -60,46 +586,40 @@ class Database:
         """
 
         device_db_id = None
+        cache = self.device_cache
 
         if serial:
-            cursor.execute("""
-                            SELECT id
-                            FROM devices
-                            WHERE serial_number = %s
-                            """, (serial,))
-            result_row = cursor.fetchone()
+            if cache is not None:
+                device_db_id = cache.device_id(serial)
+                result_row = (device_db_id,) if device_db_id else None
+            else:
+                cursor.execute(SELECT_DEVICE_BY_SERIAL, (serial,))
+                result_row = cursor.fetchone()
 
             if result_row:
                 device_db_id = result_row[0]
-                if mac:
-                    cursor.execute("""
-                                    UPDATE devices
-                                    SET mac_address = %s
-                                    WHERE id = %s
-                                    """, (mac, device_db_id))
+                if mac and (cache is None or cache.macs.get(device_db_id) != mac):
+                    cursor.execute(UPDATE_DEVICE_MAC, (mac, device_db_id))
+                    if cache is not None:
+                        cache.add_device(device_db_id, serial, mac)
             
             else:
-                cursor.execute("""
-                                INSERT INTO devices (serial_number, mac_address, first_seen)
-                                VALUES (%s, %s, %s)
-                                RETURNING id
-                                """, (serial, mac, timestamp))
-                device_db_id = cursor.fetchone()[0]
+                cursor.execute(INSERT_DEVICE, (serial, mac, timestamp))
+                device_db_id, stored_mac = cursor.fetchone()
+                if cache is not None:
+                    cache.add_device(device_db_id, serial, stored_mac)
+        elif cache is not None:
+            device_db_id = cache.device_id_by_name(name)
         else:
-            cursor.execute("""
-                            SELECT device_id
-                            FROM device_history
-                            WHERE device_name = %s
-                            ORDER BY timestamp DESC LIMIT 1
-                            """, (name,))
+            cursor.execute(SELECT_DEVICE_BY_NAME, (name,))
             result_row = cursor.fetchone()
 
             if result_row:
                 device_db_id = result_row[0]
                 
         return device_db_id
-    
-    def should_update_config(self, cursor, device_id: int, name: str | Any, 
+
+    def should_update_config(self, cursor, device_id: int, name: str | Any,
                             ip: Optional[str], mac: Optional[str], hostname: Optional[str]) -> bool:
         """
         Check if device configuration has changed since last recorded.
@@ -113,34 +633,86 @@ class Database:
         :return: True if config should be updated
         """
 
-        cursor.execute("""
-            SELECT device_name, ip_address::text, hostname, mac_address
-            FROM device_history 
-            WHERE device_id = %s 
-            ORDER BY timestamp DESC LIMIT 1
-        """, (device_id,))
+        if self.device_cache is not None:
+            cached = self.device_cache.last_config(device_id)
+            last_config = cached and (cached.name, cached.ip, cached.hostname, cached.mac)
+        else:
+            cursor.execute(SELECT_LAST_CONFIG, (device_id,))
+            last_config = cursor.fetchone()
+
+        return config_changed(last_config, name, ip, mac, hostname)
 
-        last_config = cursor.fetchone()
+    @staticmethod
+    def kept_columns(missing: Optional[Dict[str, str]]) -> List[str]:
+        """
+        Map the fields a scrape could not read to the current state columns to keep.
         
-        if not last_config:
-            return True
+        :param missing: Result field to failure reason, as reported by the fetcher
+        :return: Names of device_current_state columns that keep their last-known value
+        """
+
+        return [column for field in (missing or {}) for column in MISSING_FIELD_COLUMNS.get(field, ())]
+    
+    def evaluate_alerts(self, cursor, device_ids: List[int], timestamp: datetime) -> int:
+        """
+        Record alert transitions of the devices changed by the current save.
         
-        last_name, last_ip, last_hostname, last_mac = last_config
+        :param cursor: Database cursor, in the save transaction
+        :param device_ids: Devices whose current state row was inserted or changed
+        :param timestamp: Timestamp of the save
+        :return: Number of alert events written (0 without an alert engine)
+        """
 
-        ## Handle /32 suffix from Postgres INET type
-        ip_changed = False
-        if ip and last_ip:
-            clean_last_ip = last_ip.split('/')[0] # Remove /32 if present
-            ip_changed = (ip != clean_last_ip)
-        elif bool(ip) != bool(last_ip): # One is None, the other isn't
-            ip_changed = True
+        if self.alert_engine is None:
+            return 0
+
+        events = 0
+        with metrics.timer("kyoscan_db_phase_seconds", phase="alerts"):
+            cursor.execute(LOCK_EVENTS)
+            for query, params in self.alert_engine.statements(device_ids, timestamp):
+                cursor.execute(query, params)
+                events += cursor.rowcount
+        metrics.inc("kyoscan_alert_events_total", events)
+        return events
+    
+    def ensure_partitions(self, timestamp: datetime):
+        """
+        Make sure the monthly partitions for timestamp (and the next month) exist.
+        
+        Runs in its own transaction, once per month per connection, so the
+        partition DDL never holds locks for the duration of a save. Rows of a
+        month without a partition still land in the default partition.
+        
+        :param timestamp: Timestamp of the rows about to be saved
+        """
 
-        hostname_changed = (hostname is not None and hostname != last_hostname)
-        mac_changed = (mac is not None and mac != last_mac)
+        month = (timestamp.year, timestamp.month)
+        if month == self.partitions_month:
+            return
 
-        return (name != last_name) or ip_changed or hostname_changed or mac_changed
+        with metrics.timer("kyoscan_db_phase_seconds", phase="partitions"):
+            with self.conn.cursor() as cursor:
+                cursor.execute(ENSURE_PARTITIONS, (timestamp,))
+            self.conn.commit()
+        self.partitions_month = month
     
-    def save_printer_data(self, data_list: List[Dict[str, Any]]):
+    def save_timeout(self, cursor):
+        """Apply Config.DB_STATEMENT_TIMEOUT to the statements of the current transaction."""
+        if Config.DB_STATEMENT_TIMEOUT > 0:
+            cursor.execute(SET_SAVE_TIMEOUT, (str(int(Config.DB_STATEMENT_TIMEOUT * 1000)),))
+
+    def claim_batch(self, cursor, batch_id: Optional[str]) -> bool:
+        """Record a spooled batch as saved in the current transaction; False if it already was."""
+        if batch_id is None:
+            return True
+        cursor.execute(CLAIM_BATCH, (batch_id,))
+        if cursor.rowcount:
+            return True
+        print(f"Batch {batch_id} was already saved, skipping it.")
+        return False
+
+    def save_printer_data(self, data_list: List[Dict[str, Any]], bulk: Optional[bool] = None,
+                          timestamp: Optional[datetime] = None, batch_id: Optional[str] = None) -> int:
         """
         Save printer data to PostgreSQL database.
         
@@ -148,118 +720,408 @@ class Database:
         1. Resolves printer IDs (insert new or match existing)
         2. Updates configuration history when changes detected
         3. Logs usage data (toner, counters)
-        4. Updates current state table with alerts
+        4. Updates current state table with alerts, keeping the last-known
+           values of fields listed in the printer's 'Missing' dictionary;
+           rows whose values did not change are left alone and only
+           device_last_seen is touched
         
         :param data_list: List of printer data dictionaries
+        :param bulk: Use save_printer_data_bulk (default: Config.DB_BULK_WRITE)
+        :param timestamp: Time of the scrape (default: now), e.g. when replaying the spool
+        :param batch_id: Id of a spooled batch; the batch is skipped if it was already saved
+        :return: Number of printers saved
         """
 
         if not self.conn or self.conn.closed:
             print("Database connection is not established.")
-            return
+            return 0
+
+        if Config.DB_BULK_WRITE if bulk is None else bulk:
+            return self.save_printer_data_bulk(data_list, timestamp, batch_id)
         
+        timestamp = timestamp or datetime.now()
+        self.ensure_partitions(timestamp)
         cursor = self.conn.cursor()
-        timestamp = datetime.now()
         saved_count = 0
+        changed = []
         not_resolved = []
 
         try:
+            self.save_timeout(cursor)
+            if not self.claim_batch(cursor, batch_id):
+                self.conn.rollback()
+                return 0
+            if self.device_cache is not None:
+                with metrics.timer("kyoscan_db_phase_seconds", phase="cache"):
+                    self.device_cache.sync(cursor)
+
             for data in data_list:
                 serial = data.get('Serial')
                 name = data.get('Name')
                 ip = data.get('IP')
                 hostname = data.get('Hostname')
                 mac = data.get('Mac')
-                print_data = data.get('Print_Data') or {}
-                scan_data = data.get('Scan_Data') or {}
 
-                device_id = self.resolve_device_id(
-                    cursor,
-                    serial,
-                    name,
-                    ip,
-                    hostname,
-                    mac,
-                    timestamp
-                )
+                with metrics.timer("kyoscan_db_phase_seconds", phase="resolve"):
+                    device_id = self.resolve_device_id(
+                        cursor,
+                        serial,
+                        name,
+                        ip,
+                        hostname,
+                        mac,
+                        timestamp
+                    )
 
                 if not device_id:
                     not_resolved.append(name)
                     continue
 
-                if self.should_update_config(
-                    cursor,
-                    device_id,
-                    name,
-                    ip,
-                    mac,
-                    hostname
-                ):
-                    cursor.execute("""
-                        INSERT INTO device_history (device_id, device_name, ip_address, mac_address, hostname, timestamp)
-                        VALUES (%s, %s, %s, %s, %s, %s)
-                    """, (
+                with metrics.timer("kyoscan_db_phase_seconds", phase="history"):
+                    if self.should_update_config(
+                        cursor,
                         device_id,
                         name,
                         ip,
                         mac,
-                        hostname,
-                        timestamp
-                    ))
-
-                cursor.execute("""
-                    INSERT INTO device_logs (
-                        device_id, timestamp, status, toner_level,
-                        printer_copy_bw, printer_printer_bw, printer_fax_bw,
-                        scanner_copy, scanner_bw, scanner_other
-                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    """, (
-                        device_id, timestamp, data.get('Status'), data.get('Toner'),
-                        print_data.get('copy_bw'), print_data.get('printer_bw'), print_data.get('fax_bw'),
-                        scan_data.get('scan_copy'), scan_data.get('scan_bw'), scan_data.get('scan_other')
-                    ))
-                
-                toner_alert = data.get('Toner') is not None and data.get('Toner') < Config.ALERT_TONER_THRESHOLD
-                offline_alert = data.get('Status') == 'Offline'
-                
-                cursor.execute("""
-                    INSERT INTO device_current_state (
-                        device_id, device_name, ip_address, mac_address, hostname, status, toner_level,
-                        printer_copy_bw, printer_printer_bw, printer_fax_bw,
-                        scanner_copy, scanner_bw, scanner_other, last_updated,
-                        toner_alert, offline_alert
-                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    ON CONFLICT (device_id) DO UPDATE SET
-                        device_name = EXCLUDED.device_name,
-                        ip_address = EXCLUDED.ip_address,
-                        mac_address = EXCLUDED.mac_address,
-                        hostname = EXCLUDED.hostname,
-                        status = EXCLUDED.status,
-                        toner_level = EXCLUDED.toner_level,
-                        printer_copy_bw = EXCLUDED.printer_copy_bw,
-                        printer_printer_bw = EXCLUDED.printer_printer_bw,
-                        printer_fax_bw = EXCLUDED.printer_fax_bw,
-                        scanner_copy = EXCLUDED.scanner_copy,
-                        scanner_bw = EXCLUDED.scanner_bw,
-                        scanner_other = EXCLUDED.scanner_other,
-                        last_updated = EXCLUDED.last_updated,
-                        toner_alert = EXCLUDED.toner_alert,
-                        offline_alert = EXCLUDED.offline_alert
-                """, (
-                    device_id, name, ip, mac, hostname, data['Status'], data.get('Toner'),
-                    print_data.get('copy_bw'), print_data.get('printer_bw'), print_data.get('fax_bw'),
-                    scan_data.get('scan_copy'), scan_data.get('scan_bw'), scan_data.get('scan_other'),
-                    timestamp, toner_alert, offline_alert
-                ))
+                        hostname
+                    ):
+                        cursor.execute(INSERT_HISTORY, (
+                            device_id,
+                            name,
+                            ip,
+                            mac,
+                            hostname,
+                            timestamp
+                        ))
+                        if self.device_cache is not None:
+                            self.device_cache.record_config(device_id, name, ip, hostname, mac, timestamp)
+
+                with metrics.timer("kyoscan_db_phase_seconds", phase="logs"):
+                    cursor.execute(INSERT_LOG_DELTA if Config.DB_DELTA_LOGS else INSERT_LOG,
+                                   log_params(device_id, data, timestamp))
+
+                with metrics.timer("kyoscan_db_phase_seconds", phase="upsert"):
+                    cursor.execute(UPSERT_CURRENT_STATE, current_state_params(device_id, data, timestamp))
+                    if cursor.rowcount:  # 0 when the row already held these values
+                        changed.append(device_id)
 
                 saved_count += 1
             
-            self.conn.commit()
+            events = self.evaluate_alerts(cursor, changed, timestamp)
+
+            with metrics.timer("kyoscan_db_phase_seconds", phase="commit"):
+                self.conn.commit()
+            metrics.inc("kyoscan_db_printers_saved_total", saved_count)
+            metrics.inc("kyoscan_db_printers_unresolved_total", len(not_resolved))
+            metrics.inc("kyoscan_db_current_state_changed_total", len(changed))
             print(f"\nSaved data for {saved_count} printers.")
             print(f"Could not resolve device IDs for {len(not_resolved)} printers.")
+            print(f"Current state changed for {len(changed)} printers.")
+            if events:
+                print(f"Raised or cleared {events} alerts.")
+            return saved_count
             
         except Exception as e:
             self.conn.rollback()
+            if self.device_cache is not None:
+                self.device_cache.clear()  # It may hold rows that were just rolled back
+            metrics.inc("kyoscan_db_save_errors_total")
             print(f"Error saving printer data: {e}")
             raise
         finally:
-            cursor.close()
\ No newline at end of file
+            cursor.close()
+
+    def save_printer_data_bulk(self, data_list: List[Dict[str, Any]], timestamp: Optional[datetime] = None,
+                               batch_id: Optional[str] = None) -> int:
+        """
+        Save printer data with a fixed number of set-based statements.
+        
+        The batch is loaded into a temporary staging table with execute_values,
+        then devices, device_history, device_logs and device_current_state are
+        written from it, so the round-trips no longer grow with the batch size.
+        Results match save_printer_data: printers seen more than once in a batch
+        are applied in order, one "generation" (nth occurrence) at a time.
+        
+        :param data_list: List of printer data dictionaries
+        :param timestamp: Time of the scrape (default: now)
+        :param batch_id: Id of a spooled batch; the batch is skipped if it was already saved
+        :return: Number of printers saved
+        """
+
+        if not self.conn or self.conn.closed:
+            print("Database connection is not established.")
+            return 0
+
+        timestamp = timestamp or datetime.now()
+        self.ensure_partitions(timestamp)
+        cursor = self.conn.cursor()
+        rows = [staging_row(position, data) for position, data in enumerate(data_list)]
+
+        try:
+            self.save_timeout(cursor)
+            if not self.claim_batch(cursor, batch_id):
+                self.conn.rollback()
+                return 0
+            with metrics.timer("kyoscan_db_phase_seconds", phase="resolve"):
+                cursor.execute(CREATE_STAGING)
+                psycopg2.extras.execute_values(
+                    cursor,
+                    f"INSERT INTO printer_staging ({', '.join(STAGING_COLUMNS)}) VALUES %s",
+                    rows,
+                    template="(" + ", ".join(["%s"] * (len(STAGING_COLUMNS) - 1)) + ", %s::text[])",
+                    page_size=max(len(rows), 1)
+                )
+                cursor.execute(UPSERT_STAGED_DEVICES, (timestamp,))
+                cursor.execute(RESOLVE_STAGED)
+                resolved = cursor.fetchall()
+
+            not_resolved = [name for name, generation in resolved if generation is None]
+            generations = max((generation for _, generation in resolved if generation is not None), default=0)
+
+            changed = []
+
+            for generation in range(1, generations + 1):
+                with metrics.timer("kyoscan_db_phase_seconds", phase="history"):
+                    cursor.execute(INSERT_STAGED_HISTORY, {'timestamp': timestamp, 'generation': generation})
+
+                with metrics.timer("kyoscan_db_phase_seconds", phase="upsert"):
+                    cursor.execute(UPSERT_STAGED_CURRENT_STATE, {'timestamp': timestamp, 'generation': generation})
+                    changed += [row[0] for row in cursor.fetchall()]
+
+            with metrics.timer("kyoscan_db_phase_seconds", phase="upsert"):
+                cursor.execute(TOUCH_STAGED_LAST_SEEN, (timestamp,))
+
+            with metrics.timer("kyoscan_db_phase_seconds", phase="logs"):
+                if Config.DB_DELTA_LOGS:
+                    cursor.execute(INSERT_STAGED_LOGS_DELTA, {'timestamp': timestamp})
+                else:
+                    cursor.execute(INSERT_STAGED_LOGS, (timestamp,))
+
+            saved_count = len(resolved) - len(not_resolved)
+            events = self.evaluate_alerts(cursor, changed, timestamp)
+
+            with metrics.timer("kyoscan_db_phase_seconds", phase="commit"):
+                self.conn.commit()
+            metrics.inc("kyoscan_db_printers_saved_total", saved_count)
+            metrics.inc("kyoscan_db_printers_unresolved_total", len(not_resolved))
+            metrics.inc("kyoscan_db_current_state_changed_total", len(changed))
+            print(f"\nSaved data for {saved_count} printers.")
+            print(f"Could not resolve device IDs for {len(not_resolved)} printers.")
+            print(f"Current state changed for {len(changed)} printers.")
+            if events:
+                print(f"Raised or cleared {events} alerts.")
+            return saved_count
+            
+        except Exception as e:
+            self.conn.rollback()
+            metrics.inc("kyoscan_db_save_errors_total")
+            print(f"Error saving printer data: {e}")
+            raise
+        finally:
+            cursor.close()
+    
+    def apply_retention(self, log_months: Optional[int] = None, history_months: Optional[int] = None,
+                        hourly_months: Optional[int] = None) -> List[str]:
+        """
+        Drop expired monthly partitions and prune the hourly rollup.
+        
+        Dropping a partition is a catalog change rather than a DELETE, so no dead
+        rows or vacuum debt are left behind. Daily rollups are never pruned and
+        keep the history of dropped months.
+        
+        :param log_months: Months of device_logs to keep (default: Config.LOG_RETENTION_MONTHS, 0 keeps all)
+        :param history_months: Months of device_history to keep (default: Config.HISTORY_RETENTION_MONTHS)
+        :param hourly_months: Months of device_logs_hourly to keep (default: Config.HOURLY_ROLLUP_RETENTION_MONTHS)
+        :return: Names of the dropped partitions
+        """
+
+        if not self.conn or self.conn.closed:
+            print("Database connection is not established.")
+            return []
+
+        retention = (
+            ('device_logs', Config.LOG_RETENTION_MONTHS if log_months is None else log_months),
+            ('device_history', Config.HISTORY_RETENTION_MONTHS if history_months is None else history_months),
+        )
+        hourly_months = Config.HOURLY_ROLLUP_RETENTION_MONTHS if hourly_months is None else hourly_months
+        dropped = []
+
+        try:
+            with self.conn.cursor() as cursor:
+                for table, months in retention:
+                    if months > 0:
+                        cursor.execute(DROP_PARTITIONS, (table, months))
+                        dropped += [row[0] for row in cursor.fetchall()]
+                if hourly_months > 0:
+                    cursor.execute(PRUNE_HOURLY_ROLLUP, (hourly_months,))
+            self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            print(f"Error applying retention: {e}")
+            raise
+
+        metrics.inc("kyoscan_db_partitions_dropped_total", len(dropped))
+        return dropped
+    
+    def refresh_usage(self, since: Optional[date] = None) -> int:
+        """
+        Bring the device_usage_daily summary up to date with device_logs.
+        
+        Only the days since the previous refresh are recomputed (all of them on
+        the first run), so calling this after every save is cheap.
+        
+        :param since: Recompute from this day instead, e.g. after correcting old logs
+        :return: Number of device-days written
+        """
+
+        if not self.conn or self.conn.closed:
+            print("Database connection is not established.")
+            return 0
+
+        try:
+            with metrics.timer("kyoscan_db_phase_seconds", phase="usage"):
+                with self.conn.cursor() as cursor:
+                    cursor.execute(REFRESH_USAGE, (since,))
+                    refreshed = cursor.fetchone()[0]
+                self.conn.commit()
+            return refreshed
+        except Exception as e:
+            self.conn.rollback()
+            print(f"Error refreshing usage: {e}")
+            raise
+
+    def refresh_forecast(self, forecaster: Optional[TonerForecaster] = None) -> int:
+        """
+        Recompute the toner depletion forecast of the whole fleet (device_toner_forecast).
+        
+        :param forecaster: Forecast settings (default: TonerForecaster.from_config())
+        :return: Number of devices forecast
+        """
+
+        if not self.conn or self.conn.closed:
+            print("Database connection is not established.")
+            return 0
+
+        forecaster = forecaster or TonerForecaster.from_config()
+        now = datetime.now()
+        try:
+            with metrics.timer("kyoscan_db_phase_seconds", phase="forecast"):
+                history = forecaster.load(self.conn, now)
+                forecast = forecaster.fit(history, now)
+                with self.conn.cursor() as cursor:
+                    forecast_count = forecaster.store(cursor, forecast, now)
+                self.conn.commit()
+            return forecast_count
+        except Exception as e:
+            self.conn.rollback()
+            print(f"Error refreshing forecast: {e}")
+            raise
+
+    def export_history(self, tables: Tuple[str, ...] = EXPORT_TABLES,
+                       exporter: Optional[HistoryExporter] = None) -> Dict[str, int]:
+        """
+        Append the rows added since the last export to the Parquet/Arrow export (see HistoryExporter).
+        
+        :param tables: Tables to export (default: device_logs and device_history)
+        :param exporter: Export settings (default: HistoryExporter.from_config())
+        :return: Number of rows exported, by table
+        """
+
+        if not self.conn or self.conn.closed:
+            print("Database connection is not established.")
+            return {}
+
+        exporter = exporter or HistoryExporter.from_config()
+        exported = {}
+        try:
+            with metrics.timer("kyoscan_db_phase_seconds", phase="export"):
+                for table in tables:
+                    exported[table] = exporter.export(self.conn, table)
+            return exported
+        except Exception as e:
+            self.conn.rollback()
+            print(f"Error exporting history: {e}")
+            raise
+
+    def _query_usage(self, query: str, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Run a usage query against the coarsest summary that answers it exactly."""
+        if params['bucket'] not in USAGE_BUCKETS:
+            raise ValueError(f"Unknown bucket {params['bucket']!r}, expected one of {', '.join(USAGE_BUCKETS)}")
+
+        if not self.conn or self.conn.closed:
+            print("Database connection is not established.")
+            return []
+
+        start, end = params['start'], params['end']
+        period = 'month' if params['bucket'] in ('month', 'quarter', 'year') and start.day == 1 and end.day == 1 else 'day'
+
+        with self.conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            cursor.execute(query.format(table=USAGE_SOURCES[period], period=period), params)
+            rows = [dict(row) for row in cursor.fetchall()]
+        self.conn.commit()
+        return rows
+    
+    def get_usage(self, start: date, end: date, bucket: str = 'day',
+                  device_ids: Optional[List[int]] = None) -> List[Dict[str, Any]]:
+        """
+        Pages printed and scanned per device and bucket, from the daily usage summary.
+        
+        Each counter column holds the increase of that counter over the bucket;
+        a counter that went down (device reset or replaced board) counts from
+        zero and is reported in 'resets'. 'pages' is copy + print + fax,
+        'scans' the three scanner counters, 'cumulative_pages' the running total
+        of the device over the range. Reflects the last refresh_usage().
+        Month, quarter and year buckets over whole months are read from the
+        monthly summary; anything else from the daily one.
+        
+        :param start: First day of the range
+        :param end: Day after the range (exclusive)
+        :param bucket: 'day', 'week', 'month', 'quarter' or 'year'
+        :param device_ids: Only these devices (default: all)
+        :return: One dictionary per device and bucket with data, ordered by device and bucket
+        """
+
+        return self._query_usage(SELECT_USAGE, {
+            'start': start, 'end': end, 'bucket': bucket,
+            'device_ids': list(device_ids) if device_ids is not None else None
+        })
+    
+    def get_fleet_usage(self, start: date, end: date, bucket: str = 'day') -> List[Dict[str, Any]]:
+        """
+        Pages printed and scanned by the whole fleet per bucket.
+        
+        Same columns as get_usage summed over devices, plus 'devices', the
+        number of devices that reported during the bucket.
+        
+        :param start: First day of the range
+        :param end: Day after the range (exclusive)
+        :param bucket: 'day', 'week', 'month', 'quarter' or 'year'
+        :return: One dictionary per bucket with data, in order
+        """
+
+        return self._query_usage(SELECT_FLEET_USAGE, {'start': start, 'end': end, 'bucket': bucket})
+    
+    def get_alert_events(self, after_id: int = 0, limit: int = 1000) -> List[Dict[str, Any]]:
+        """
+        Alert events written after a given event, oldest first.
+        
+        Consumers keep the id of the last event they handled and pass it back,
+        instead of polling devices_alert_view.
+        
+        :param after_id: Id of the last event already read (0 for all)
+        :param limit: Maximum number of events returned
+        :return: Dictionaries with id, device_id, serial_number, device_name,
+                 alert ('toner_low', 'offline', 'offline_sustained'),
+                 event ('raised' or 'cleared'), at and value
+        """
+
+        if not self.conn or self.conn.closed:
+            print("Database connection is not established.")
+            return []
+
+        with self.conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            cursor.execute(SELECT_EVENTS, (after_id, limit))
+            rows = [dict(row) for row in cursor.fetchall()]
+        self.conn.commit()
+        return rows
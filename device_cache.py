@@ -0,0 +1,141 @@
+import time
+from datetime import datetime
+from typing import Dict, NamedTuple, Optional
+from metrics import get_registry
+
+metrics = get_registry()
+
+class DeviceConfig(NamedTuple):
+    """Latest device_history entry of a device (ip without the /32 suffix)."""
+    device_id: int
+    name: Optional[str]
+    ip: Optional[str]
+    hostname: Optional[str]
+    mac: Optional[str]
+    timestamp: datetime
+    history_id: int
+
+# Every device, the latest history entry per device and per name, and the history watermark
+_FULL_LOAD = """
+    SELECT 'device', id, id, serial_number, NULL, NULL, NULL, mac_address, NULL::timestamp
+    FROM devices
+    UNION ALL
+    (SELECT DISTINCT ON (device_id) 'history', id, device_id, NULL, device_name, host(ip_address), hostname, mac_address, timestamp
+     FROM device_history
+     ORDER BY device_id, timestamp DESC, id DESC)
+    UNION ALL
+    (SELECT DISTINCT ON (device_name) 'history', id, device_id, NULL, device_name, host(ip_address), hostname, mac_address, timestamp
+     FROM device_history
+     WHERE device_name IS NOT NULL
+     ORDER BY device_name, timestamp DESC, id DESC)
+    UNION ALL
+    SELECT 'watermark', (SELECT max(id) FROM device_history), NULL, NULL, NULL, NULL, NULL, NULL, NULL
+"""
+
+# Rows written since the watermarks, by this process or any other collector
+_DELTA_LOAD = """
+    SELECT 'device', id, id, serial_number, NULL, NULL, NULL, mac_address, NULL::timestamp
+    FROM devices
+    WHERE id > %(devices)s OR id IN (SELECT device_id FROM device_history WHERE id > %(history)s)
+    UNION ALL
+    SELECT 'history', id, device_id, NULL, device_name, host(ip_address), hostname, mac_address, timestamp
+    FROM device_history
+    WHERE id > %(history)s
+"""
+
+class DeviceCache:
+    """
+    In-process copy of device identities and their last recorded configuration.
+
+    Lets Database.resolve_device_id and should_update_config answer from memory.
+    sync() runs once per save: the first call (and one every max_age seconds)
+    loads everything with a single query, later calls only fetch devices and
+    history rows above the id watermarks, so rows written by another collector
+    are picked up before they could be compared against stale values. The
+    periodic full reload bounds staleness from ids committed out of order.
+    """
+
+    def __init__(self, max_age: float = 3600):
+        self.max_age = max_age
+        self.clear()
+
+    def clear(self):
+        """Forget everything; the next sync() does a full load."""
+        self.ids_by_serial: Dict[str, int] = {}
+        self.macs: Dict[int, Optional[str]] = {}
+        self.configs: Dict[int, DeviceConfig] = {}
+        self.names: Dict[str, DeviceConfig] = {}
+        self.device_watermark = 0
+        self.history_watermark = 0
+        self.loaded_at: Optional[float] = None
+
+    def sync(self, cursor):
+        """
+        Bring the cache up to date with the database.
+
+        :param cursor: Database cursor, in the transaction about to use the cache
+        """
+
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > self.max_age:
+            self.clear()
+            cursor.execute(_FULL_LOAD)
+            self.loaded_at = time.monotonic()
+            metrics.inc("kyoscan_device_cache_loads_total", kind="full")
+        else:
+            cursor.execute(_DELTA_LOAD, {'devices': self.device_watermark, 'history': self.history_watermark})
+            metrics.inc("kyoscan_device_cache_loads_total", kind="delta")
+
+        for kind, row_id, device_id, serial, name, ip, hostname, mac, timestamp in cursor.fetchall():
+            if kind == 'device':
+                self.ids_by_serial[serial] = device_id
+                self.macs[device_id] = mac
+                self.device_watermark = max(self.device_watermark, device_id)
+            elif kind == 'history':
+                self._apply(DeviceConfig(device_id, name, ip, hostname, mac, timestamp, row_id))
+            if row_id is not None and kind != 'device':
+                self.history_watermark = max(self.history_watermark, row_id)
+
+        metrics.set_gauge("kyoscan_device_cache_devices", len(self.ids_by_serial))
+
+    def _apply(self, config: DeviceConfig):
+        """Keep a history entry if it is the latest for its device and for its name."""
+        order = (config.timestamp, config.history_id)
+        current = self.configs.get(config.device_id)
+        if current is None or order > (current.timestamp, current.history_id):
+            self.configs[config.device_id] = config
+        if config.name is not None:
+            current = self.names.get(config.name)
+            if current is None or order > (current.timestamp, current.history_id):
+                self.names[config.name] = config
+
+    def device_id(self, serial: str) -> Optional[int]:
+        """Device ID of a serial number, or None if it is not known."""
+        return self.ids_by_serial.get(serial)
+
+    def device_id_by_name(self, name: str) -> Optional[int]:
+        """Device ID of the latest history entry with this name, as resolve_device_id looks it up."""
+        config = self.names.get(name)
+        return config.device_id if config else None
+
+    def last_config(self, device_id: int) -> Optional[DeviceConfig]:
+        """Latest recorded configuration of a device, or None if it has no history."""
+        return self.configs.get(device_id)
+
+    def add_device(self, device_id: int, serial: str, mac: Optional[str]):
+        """Record a device row written in the current transaction."""
+        self.ids_by_serial[serial] = device_id
+        self.macs[device_id] = mac
+
+    def record_config(self, device_id: int, name: Optional[str], ip: Optional[str],
+                      hostname: Optional[str], mac: Optional[str], timestamp: datetime):
+        """Record a device_history row written in the current transaction."""
+        # history_id 0 sorts before the row itself once a delta load reads it back,
+        # but a later write at the same timestamp must still win, so compare timestamps only
+        config = DeviceConfig(device_id, name, ip, hostname, mac, timestamp, 0)
+        current = self.configs.get(device_id)
+        if current is None or timestamp >= current.timestamp:
+            self.configs[device_id] = config
+        if name is not None:
+            current = self.names.get(name)
+            if current is None or timestamp >= current.timestamp:
+                self.names[name] = config
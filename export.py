@@ -0,0 +1,149 @@
+import json
+import os
+from pathlib import Path
+from typing import Dict
+from config import Config
+from metrics import get_registry
+
+metrics = get_registry()
+
+# Tables that can be exported; both are append-only and keyed by a serial id
+EXPORT_TABLES = ('device_logs', 'device_history')
+
+# Highest id any committed row can have. The SHARE lock waits for the saves in flight and holds
+# off new ones for this one statement, so no row at or below it can commit after the export
+SELECT_UPPER_ID = """
+    LOCK TABLE {table} IN SHARE MODE;
+    SELECT COALESCE(pg_sequence_last_value(pg_get_serial_sequence('{table}', 'id')), 0);
+"""
+
+# Read with a named cursor, in id order, so exports can resume after the last id
+SELECT_ROWS = "SELECT * FROM {table} WHERE id > %s AND id <= %s ORDER BY id"
+
+WATERMARK_FILE = "watermark.json"
+
+FILE_EXTENSIONS = {'parquet': 'parquet', 'arrow': 'arrow'}
+
+def arrow_type(type_code: int):
+    """Arrow type of a PostgreSQL column (cursor.description type_code); unknown types become strings."""
+    import pyarrow as pa
+    return {
+        16: pa.bool_(), 20: pa.int64(), 21: pa.int16(), 23: pa.int32(),
+        700: pa.float32(), 701: pa.float64(),
+        1082: pa.date32(), 1114: pa.timestamp('us'), 1184: pa.timestamp('us', tz='UTC'),
+    }.get(type_code, pa.string())
+
+class HistoryExporter:
+    """
+    Incremental columnar export of device_logs and device_history for BI tools.
+
+    Rows newer than the watermark of the last export (the highest id exported,
+    kept in watermark.json in the export directory) are streamed from a named
+    cursor chunk_rows at a time and appended to one new file per table and month,
+    table/month=YYYY-MM/part-<watermark>.<format>, so memory stays flat whatever
+    the size of the history. Files are Parquet or Arrow IPC, compressed with
+    compression. A file only gets its final name once it is complete, and the
+    watermark is moved after all files are; an export that fails is rerun from
+    the same watermark and rewrites the same files.
+
+    Rows are exported once: the valid_until that change-only logging later moves
+    on an exported row is not exported again.
+    """
+
+    def __init__(self, directory: str = "export", file_format: str = "parquet", compression: str = "zstd",
+                 chunk_rows: int = 50000):
+        if file_format not in FILE_EXTENSIONS:
+            raise ValueError(f"Unknown export format {file_format!r}, expected 'parquet' or 'arrow'")
+        self.directory = Path(directory)
+        self.file_format = file_format
+        self.compression = compression
+        self.chunk_rows = chunk_rows
+
+    @classmethod
+    def from_config(cls) -> "HistoryExporter":
+        """Create an exporter with the Config export settings."""
+        return cls(Config.EXPORT_DIR, Config.EXPORT_FORMAT, Config.EXPORT_COMPRESSION, Config.EXPORT_CHUNK_ROWS)
+
+    def watermarks(self) -> Dict[str, int]:
+        """Highest id exported so far, by table."""
+        path = self.directory / WATERMARK_FILE
+        return json.loads(path.read_text(encoding="utf-8")) if path.exists() else {}
+
+    def save_watermarks(self, watermarks: Dict[str, int]):
+        """Replace the watermark file atomically."""
+        path = self.directory / WATERMARK_FILE
+        path.with_suffix(".tmp").write_text(json.dumps(watermarks, indent=2), encoding="utf-8")
+        os.replace(path.with_suffix(".tmp"), path)
+
+    def open_writer(self, path: Path, schema):
+        """Open a Parquet or Arrow IPC file writer on path."""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self.file_format == 'parquet':
+            return pq.ParquetWriter(path, schema, compression=self.compression)
+        options = pa.ipc.IpcWriteOptions(compression=self.compression)
+        return pa.ipc.new_file(str(path), schema, options=options)
+
+    def export(self, conn, table: str) -> int:
+        """
+        Export the rows of table added since the last export.
+
+        :param conn: psycopg2 connection, not in a transaction
+        :param table: One of EXPORT_TABLES
+        :return: Number of rows exported
+        """
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        if table not in EXPORT_TABLES:
+            raise ValueError(f"Unknown export table {table!r}, expected one of {', '.join(EXPORT_TABLES)}")
+
+        watermarks = self.watermarks()
+        after_id = watermarks.get(table, 0)
+        with conn.cursor() as cursor:
+            cursor.execute(SELECT_UPPER_ID.format(table=table))
+            upper_id = cursor.fetchone()[0]
+        conn.commit()
+        if upper_id <= after_id:
+            return 0
+
+        schema = None
+        writers = {}
+        exported = 0
+        cursor = conn.cursor(name=f"kyoscan_export_{table}")
+        try:
+            cursor.execute(SELECT_ROWS.format(table=table), (after_id, upper_id))
+            while rows := cursor.fetchmany(self.chunk_rows):
+                if schema is None:
+                    schema = pa.schema([(column.name, arrow_type(column.type_code)) for column in cursor.description])
+                columns = list(zip(*rows))
+                del rows
+                chunk = pa.Table.from_arrays(
+                    [pa.array(values, field.type) for values, field in zip(columns, schema)], schema=schema)
+                del columns
+
+                # Rows are in id order, so a chunk rarely spans more than one month
+                months = pc.strftime(chunk.column('timestamp'), format='%Y-%m')
+                for month in pc.unique(months).to_pylist():
+                    if month not in writers:
+                        path = self.directory / table / f"month={month}" / \
+                            f"part-{after_id:012d}.{FILE_EXTENSIONS[self.file_format]}"
+                        path.parent.mkdir(parents=True, exist_ok=True)
+                        writers[month] = (path, self.open_writer(path.with_name(path.name + ".tmp"), schema))
+                    writers[month][1].write_table(chunk.filter(pc.equal(months, month)))
+                exported += chunk.num_rows
+            cursor.close()
+            conn.commit()
+        except Exception:
+            for path, writer in writers.values():
+                writer.close()
+                path.with_name(path.name + ".tmp").unlink(missing_ok=True)
+            raise
+
+        for path, writer in writers.values():
+            writer.close()
+            os.replace(path.with_name(path.name + ".tmp"), path)
+        self.save_watermarks({**self.watermarks(), table: upper_id})
+        metrics.inc("kyoscan_export_rows_total", exported, table=table)
+        return exported
@@ -1,8 +1,16 @@
 import asyncio
 import httpx
 import win32print
+import random
 import re
-from typing import Dict, List, Optional, Any
+import time
+from typing import AsyncIterator, Dict, List, Optional, Any, Union
+from config import Config
+from limiter import AdaptiveLimiter
+from metrics import get_registry
+from model_parser import parse_pp_assignments, pp_int, pp_list, pp_str
+
+metrics = get_registry()
 
     
 def get_printers_from_server(server_ip: str) -> Optional[Dict[str, Optional[str]]]:
@@ -35,89 +43,316 @@ async def fetch_printer_data(client: httpx.AsyncClient, ip: str, endpoint: str,
     response.raise_for_status()
     return response.text
 
+PRINTER_INFO_FIELDS = {
+    "hostname": "hostName",
+    "serial": "serialNumber",
+    "mac": "macAddress"
+}
+
+PRINT_COUNTER_FIELDS = {
+    "copy_bw": "copyBlackWhite",
+    "printer_bw": "printerBlackWhite",
+    "fax_bw": "faxBlackWhite"
+}
+
+SCAN_COUNTER_FIELDS = {
+    "scan_copy": "scanCopy",
+    "scan_bw": "scanBlackWhite",
+    "scan_other": "scanOther"
+}
+
 async def parse_printer_info(text: str) -> Dict[str, Optional[str]]:
     """Parse hostname, serial, and MAC from response text."""
-    patterns = {
-        "hostname": r"_pp\.hostName\s*=\s*'([^']*)';",
-        "serial": r"_pp\.serialNumber\s*=\s*'([^']*)';",
-        "mac": r"_pp\.macAddress\s*=\s*'([^']*)';"
-    }
-    return {key: (re.search(pattern, text).group(1) if re.search(pattern, text) else None) for key, pattern in patterns.items()}
+    assignments = parse_pp_assignments(text, PRINTER_INFO_FIELDS.values())
+    return {key: pp_str(assignments, field) for key, field in PRINTER_INFO_FIELDS.items()}
 
 async def parse_toner_level(text: str) -> Optional[int]:
     """Parse toner level from response text."""
-    matches = re.findall(r"_pp\.Renaming\.push\(parseInt\('(\d+)',\s*10\)\);", text)
-    return int(matches[0]) if matches else None
-
-async def parse_counter_data(text: str, patterns: Dict[str, str]) -> Dict[str, Optional[int]]:
-    """Parse counter data using given patterns."""
-    return {key: (int(match.group(1)) if (match := re.search(pattern, text)) else None) for key, pattern in patterns.items()}
-
-async def fetch_printer_details(client: httpx.AsyncClient, name: str, ip: Optional[str], semaphore: asyncio.Semaphore) -> Dict[str, Any]:
-    """Fetch all details for a single printer."""
-    async with semaphore:
-        if not ip:
-            return {'Name': name, 'IP': None, 'Hostname': "N/A", 'Serial': None, 'Mac': None, 'Toner': None, 'Print_Data': None, 'Scan_Data': None, 'Status': "Offline"}
-        
-        info = {'Name': name, 'IP': ip, 'Hostname': None, 'Serial': None, 'Mac': None, 'Toner': None, 'Print_Data': None, 'Scan_Data': None, 'Status': "Offline"}
+    levels = [int(value) for value in pp_list(parse_pp_assignments(text, ("Renaming",)), "Renaming") if value.isdigit()]
+    return levels[0] if levels else None
+
+async def parse_counter_data(text: str, fields: Dict[str, str]) -> Dict[str, Optional[int]]:
+    """Parse counter data for the given {key: _pp field name} mapping."""
+    assignments = parse_pp_assignments(text, fields.values())
+    return {key: pp_int(assignments, field) for key, field in fields.items()}
+
+async def apply_config_endpoint(info: Dict[str, Any], text: str) -> None:
+    """Merge hostname, serial and MAC into the printer result."""
+    parsed_info = await parse_printer_info(text)
+    info.update({'Hostname': parsed_info['hostname'], 'Serial': parsed_info['serial'], 'Mac': parsed_info['mac']})
+
+async def apply_toner_endpoint(info: Dict[str, Any], text: str) -> None:
+    """Merge the toner level into the printer result."""
+    info['Toner'] = await parse_toner_level(text)
+
+async def apply_print_counter_endpoint(info: Dict[str, Any], text: str) -> None:
+    """Merge the print counters into the printer result."""
+    info['Print_Data'] = await parse_counter_data(text, PRINT_COUNTER_FIELDS)
+
+async def apply_scan_counter_endpoint(info: Dict[str, Any], text: str) -> None:
+    """Merge the scan counters into the printer result."""
+    info['Scan_Data'] = await parse_counter_data(text, SCAN_COUNTER_FIELDS)
+
+# Endpoint plan for one printer: every entry is fetched independently and
+# merged into the same result dict by its "apply" coroutine. "fields" are the
+# result keys left missing when the endpoint fails.
+PRINTER_ENDPOINTS: List[Dict[str, Any]] = [
+    {
+        "name": "config",
+        "fields": ["Hostname", "Serial", "Mac"],
+        "path": "/js/jssrc/model/dvcinfo/dvcconfig/DvcConfig_Config.model.htm?arg1=0",
+        "referer": "/dvcinfo/dvcconfig/DvcConfig_Config.htm?arg1=0",
+        "apply": apply_config_endpoint,
+    },
+    {
+        "name": "toner",
+        "fields": ["Toner"],
+        "path": "/js/jssrc/model/startwlm/Hme_Toner.model.htm",
+        "referer": "/startwlm/Hme_Toner.htm",
+        "apply": apply_toner_endpoint,
+    },
+    {
+        "name": "print_counter",
+        "fields": ["Print_Data"],
+        "path": "/js/jssrc/model/dvcinfo/dvccounter/DvcInfo_Counter_PrnCounter.model.htm",
+        "referer": "/dvcinfo/dvccounter/DvcInfo_Counter_PrnCounter.htm",
+        "apply": apply_print_counter_endpoint,
+    },
+    {
+        "name": "scan_counter",
+        "fields": ["Scan_Data"],
+        "path": "/js/jssrc/model/dvcinfo/dvccounter/DvcInfo_Counter_ScanCounter.model.htm",
+        "referer": "/dvcinfo/dvccounter/DvcInfo_Counter_ScanCounter.htm",
+        "apply": apply_scan_counter_endpoint,
+    },
+]
+
+def is_retryable(exc: Exception) -> bool:
+    """Return True for failures worth another attempt (network errors, timeouts, 5xx)."""
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code >= 500
+    return isinstance(exc, httpx.TransportError)
+
+def failure_kind(exc: Exception) -> str:
+    """Classify an endpoint failure as timeout, http, connection or parse."""
+    if isinstance(exc, httpx.TimeoutException):
+        return "timeout"
+    if isinstance(exc, httpx.HTTPStatusError):
+        return "http"
+    if isinstance(exc, httpx.TransportError):
+        return "connection"
+    return "parse"
+
+def describe_failure(exc: Exception) -> str:
+    """Short reason recorded in the result for a field that could not be read."""
+    kind = failure_kind(exc)
+    if kind == "http":
+        return f"http {exc.response.status_code}"
+    if kind == "connection":
+        return "connection error"
+    if kind == "parse":
+        return f"parse error: {type(exc).__name__}"
+    return kind
+
+async def fetch_endpoint_plan(client: httpx.AsyncClient, ip: str, plan: List[Dict[str, Any]], info: Dict[str, Any], max_per_host: int, retries: int = 0, retry_backoff: float = 0.5, request_seconds: Optional[Dict[str, float]] = None) -> Dict[str, Optional[Exception]]:
+    """
+    Fetch every endpoint of the plan concurrently and merge each one into info.
+
+    At most max_per_host requests are in flight against the printer at a time.
+    A failed endpoint is retried on its own, up to retries times, after a jittered
+    exponential backoff; parse failures and 4xx responses are not retried.
+    Returns the exception raised by each endpoint (None on success), keyed by name.
+    If request_seconds is given, the time each endpoint spent in requests (all
+    attempts, without the backoff sleeps) is stored in it by name.
+    """
+    host_semaphore = asyncio.Semaphore(max_per_host)
+
+    async def run(endpoint: Dict[str, Any]) -> None:
+        headers = {"Referer": f"https://{ip}{endpoint['referer']}", "Cookie": "rtl=0; css=1"}
+        for attempt in range(retries + 1):
+            try:
+                async with host_semaphore:
+                    requested = time.perf_counter()
+                    try:
+                        with metrics.timer("kyoscan_endpoint_latency_seconds", endpoint=endpoint['name']):
+                            text = await fetch_printer_data(client, ip, endpoint['path'], headers)
+                    finally:
+                        if request_seconds is not None:
+                            request_seconds[endpoint['name']] = request_seconds.get(endpoint['name'], 0.0) + time.perf_counter() - requested
+                break
+            except Exception as e:
+                metrics.inc("kyoscan_endpoint_errors_total", endpoint=endpoint['name'], kind=failure_kind(e))
+                if attempt == retries or not is_retryable(e):
+                    raise
+            # Full jitter keeps retries from hitting the device in lockstep
+            metrics.inc("kyoscan_endpoint_retries_total", endpoint=endpoint['name'])
+            await asyncio.sleep(random.uniform(0, retry_backoff * 2 ** attempt))
         
         try:
-            # Fetch basic info
-            headers = {"Referer": f"https://{ip}/dvcinfo/dvcconfig/DvcConfig_Config.htm?arg1=0", "Cookie": "rtl=0; css=1"}
-            text = await fetch_printer_data(client, ip, "/js/jssrc/model/dvcinfo/dvcconfig/DvcConfig_Config.model.htm?arg1=0", headers)
-            parsed_info = await parse_printer_info(text)
-            info.update({'Hostname': parsed_info['hostname'], 'Serial': parsed_info['serial'], 'Mac': parsed_info['mac'], 'Status': "Online"})
-            
-            # Fetch toner
-            headers = {"Referer": f"https://{ip}/startwlm/Hme_Toner.htm", "Cookie": "rtl=0; css=1"}
-            text = await fetch_printer_data(client, ip, "/js/jssrc/model/startwlm/Hme_Toner.model.htm", headers)
-            info['Toner'] = await parse_toner_level(text)
-            
-            # Fetch print data
-            headers = {"Referer": f"https://{ip}/dvcinfo/dvccounter/DvcInfo_Counter_PrnCounter.htm", "Cookie": "rtl=0; css=1"}
-            text = await fetch_printer_data(client, ip, "/js/jssrc/model/dvcinfo/dvccounter/DvcInfo_Counter_PrnCounter.model.htm", headers)
-            patterns = {
-                "copy_bw": r"_pp\.copyBlackWhite\s*=\s*\('(\d+)'\)\.toString\(\);",
-                "printer_bw": r"_pp\.printerBlackWhite\s*=\s*\('(\d+)'\)\.toString\(\);",
-                "fax_bw": r"_pp\.faxBlackWhite\s*=\s*\('(\d+)'\)\.toString\(\);"
-            }
-            info['Print_Data'] = await parse_counter_data(text, patterns)
-            
-            # Fetch scan data
-            headers = {"Referer": f"https://{ip}/dvcinfo/dvccounter/DvcInfo_Counter_ScanCounter.htm", "Cookie": "rtl=0; css=1"}
-            text = await fetch_printer_data(client, ip, "/js/jssrc/model/dvcinfo/dvccounter/DvcInfo_Counter_ScanCounter.model.htm", headers)
-            patterns = {
-                "scan_copy": r"_pp\.scanCopy\s*=\s*parseInt\('(\d+)',\s*10\);",
-                "scan_bw": r"_pp\.scanBlackWhite\s*=\s*parseInt\('(\d+)',\s*10\);",
-                "scan_other": r"_pp\.scanOther\s*=\s*parseInt\('(\d+)',\s*10\);"
-            }
-            info['Scan_Data'] = await parse_counter_data(text, patterns)
-            
+            await endpoint['apply'](info, text)
         except Exception:
-            pass
+            metrics.inc("kyoscan_endpoint_errors_total", endpoint=endpoint['name'], kind="parse")
+            raise
+
+    outcomes = await asyncio.gather(*(run(endpoint) for endpoint in plan), return_exceptions=True)
+    return {endpoint['name']: outcome for endpoint, outcome in zip(plan, outcomes)}
+
+async def probe_host(ip: str, port: int = 443, timeout: float = 0.5) -> bool:
+    """Check that a TCP connection to the printer can be opened within timeout."""
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return True
+
+class CircuitBreaker:
+    """
+    Per-IP liveness gate in front of the full scrape.
+
+    A host is first checked with a cheap TCP connect to probe_port. After
+    failure_threshold consecutive failures (failed probe or no endpoint reachable)
+    the host is skipped without any network traffic for cooldown seconds, then
+    probed again.
+    """
+
+    def __init__(self, probe_timeout: float = 0.5, probe_port: int = 443, probe_concurrency: int = 100,
+                 failure_threshold: int = 1, cooldown: float = 300.0):
+        self.probe_timeout = probe_timeout
+        self.probe_port = probe_port
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._probe_semaphore = asyncio.Semaphore(probe_concurrency)
+        self._failures: Dict[str, int] = {}
+        self._open_until: Dict[str, float] = {}
+
+    @classmethod
+    def from_config(cls) -> "CircuitBreaker":
+        """Create a breaker with the Config probe and cooldown settings."""
+        return cls(
+            probe_timeout=Config.PROBE_TIMEOUT,
+            probe_port=Config.PROBE_PORT,
+            probe_concurrency=Config.PROBE_CONCURRENCY,
+            failure_threshold=Config.BREAKER_FAILURE_THRESHOLD,
+            cooldown=Config.BREAKER_COOLDOWN
+        )
+
+    def is_open(self, ip: str) -> bool:
+        """Return True while the host is in its cooldown window."""
+        return self._open_until.get(ip, 0.0) > time.monotonic()
+
+    async def allow(self, ip: str) -> bool:
+        """Return True if the host should be scraped (probing it if enabled)."""
+        if self.is_open(ip):
+            return False
+        if self.probe_timeout <= 0:
+            return True
+        
+        async with self._probe_semaphore:
+            alive = await probe_host(ip, self.probe_port, self.probe_timeout)
         
+        if not alive:
+            self.record_failure(ip)
+        return alive
+
+    def record_success(self, ip: str):
+        """Close the circuit for a host that answered."""
+        self._failures.pop(ip, None)
+        self._open_until.pop(ip, None)
+
+    def record_failure(self, ip: str):
+        """Count a failure and open the circuit once the threshold is reached."""
+        failures = self._failures.get(ip, 0) + 1
+        self._failures[ip] = failures
+        if failures >= self.failure_threshold:
+            self._open_until[ip] = time.monotonic() + self.cooldown
+
+async def fetch_printer_details(client: httpx.AsyncClient, name: str, ip: Optional[str], semaphore: Union[asyncio.Semaphore, AdaptiveLimiter], max_per_host: int = 4, breaker: Optional[CircuitBreaker] = None) -> Dict[str, Any]:
+    """Fetch all details for a single printer (semaphore may be a fixed or an adaptive limiter)."""
+    if not ip:
+        metrics.inc("kyoscan_printers_skipped_total", reason="no_ip")
+        return {'Name': name, 'IP': None, 'Hostname': "N/A", 'Serial': None, 'Mac': None, 'Toner': None, 'Print_Data': None, 'Scan_Data': None, 'Status': "Offline"}
+    
+    info = {'Name': name, 'IP': ip, 'Hostname': None, 'Serial': None, 'Mac': None, 'Toner': None, 'Print_Data': None, 'Scan_Data': None, 'Status': "Offline", 'Missing': {}}
+    
+    # Known-dead and unreachable hosts are reported Offline without taking a scrape slot
+    if breaker and not await breaker.allow(ip):
+        info['Missing'] = {field: "unreachable" for endpoint in PRINTER_ENDPOINTS for field in endpoint['fields']}
+        metrics.inc("kyoscan_printers_skipped_total", reason="unreachable")
         return info
+    
+    adaptive = isinstance(semaphore, AdaptiveLimiter)
+    queued = time.perf_counter()
+    async with (semaphore.slot(ip) if adaptive else semaphore):
+        started = time.perf_counter()
+        metrics.observe("kyoscan_scrape_queue_wait_seconds", started - queued)
+        request_seconds: Dict[str, float] = {}
+        outcomes = await fetch_endpoint_plan(client, ip, PRINTER_ENDPOINTS, info, max_per_host, Config.ENDPOINT_RETRIES, Config.RETRY_BACKOFF, request_seconds)
+        metrics.observe("kyoscan_printer_scrape_seconds", time.perf_counter() - started)
+    
+    # Fields of failed endpoints are reported missing so the database keeps their last-known values
+    for endpoint in PRINTER_ENDPOINTS:
+        outcome = outcomes[endpoint['name']]
+        if outcome is not None:
+            info['Missing'].update({field: describe_failure(outcome) for field in endpoint['fields']})
+    
+    if any(outcome is None for outcome in outcomes.values()):
+        info['Status'] = "Online"
+    metrics.inc("kyoscan_printers_scraped_total", status=info['Status'])
+    
+    if breaker:
+        if all(isinstance(outcome, httpx.TransportError) for outcome in outcomes.values()):
+            breaker.record_failure(ip)
+        else:
+            breaker.record_success(ip)
+    
+    # The limiter gets the slowest endpoint's request time, without retry backoff sleeps. A host
+    # the breaker now takes for dead timed out because it is down, not because the subnet is congested
+    if adaptive and not (breaker and breaker.is_open(ip)):
+        congested = any(isinstance(outcome, httpx.TimeoutException) for outcome in outcomes.values())
+        await semaphore.record(ip, max(request_seconds.values(), default=0.0), congested)
+    
+    return info
 
-async def get_all_printers_data_async(printer_dict: Dict[str, Optional[str]], max_concurrent: int = 20) -> List[Dict[str, Any]]:
-    """Fetch data for all printers concurrently."""
+def create_client(max_concurrent: int = 20, max_per_host: int = 4, timeout: float = Config.REQUEST_TIMEOUT, transport: Optional[httpx.AsyncBaseTransport] = None) -> httpx.AsyncClient:
+    """Create the HTTP client shared by all printer requests (transport is for simulated fleets)."""
+    # Each printer slot may hold up to max_per_host connections at once
+    limits = httpx.Limits(max_keepalive_connections=max_concurrent * max_per_host, max_connections=max_concurrent * max_per_host)
+    return httpx.AsyncClient(verify=False, timeout=timeout, limits=limits, transport=transport)
+
+async def stream_printers_data_async(printer_dict: Dict[str, Optional[str]], max_concurrent: int = 20, max_per_host: int = 4, breaker: Optional[CircuitBreaker] = None, transport: Optional[httpx.AsyncBaseTransport] = None, limiter: Optional[AdaptiveLimiter] = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Fetch data for all printers concurrently, yielding each result as it completes.
+
+    Concurrency is fixed at max_concurrent unless an adaptive limiter is given
+    (or Config.ADAPTIVE_CONCURRENCY is set), in which case max_concurrent is its starting point.
+    """
     
-    semaphore = asyncio.Semaphore(max_concurrent)
-    limits = httpx.Limits(max_keepalive_connections=max_concurrent, max_connections=max_concurrent)
+    if limiter is None and Config.ADAPTIVE_CONCURRENCY:
+        limiter = AdaptiveLimiter.from_config()
+    semaphore = limiter or asyncio.Semaphore(max_concurrent)
+    breaker = breaker or CircuitBreaker.from_config()
+    pool_size = limiter.max_limit if limiter else max_concurrent
     
-    async with httpx.AsyncClient(verify=False, timeout=10.0, limits=limits) as client:
-        tasks = [fetch_printer_details(client, name, ip, semaphore) for name, ip in printer_dict.items()]
-        
-        results = []
+    async with create_client(pool_size, max_per_host, transport=transport) as client:
+        tasks = [fetch_printer_details(client, name, ip, semaphore, max_per_host, breaker) for name, ip in printer_dict.items()]
         total = len(tasks)
         
         # Progress marker: update every 10 printers
         for i, task in enumerate(asyncio.as_completed(tasks)):
             result = await task
-            results.append(result)
+            yield result
             if (i + 1) % 10 == 0 or (i + 1) == total:
                 print(f"Progress: {i + 1}/{total} printers processed.", end='\r')
-        
-        return results
+
+async def get_all_printers_data_async(printer_dict: Dict[str, Optional[str]], max_concurrent: int = 20, max_per_host: int = 4, breaker: Optional[CircuitBreaker] = None, transport: Optional[httpx.AsyncBaseTransport] = None, limiter: Optional[AdaptiveLimiter] = None) -> List[Dict[str, Any]]:
+    """Fetch data for all printers concurrently."""
+    return [result async for result in stream_printers_data_async(printer_dict, max_concurrent, max_per_host, breaker, transport, limiter)]
 
 async def main() -> None:
     """Main entry point."""
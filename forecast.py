@@ -0,0 +1,188 @@
+import io
+from datetime import datetime, timedelta, timezone
+from typing import Dict
+import numpy as np
+import psycopg2.extras
+from config import Config
+
+SECONDS_PER_DAY = 86400.0
+
+# Latest toner reading and page counter of each device and day, streamed with a binary COPY.
+# The daily rollup has one row per device and day, so a year of a 10k fleet is a few million rows;
+# a sequential scan and a sort in NumPy beat an ordered index scan by far
+SELECT_TONER_HISTORY = """
+    COPY (
+        SELECT device_id,
+               date_part('epoch', last_at),
+               toner_level_last::float8,
+               COALESCE((printer_copy_bw_last::bigint + printer_printer_bw_last + printer_fax_bw_last)::float8, 'NaN')
+        FROM device_logs_daily
+        WHERE bucket >= %s AND toner_level_last IS NOT NULL
+    ) TO STDOUT (FORMAT binary)
+"""
+
+# One row of that COPY: field count, then the size and value of each field (none is NULL).
+# The data starts after the signature, flags and header extension length, and ends with -1
+COPY_ROW = np.dtype([
+    ("fields", ">i2"),
+    ("device_id_size", ">i4"), ("device_id", ">i4"),
+    ("at_size", ">i4"), ("at", ">f8"),
+    ("toner_size", ">i4"), ("toner", ">f8"),
+    ("pages_size", ">i4"), ("pages", ">f8"),
+])
+COPY_HEADER_SIZE = 19
+COPY_TRAILER_SIZE = 2
+
+# NaN (no estimate) is stored as NULL
+UPSERT_FORECAST = """
+    INSERT INTO device_toner_forecast (
+        device_id, computed_at, samples, toner_level,
+        depletion_per_day, days_to_empty, empty_at, pages_per_percent
+    )
+    SELECT v.device_id, v.computed_at, v.samples, v.toner_level,
+           NULLIF(v.depletion_per_day, 'NaN'), NULLIF(v.days_to_empty, 'NaN'),
+           v.computed_at + NULLIF(v.days_to_empty, 'NaN') * INTERVAL '1 day',
+           NULLIF(v.pages_per_percent, 'NaN')
+    FROM (VALUES %s) v(device_id, computed_at, samples, toner_level, depletion_per_day, days_to_empty, pages_per_percent)
+    ON CONFLICT (device_id) DO UPDATE SET
+        computed_at = EXCLUDED.computed_at,
+        samples = EXCLUDED.samples,
+        toner_level = EXCLUDED.toner_level,
+        depletion_per_day = EXCLUDED.depletion_per_day,
+        days_to_empty = EXCLUDED.days_to_empty,
+        empty_at = EXCLUDED.empty_at,
+        pages_per_percent = EXCLUDED.pages_per_percent
+"""
+
+FORECAST_VALUES_TEMPLATE = "(%s, %s::timestamp, %s::integer, %s::smallint, %s::float8, %s::float8, %s::float8)"
+
+# Devices without a reading in the window keep no stale forecast
+DELETE_STALE_FORECASTS = "DELETE FROM device_toner_forecast WHERE computed_at < %s"
+
+class TonerForecaster:
+    """
+    Fleet-wide toner depletion forecast.
+
+    Streams the daily rollup of device_logs for the whole fleet with one binary
+    COPY, read straight into NumPy arrays, and fits a least-squares line to the
+    toner level of every device at once: per-device sums are accumulated with
+    np.bincount, so the work is a handful of array operations whatever the fleet
+    size. Only the readings
+    since the last cartridge change (a rise of at least refill_jump percent) are
+    fitted. The page counters give the pages printed per percent of toner.
+    """
+
+    def __init__(self, window_days: int = 365, min_samples: int = 3, refill_jump: float = 10.0):
+        self.window_days = window_days
+        self.min_samples = min_samples
+        self.refill_jump = refill_jump
+
+    @classmethod
+    def from_config(cls) -> "TonerForecaster":
+        """Create a forecaster with the Config forecast settings."""
+        return cls(Config.FORECAST_WINDOW_DAYS, Config.FORECAST_MIN_SAMPLES, Config.FORECAST_REFILL_JUMP)
+
+    def load(self, conn, now: datetime) -> np.ndarray:
+        """
+        Stream the toner history of the window into one array.
+
+        :param conn: psycopg2 connection, in the transaction that stores the forecast
+        :param now: End of the window
+        :return: Array of rows (device_id, epoch seconds, toner level, pages), sorted by device and time
+        """
+
+        data = io.BytesIO()
+        with conn.cursor() as cursor:
+            query = cursor.mogrify(SELECT_TONER_HISTORY, (now - timedelta(days=self.window_days),)).decode()
+            cursor.copy_expert(query, data)
+
+        buffer = data.getbuffer()
+        extension = int.from_bytes(buffer[15:COPY_HEADER_SIZE], "big")
+        start = COPY_HEADER_SIZE + extension
+        rows = np.frombuffer(buffer, COPY_ROW, (len(buffer) - start - COPY_TRAILER_SIZE) // COPY_ROW.itemsize, start)
+        if len(rows) and (rows["fields"] != 4).any():
+            raise ValueError("Unexpected row layout in the toner history COPY")
+
+        history = np.column_stack([rows["device_id"], rows["at"], rows["toner"], rows["pages"]]).astype(np.float64)
+        del rows, buffer
+        return history[np.lexsort((history[:, 1], history[:, 0]))]
+
+    def fit(self, history: np.ndarray, now: datetime) -> Dict[str, np.ndarray]:
+        """
+        Fit the depletion rate of every device in the history.
+
+        :param history: Rows as returned by load
+        :param now: Time the days to empty are counted from
+        :return: Arrays indexed by device: device_id, samples, toner_level (latest reading),
+                 depletion_per_day, days_to_empty and pages_per_percent (NaN without an estimate)
+        """
+
+        if not len(history):
+            return {key: np.empty(0) for key in
+                    ("device_id", "samples", "toner_level", "depletion_per_day", "days_to_empty", "pages_per_percent")}
+
+        device_ids, days, levels, pages = history[:, 0], history[:, 1] / SECONDS_PER_DAY, history[:, 2], history[:, 3]
+
+        # Split each device's readings at refills and keep the last segment
+        first = np.ones(len(history), dtype=bool)
+        first[1:] = device_ids[1:] != device_ids[:-1]
+        refill = np.zeros(len(history), dtype=bool)
+        refill[1:] = ~first[1:] & (levels[1:] - levels[:-1] >= self.refill_jump)
+        device = np.cumsum(first) - 1
+        segment = np.cumsum(first | refill)
+        last = np.append(first[1:], True)
+        keep = segment == segment[last][device]
+
+        device, days, levels, pages = device[keep], days[keep], levels[keep], pages[keep]
+        starts = np.flatnonzero(np.append(True, device[1:] != device[:-1]))
+        ends = np.append(starts[1:], len(device)) - 1
+        count = len(starts)
+
+        # Least squares per device, with time relative to the latest reading
+        x = days - days[ends][device]
+        n = np.bincount(device, minlength=count).astype(np.float64)
+        sx = np.bincount(device, x, count)
+        sy = np.bincount(device, levels, count)
+        sxx = np.bincount(device, x * x, count)
+        sxy = np.bincount(device, x * levels, count)
+        denominator = n * sxx - sx * sx
+        with np.errstate(divide="ignore", invalid="ignore"):
+            slope = np.where(denominator > 0, (n * sxy - sx * sy) / denominator, np.nan)
+        depletion = np.where((n >= self.min_samples) & (slope < 0), -slope, np.nan)
+
+        # Latest reading, less what was used since it was taken
+        toner_level = levels[ends]
+        # date_part('epoch') reads the naive timestamps as UTC
+        elapsed = now.replace(tzinfo=timezone.utc).timestamp() / SECONDS_PER_DAY - days[ends]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            days_to_empty = np.maximum(toner_level / depletion - elapsed, 0.0)
+
+            used = levels[starts] - toner_level
+            printed = np.fmax.reduceat(pages, starts) - np.fmin.reduceat(pages, starts)
+            pages_per_percent = np.where((used > 0) & (printed > 0), printed / used, np.nan)
+
+        return {
+            "device_id": device_ids[first].astype(np.int64),
+            "samples": n.astype(np.int64),
+            "toner_level": toner_level.astype(np.int64),
+            "depletion_per_day": depletion,
+            "days_to_empty": days_to_empty,
+            "pages_per_percent": pages_per_percent,
+        }
+
+    def store(self, cursor, forecast: Dict[str, np.ndarray], now: datetime) -> int:
+        """
+        Write the forecast to device_toner_forecast, replacing the previous one.
+
+        :param cursor: Database cursor
+        :param forecast: Arrays as returned by fit
+        :param now: Time the forecast was computed
+        :return: Number of devices forecast
+        """
+
+        rows = zip(forecast["device_id"].tolist(), [now] * len(forecast["device_id"]), forecast["samples"].tolist(),
+                   forecast["toner_level"].tolist(), forecast["depletion_per_day"].tolist(),
+                   forecast["days_to_empty"].tolist(), forecast["pages_per_percent"].tolist())
+        psycopg2.extras.execute_values(cursor, UPSERT_FORECAST, rows, template=FORECAST_VALUES_TEMPLATE, page_size=1000)
+        cursor.execute(DELETE_STALE_FORECASTS, (now,))
+        return len(forecast["device_id"])
@@ -0,0 +1,124 @@
+import asyncio
+import ipaddress
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from config import Config
+from metrics import get_registry
+
+metrics = get_registry()
+
+def parse_subnet_budgets(spec: str) -> List[Tuple[ipaddress.IPv4Network, int]]:
+    """
+    Parse "10.5.0.0/16=4,10.9.1.0/24=2" into (network, budget) pairs.
+
+    :param spec: Comma-separated network=budget pairs (empty for none)
+    :return: Pairs ordered from the most to the least specific network
+    """
+    budgets = []
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        network, budget = item.split('=')
+        budgets.append((ipaddress.ip_network(network.strip(), strict=False), int(budget)))
+    return sorted(budgets, key=lambda pair: pair[0].prefixlen, reverse=True)
+
+class _Window:
+    """AIMD congestion window for one subnet."""
+
+    def __init__(self, limit: float, ceiling: int):
+        self.limit = limit
+        self.ceiling = ceiling
+        self.in_flight = 0
+        self.baseline: Optional[float] = None
+        self.last_decrease = 0.0
+        self.condition = asyncio.Condition()
+
+class AdaptiveLimiter:
+    """
+    Additive-increase/multiplicative-decrease concurrency limiter.
+
+    Printers are grouped by subnet (subnet_prefix bits, 0 for one global group) and
+    every group gets its own window. A window grows by about one slot per window of
+    healthy completions and is cut by backoff on a timeout or when latency exceeds
+    latency_tolerance times its running baseline. max_limit caps the total in flight.
+    """
+
+    def __init__(self, initial_limit: int = 10, min_limit: int = 2, max_limit: int = 100, subnet_prefix: int = 24,
+                 subnet_budgets: Optional[List[Tuple[ipaddress.IPv4Network, int]]] = None,
+                 latency_tolerance: float = 2.0, backoff: float = 0.5):
+        self.initial_limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.subnet_prefix = subnet_prefix
+        self.subnet_budgets = subnet_budgets or []
+        self.latency_tolerance = latency_tolerance
+        self.backoff = backoff
+        self._total = asyncio.Semaphore(max_limit)
+        self._windows: Dict[str, _Window] = {}
+
+    @classmethod
+    def from_config(cls) -> "AdaptiveLimiter":
+        """Create a limiter with the Config concurrency settings."""
+        return cls(
+            initial_limit=Config.MAX_CONCURRENT_REQUESTS,
+            min_limit=Config.CONCURRENCY_MIN,
+            max_limit=Config.CONCURRENCY_MAX,
+            subnet_prefix=Config.SUBNET_PREFIX,
+            subnet_budgets=parse_subnet_budgets(Config.SUBNET_BUDGETS)
+        )
+
+    def _window(self, ip: str) -> Tuple[str, _Window]:
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            address = None
+        subnet = "all"
+        if address is not None and self.subnet_prefix:
+            subnet = str(ipaddress.ip_network(f"{ip}/{self.subnet_prefix}", strict=False))
+        
+        window = self._windows.get(subnet)
+        if window is None:
+            ceiling = next((budget for network, budget in self.subnet_budgets if address in network), self.max_limit) if address else self.max_limit
+            window = self._windows[subnet] = _Window(min(max(self.initial_limit, self.min_limit), ceiling), ceiling)
+        return subnet, window
+
+    @asynccontextmanager
+    async def slot(self, ip: str) -> AsyncIterator[None]:
+        """Hold one scrape slot in the printer's subnet window (and the global cap)."""
+        _, window = self._window(ip)
+        async with window.condition:
+            await window.condition.wait_for(lambda: window.in_flight < int(window.limit))
+            window.in_flight += 1
+        try:
+            async with self._total:
+                yield
+        finally:
+            async with window.condition:
+                window.in_flight -= 1
+                window.condition.notify()
+
+    async def record(self, ip: str, latency: float, congested: bool):
+        """
+        Feed one scrape outcome back into the printer's subnet window.
+
+        :param ip: Printer IP
+        :param latency: Scrape duration in seconds
+        :param congested: True if any request timed out
+        """
+        subnet, window = self._window(ip)
+        spike = window.baseline is not None and latency > window.baseline * self.latency_tolerance
+        now = time.monotonic()
+
+        async with window.condition:
+            if congested or spike:
+                # One cut per round trip, so a burst of timeouts doesn't collapse the window
+                if now - window.last_decrease > (window.baseline or latency):
+                    window.limit = max(self.min_limit, window.limit * self.backoff)
+                    window.last_decrease = now
+            else:
+                window.baseline = latency if window.baseline is None else 0.9 * window.baseline + 0.1 * latency
+                previous = int(window.limit)
+                window.limit = min(window.ceiling, window.limit + 1 / window.limit)
+                if int(window.limit) > previous:
+                    window.condition.notify(int(window.limit) - previous)
+
+        metrics.set_gauge("kyoscan_concurrency_limit", int(window.limit), subnet=subnet)
@@ -1,13 +1,15 @@
 from config import Config
-from database import Database
 from fetcher import get_printers_from_server, get_all_printers_data_async
 from logger import get_logger
+from pipeline import run_streaming_pipeline, open_database, save_batch, apply_retention, refresh_usage, refresh_forecast, export_history, ship_upstream
+from daemon import run_daemon
+from spool import get_spool
+from metrics import serve_metrics, dump_metrics, dump_metrics_periodically
 import asyncio
 
-async def main() -> None:
-    """Main entry point."""
+async def run_pipeline() -> None:
+    """Discover printers, scrape them and save the results in the configured mode."""
     logger = get_logger()
-    logger.info("Starting Kyoscan data pipeline.")
    
     ### Fetch printers from print server
     printers = get_printers_from_server(Config.PRINT_SERVER_IP)
@@ -16,17 +18,91 @@ async def main() -> None:
         logger.error("No printers found or connection error to printer server occurred.")
         return
     
-    ### Fetch printer metrics asynchronously
-    all_data = await get_all_printers_data_async(
-        printers, 
-        max_concurrent=Config.MAX_CONCURRENT_REQUESTS
-    )
+    if Config.PIPELINE_MODE == "daemon":
+        ### Keep polling each printer on its own schedule until stopped
+        await run_daemon(printers)
+        return
+    
+    if Config.PIPELINE_MODE == "stream":
+        ### Fetch printer metrics and save them as they complete
+        async with open_database() as db:
+            saved = await run_streaming_pipeline(
+                printers,
+                db,
+                max_concurrent=Config.MAX_CONCURRENT_REQUESTS,
+                max_per_host=Config.MAX_REQUESTS_PER_HOST,
+                queue_size=Config.PIPELINE_QUEUE_SIZE,
+                batch_size=Config.PIPELINE_BATCH_SIZE,
+                flush_seconds=Config.PIPELINE_FLUSH_SECONDS
+            )
+        logger.info(f"Kyoscan streaming pipeline completed, {saved} printers saved.")
+    else:
+        ### Fetch printer metrics asynchronously
+        all_data = await get_all_printers_data_async(
+            printers, 
+            max_concurrent=Config.MAX_CONCURRENT_REQUESTS,
+            max_per_host=Config.MAX_REQUESTS_PER_HOST
+        )
+        
+        ### Save results to database
+        async with open_database() as db:
+            await save_batch(db, all_data)
+        
+        logger.info("Kyoscan data pipeline completed.")
+    
+    ### Nothing more to do while the database is unavailable: the spooled batches are saved next run
+    spool = get_spool()
+    if spool is not None and spool.pending():
+        logger.warning("Batches are spooled, skipping the usage, forecast, export and retention steps.")
+        return
+
+    ### Ship what an edge collector saved locally, update the usage summary and toner forecast
+    ### and export new history, then drop partitions and rollups past their retention
+    if Config.SHIP_UPSTREAM and Config.DB_BACKEND == "sqlite":
+        try:
+            shipped = await ship_upstream()
+            logger.info(f"Shipped to the central database: {shipped}")
+        except Exception as e:
+            logger.error(f"Shipping to the central database failed: {e}")
+    try:
+        await refresh_usage()
+    except Exception as e:
+        logger.error(f"Usage refresh failed: {e}")
+    try:
+        await refresh_forecast()
+    except Exception as e:
+        logger.error(f"Forecast refresh failed: {e}")
+    if Config.EXPORT_DIR:
+        try:
+            await export_history()
+        except Exception as e:
+            logger.error(f"History export failed: {e}")
+    try:
+        dropped = await apply_retention()
+        if dropped:
+            logger.info(f"Dropped expired partitions: {', '.join(dropped)}")
+    except Exception as e:
+        logger.error(f"Retention failed: {e}")
+
+async def main() -> None:
+    """Main entry point."""
+    logger = get_logger()
+    logger.info("Starting Kyoscan data pipeline.")
     
-    ### Save results to database
-    with Database(Config()) as db:
-        db.save_printer_data(all_data)
+    ### Expose pipeline metrics while running
+    metrics_server = await serve_metrics(Config.METRICS_PORT) if Config.METRICS_PORT else None
+    metrics_dump = None
+    if Config.METRICS_JSON_PATH:
+        metrics_dump = asyncio.create_task(dump_metrics_periodically(Config.METRICS_JSON_PATH, Config.METRICS_DUMP_INTERVAL))
     
-    logger.info("Kyoscan data pipeline completed.")
+    try:
+        await run_pipeline()
+    finally:
+        if metrics_dump:
+            metrics_dump.cancel()
+            dump_metrics(Config.METRICS_JSON_PATH)
+        if metrics_server:
+            metrics_server.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
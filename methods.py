@@ -3,176 +3,105 @@
 # Pablo Nicolay
 # 2025
 
+import asyncio
+import json
+import math
+import os
+import sys
+import time
+import httpx
 import requests
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
 from urllib.parse import urlencode
-import re
 import warnings
 from urllib3.exceptions import InsecureRequestWarning
+from config import Config
+from model_parser import parse_pp_assignments, pp_list, pp_str
 
 # Suppress InsecureRequestWarning for clean output
 warnings.simplefilter('ignore', InsecureRequestWarning)
 
-def fetch_available_id(printer_ip, proxies=None):
-    """
-    Fetch and parse the first available contact ID from the printer's model.
-    """
-    model_url = (
-        f"https://{printer_ip}/js/jssrc/model/basic/AddrBook_Addr_NewCntct_Prpty.model.htm"
-        f"?arg1=1&arg2=0&arg3=&arg4=0&arg5=&arg6=1&arg50=0"
-    )
-    
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+# _pp fields read from the address book list and contact detail models
+ADDRESS_BOOK_LIST_FIELDS = ('TotsearchResult', 'h_getAbpListCount', 'AddrNumber', 'AddrType')
+ADDRESS_BOOK_DETAIL_FIELDS = ('number', 'nameAdbk', 'smbHostName')
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+
+def model_headers(printer_ip, referer):
+    """Headers of a model.htm request, as sent by the page at referer."""
+    return {
+        'User-Agent': USER_AGENT,
         'Accept': '*/*',
-        'Referer': f'https://{printer_ip}/basic/AddrBook_Addr_NewCntct_Prpty.htm?arg1=1&arg2=0&arg3=&arg4=0&arg5=&arg6=1&arg50=0',
+        'Referer': f'https://{printer_ip}{referer}',
         'Cookie': 'rtl=0'
     }
-    
-    try:
-        response = requests.get(model_url, headers=headers, proxies=proxies, verify=False, timeout=10)
-        if response.status_code != 200:
-            return None
-        
-        # Extract emptyMemoryId with regex (lightweight, no full JS eval)
-        match = re.search(r"_pp\.emptyMemoryId\s*=\s*'([^']+)';", response.text)
-        if not match:
-            return None
-        
-        # Split and return first available ID
-        ids = [id.strip() for id in match.group(1).split('/') if id.strip()]
-        return ids[0] if ids else None
-        
-    except (requests.RequestException, IndexError):
-        return None
 
-def fetch_address_book_page(printer_ip, page=1, proxies=None):
-    """
-    Fetch a page of the address book entries.
-    Returns (total_entries: int, page_entries: list of {'id': str, 'name': str})
-    """
-    list_url = (
-        f"https://{printer_ip}/js/jssrc/model/basic/AddrBook_Addr.model.htm"
-        f"?arg1={page}&arg2=0&arg3=&arg4=1&arg5=&arg6=0&arg7=0&arg8=&arg9=&arg50=0"
-    )
-    
+def form_headers(printer_ip, referer=None):
+    """Headers of a set.cgi form post."""
     headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-        'Accept': '*/*',
-        'Referer': f'https://{printer_ip}/basic/AddrBook_Addr.htm?arg1={page}&arg2=0&arg3=&arg4=1&arg5=&arg6=0&arg7=0&arg9=&arg50=0',
+        'Content-Type': 'application/x-www-form-urlencoded',
+        'User-Agent': USER_AGENT,
+        'Accept': 'text/html,application/xhtml+xml,*/*;q=0.9',
         'Cookie': 'rtl=0'
     }
+    if referer:
+        headers['Referer'] = f'https://{printer_ip}{referer}'
+    return headers
+
+def parse_available_id(text):
+    """First available contact ID (emptyMemoryId) of the new contact model, or None."""
+    # Extract emptyMemoryId (lightweight, no full JS eval)
+    empty_ids = pp_str(parse_pp_assignments(text, ('emptyMemoryId',)), 'emptyMemoryId', allow_empty=False)
+    if not empty_ids:
+        return None
     
-    try:
-        response = requests.get(list_url, headers=headers, proxies=proxies, verify=False, timeout=10)
-        if response.status_code != 200:
-            return 0, []
-        
-        # Extract total
-        match_total = re.search(r"_pp\.TotsearchResult\s*=\s*'([^']+)';", response.text)
-        total = int(match_total.group(1)) if match_total else 0
-        
-        # Extract list count
-        match_listcount = re.search(r"_pp\.h_getAbpListCount\s*=\s*'([^']+)';", response.text)
-        list_count = int(match_listcount.group(1)) if match_listcount else 0
-        
-        # Extract IDs and names using findall (order preserved)
-        ids = re.findall(r"_pp\.AddrNumber\s*\[index\]\s*=\s*'([^']+)';", response.text)
-        names_raw = re.findall(r"_pp\.AddrType\s*\[index\]\s*=\s*'([^']+)';", response.text)
-        
-        entries = []
-        for idx in range(min(len(ids), len(names_raw))):
-            entry_id = ids[idx]
-            entry_name = names_raw[idx]  # Original name before any replacement
-            entries.append({'id': entry_id, 'name': entry_name})
-        
-        return total, entries
-        
-    except (requests.RequestException, ValueError, IndexError):
-        return 0, []
+    # Split and return first available ID
+    ids = [id.strip() for id in empty_ids.split('/') if id.strip()]
+    return ids[0] if ids else None
 
-def get_all_entries(printer_ip, proxies=None):
+def parse_address_book_page(text):
     """
-    Fetch all address book entries by paginating through pages.
-    Returns list of {'id': str, 'name': str}
+    Parse a page of the address book list model.
+    Returns (total_entries: int, page_entries: list of {'id': str, 'name': str})
     """
-    all_entries = []
-    page = 1
-    total = 0
+    assignments = parse_pp_assignments(text, ADDRESS_BOOK_LIST_FIELDS)
     
-    while True:
-        page_total, page_entries = fetch_address_book_page(printer_ip, page, proxies)
-        total = page_total  # Update total from first page
-        if not page_entries:
-            break
-        all_entries.extend(page_entries)
-        if len(all_entries) >= total:
-            break
-        page += 1
+    # Extract total
+    match_total = pp_str(assignments, 'TotsearchResult', allow_empty=False)
+    total = int(match_total) if match_total else 0
     
-    return all_entries[:total]  # Trim if overfetched
-
-def fetch_entry_detail(printer_ip, entry_id, proxies=None):
-    """
-    Fetch details for a specific entry ID.
-    Returns (success: bool, number: str, name: str, smb_host: str or None)
-    """
-    detail_url = (
-        f"https://{printer_ip}/js/jssrc/model/basic/AddrBook_Addr_NewCntct_Prpty.model.htm"
-        f"?arg1=1&arg2=0&arg3=&arg4=1&arg5={entry_id}&arg6=1&arg50=0"
-    )
+    # Extract IDs and names (order preserved)
+    ids = [value for value in pp_list(assignments, 'AddrNumber') if value]
+    names_raw = [value for value in pp_list(assignments, 'AddrType') if value]
     
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-        'Accept': '*/*',
-        'Referer': f'https://{printer_ip}/basic/AddrBook_Addr_NewCntct_Prpty.htm?arg1=1&arg2=0&arg3=&arg4=1&arg5={entry_id}&arg6=1&arg50=0',
-        'Cookie': 'rtl=0'
-    }
+    entries = []
+    for idx in range(min(len(ids), len(names_raw))):
+        entry_id = ids[idx]
+        entry_name = names_raw[idx]  # Original name before any replacement
+        entries.append({'id': entry_id, 'name': entry_name})
     
-    try:
-        response = requests.get(detail_url, headers=headers, proxies=proxies, verify=False, timeout=10)
-        if response.status_code != 200:
-            return False, None, None, None
-        
-        match_number = re.search(r"_pp\.number\s*=\s*'([^']+)';", response.text)
-        number = match_number.group(1) if match_number else None
-        
-        match_name = re.search(r"_pp\.nameAdbk\s*=\s*'([^']*)';", response.text)
-        name = match_name.group(1) if match_name else None
-        
-        match_smb = re.search(r"_pp\.smbHostName\s*=\s*'([^']*)';", response.text)
-        smb_host = match_smb.group(1).strip() if match_smb else None
-        
-        if number and name:  # Valid entry
-            return True, number, name, smb_host
-        return False, None, None, None
-        
-    except requests.RequestException:
-        return False, None, None, None
+    return total, entries
 
-def check_duplicates(printer_ip, target_smb_ip, proxies=None):
+def parse_entry_detail(text):
     """
-    Check for duplicate SMB entries matching the target IP.
-    Returns list of {'id': str, 'name': str} for duplicates.
+    Parse the contact detail model.
+    Returns (success: bool, number: str, name: str, smb_host: str or None)
     """
-    entries = get_all_entries(printer_ip, proxies)
-    duplicates = []
+    assignments = parse_pp_assignments(text, ADDRESS_BOOK_DETAIL_FIELDS)
+    number = pp_str(assignments, 'number', allow_empty=False)
+    name = pp_str(assignments, 'nameAdbk')
     
-    for entry in entries:
-        success, number, name, smb_host = fetch_entry_detail(printer_ip, entry['id'], proxies)
-        if success and smb_host and smb_host == target_smb_ip:
-            duplicates.append({'id': number, 'name': name})
+    smb_host = pp_str(assignments, 'smbHostName')
+    smb_host = smb_host.strip() if smb_host is not None else None
     
-    return duplicates
+    if number and name:  # Valid entry
+        return True, number, name, smb_host
+    return False, None, None, None
 
-def delete_entry(printer_ip, entry_id, proxies=None):
-    """
-    Delete a specified entry from the printer's address book.
-    Returns (success: bool, message: str, response_text: str or None)
-    """
-    cgi_url = f"https://{printer_ip}/basic/set.cgi"
-    
-    # Form data for deletion
-    form_data = {
+def delete_form(entry_id):
+    """Form data of a deleteAbpPersonalGroup post for one entry."""
+    return {
         'okhtmfile': '/basic/Contact_BasicDelRslt.htm',
         'failhtmfile': '/basic/Contact_BasicErr.htm',
         'func': 'deleteAbpPersonalGroup',
@@ -195,106 +124,27 @@ def delete_entry(printer_ip, entry_id, proxies=None):
         'hidden': '',
         'arg16_ID': entry_id,
     }
-    
-    headers = {
-        'Content-Type': 'application/x-www-form-urlencoded',
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-        'Accept': 'text/html,application/xhtml+xml,*/*;q=0.9',
-        'Cookie': 'rtl=0'
-    }
-    
-    try:
-        response = requests.post(
-            cgi_url, data=urlencode(form_data), headers=headers,
-            proxies=proxies, verify=False, timeout=10
-        )
-        
-        # Debug: Print status and response preview
-        print(f"Delete response for ID {entry_id}: Status {response.status_code}")
-        
-        # For delete, success if status 200 (no progress gif needed, as delete is immediate)
-        if response.status_code != 200:
-            return False, f"Delete failed HTTP {response.status_code}", response.text
-        
-        return True, f"Successfully deleted entry with ID: {entry_id}", response.text
-        
-    except requests.RequestException as e:
-        return False, f"Connection error: {str(e)}", None
 
-def cleanup_duplicates(printer_ip, target_smb_ip, proxies=None):
-    """
-    Retrieve duplicates for the target SMB IP, delete all except the one with the smallest ID,
-    and return the details of the kept entry.
-    Returns {'success': bool, 'kept_id': str or None, 'entry_name': str or None, 'smb_address': str or None, 'message': str}
-    """
-    # Retrieve duplicates
-    duplicates = check_duplicates(printer_ip, target_smb_ip, proxies)
-    if not duplicates:
-        return {
-            'success': False,
-            'kept_id': None,
-            'entry_name': None,
-            'smb_address': None,
-            'message': 'No duplicates found.'
-        }
-    
-    # Find the duplicate with the smallest ID (convert to int for comparison)
-    min_dup = min(duplicates, key=lambda x: int(x['id']))
-    min_id = min_dup['id']
-    
-    # Delete all other duplicates
-    deleted_count = 0
-    for dup in duplicates:
-        if dup['id'] != min_id:
-            success, msg, resp_text = delete_entry(printer_ip, dup['id'], proxies)
-            if success:
-                deleted_count += 1
-            else:
-                # Log error but continue
-                print(f"Failed to delete duplicate ID {dup['id']}: {msg}")
-                if resp_text:
-                    print(f"Response for failed delete: {resp_text[:200]}...")
-    
-    # Fetch details of the kept entry
-    success, number, name, smb_host = fetch_entry_detail(printer_ip, min_id, proxies)
-    if success and smb_host == target_smb_ip:
-        return {
-            'success': True,
-            'kept_id': number,
-            'entry_name': name,
-            'smb_address': smb_host,
-            'message': f'Cleaned up {len(duplicates) - 1} duplicates. Kept ID: {number}'
-        }
-    else:
-        return {
-            'success': False,
-            'kept_id': None,
-            'entry_name': None,
-            'smb_address': None,
-            'message': 'Failed to fetch details of kept entry after cleanup.'
-        }
+# Entries deleted by one deleteAbpPersonalGroup post: arg06_MemoryID to arg15_MemoryID
+DELETE_BATCH_SIZE = 10
 
-def add_smb_contact(printer_ip, smb_address, smb_password='scanner#oki', proxies=None, check_duplicates_first=True):
-    """
-    Add an SMB contact to the printer's address book.
-    Optionally checks for duplicates first.
-    Returns (success: bool, id: str or error: str, response_text: str or None, duplicates: list or None)
-    """
-    if check_duplicates_first:
-        dups = check_duplicates(printer_ip, smb_address, proxies)
-        if dups:
-            return False, f"Duplicates found: {dups}", None, dups
-    
-    # Fetch ID inline (single call, no separate function overhead)
-    available_id = fetch_available_id(printer_ip, proxies)
-    if not available_id:
-        return False, "Failed to fetch available ID", None, None
+def batch_delete_form(entry_ids):
+    """Form data of a deleteAbpPersonalGroup post for up to DELETE_BATCH_SIZE entries."""
+    if not 0 < len(entry_ids) <= DELETE_BATCH_SIZE:
+        raise ValueError(f"A delete takes 1 to {DELETE_BATCH_SIZE} IDs, got {len(entry_ids)}")
     
-    cgi_url = f"https://{printer_ip}/basic/set.cgi"
+    form = delete_form('')
+    form['arg04_MemoryIDNum'] = str(len(entry_ids))
+    for slot, entry_id in enumerate(entry_ids, start=6):
+        form[f'arg{slot:02d}_MemoryID'] = entry_id
+    return form
+
+def smb_contact_form(available_id, smb_address, smb_password):
+    """Form data of an addAbpPersonal post for an SMB contact."""
     entry_name = '.'.join(smb_address.split('.')[2:])
     
     # Minimal form data: Only required fields for SMB add (from captured traffic)
-    form_data = {
+    return {
         'okhtmfile': '/basic/Contact_BasicRslt.htm',
         'failhtmfile': '/basic/Contact_BasicErr.htm',
         'func': 'addAbpPersonal',
@@ -331,28 +181,534 @@ def add_smb_contact(printer_ip, smb_address, smb_password='scanner#oki', proxies
         'arg22_EncryptionKey': '0',
         'submit001': 'Enviar'
     }
-    
-    headers = {
-        'Content-Type': 'application/x-www-form-urlencoded',
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-        'Accept': 'text/html,application/xhtml+xml,*/*;q=0.9',
-        'Referer': f'https://{printer_ip}/basic/AddrBook_Addr_NewCntct_Prpty.htm?arg1=1&arg2=0&arg3=&arg4=0&arg5=&arg6=1&arg50=0',
-        'Cookie': 'rtl=0'
-    }
-    
-    try:
-        response = requests.post(
-            cgi_url, data=urlencode(form_data), headers=headers,
-            proxies=proxies, verify=False, timeout=10
-        )
+
+LIST_PAGE_PATH = "/js/jssrc/model/basic/AddrBook_Addr.model.htm?arg1={page}&arg2=0&arg3=&arg4=1&arg5=&arg6=0&arg7=0&arg8=&arg9=&arg50=0"
+LIST_PAGE_REFERER = "/basic/AddrBook_Addr.htm?arg1={page}&arg2=0&arg3=&arg4=1&arg5=&arg6=0&arg7=0&arg9=&arg50=0"
+DETAIL_PATH = "/js/jssrc/model/basic/AddrBook_Addr_NewCntct_Prpty.model.htm?arg1=1&arg2=0&arg3=&arg4=1&arg5={entry_id}&arg6=1&arg50=0"
+DETAIL_REFERER = "/basic/AddrBook_Addr_NewCntct_Prpty.htm?arg1=1&arg2=0&arg3=&arg4=1&arg5={entry_id}&arg6=1&arg50=0"
+
+class AddressBookMirror:
+    """
+    Local copy of one printer's address book, indexed by entry ID and by SMB host.
+
+    Kept in <directory>/<printer_ip>.json (in memory only without a path).
+    AddressBookClient syncs it incrementally and applies its own adds and
+    deletes to it, so a duplicate check is a dictionary lookup instead of a
+    download of the whole book.
+    """
+
+    def __init__(self, path: Optional[Path] = None):
+        self.path = path
+        self.synced_at = 0.0
+        self.refreshed_at = 0.0  # Last time the details of every entry were read
+        self.entries: Dict[str, Dict[str, Optional[str]]] = {}  # ID -> {'name', 'smb_host'}
+        self.by_host: Dict[str, Set[str]] = {}
+
+    @classmethod
+    def load(cls, directory: str, printer_ip: str) -> "AddressBookMirror":
+        """Load the mirror of a printer (empty and never synced if there is none yet or it is unreadable)."""
+        path = Path(directory) / f"{printer_ip}.json"
+        mirror = cls(path)
+        if path.exists():
+            try:
+                data = json.loads(path.read_text(encoding="utf-8"))
+                mirror.synced_at = data['synced_at']
+                mirror.refreshed_at = data.get('refreshed_at', 0.0)
+                for entry_id, entry in data['entries'].items():
+                    mirror.put(entry_id, entry['name'], entry['smb_host'])
+            except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+                # A truncated or corrupt file only costs a full sync
+                print(f"Address book mirror {path} is unreadable, starting over: {e}", file=sys.stderr)
+                mirror = cls(path)
+        return mirror
+
+    def save(self):
+        """Write the mirror, replacing the previous file atomically."""
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = self.path.with_suffix(".tmp")
+        temporary.write_text(json.dumps({'synced_at': self.synced_at, 'refreshed_at': self.refreshed_at,
+                                         'entries': self.entries}), encoding="utf-8")
+        os.replace(temporary, self.path)
+
+    def put(self, entry_id: str, name: str, smb_host: Optional[str]):
+        """Add or replace an entry."""
+        self.remove(entry_id)
+        self.entries[entry_id] = {'name': name, 'smb_host': smb_host}
+        if smb_host:
+            self.by_host.setdefault(smb_host, set()).add(entry_id)
+
+    def remove(self, entry_id: str):
+        """Forget an entry (no-op if unknown)."""
+        entry = self.entries.pop(entry_id, None)
+        if entry and entry['smb_host']:
+            self.by_host[entry['smb_host']].discard(entry_id)
+            if not self.by_host[entry['smb_host']]:
+                del self.by_host[entry['smb_host']]
+
+    def find(self, smb_host: str) -> List[Dict[str, str]]:
+        """Entries with this SMB host, as [{'id', 'name'}] in ID order."""
+        return [{'id': entry_id, 'name': self.entries[entry_id]['name']}
+                for entry_id in sorted(self.by_host.get(smb_host, ()), key=int)]
+
+def proxy_mounts(proxies):
+    """httpx transports for a requests-style proxies dict, e.g. {'https': 'http://proxy:3128'}."""
+    if not proxies:
+        return None
+    return {f"{scheme}://": httpx.AsyncHTTPTransport(proxy=url, verify=False) for scheme, url in proxies.items()}
+
+class AddressBookClient:
+    """
+    Async client for the printers' address book, on one shared httpx connection pool.
+
+    Listing reads the first page, which gives the total (TotsearchResult) and the
+    page size, then fetches all remaining pages at once; entry details are also
+    fetched concurrently. At most max_per_host requests are in flight against a
+    printer, however many printers the client is used for. Requests reuse
+    keep-alive connections instead of a new TLS handshake each.
+
+    With a mirror_dir, duplicate checks are answered from an AddressBookMirror of
+    each printer, synced when older than mirror_max_age seconds: the list pages
+    are read, and details are fetched only for entries that are new or renamed.
+    The list has no SMB host, so an entry whose host is edited in place is only
+    seen when its details are read again: the entries a duplicate check finds are
+    re-read before they are returned, and every mirror_full_refresh seconds a sync
+    reads the details of all entries. Until then, an entry edited to the checked
+    host can be missed. If the mirror cannot be synced, the whole book is read as
+    without one. Our own adds and deletes are applied to the mirror on disk,
+    whether or not this client has read it yet.
+
+    Methods return the same values as the module functions of the same name.
+    """
+
+    def __init__(self, client: Optional[httpx.AsyncClient] = None, max_per_host: int = 4,
+                 timeout: float = 10.0, proxies: Optional[Dict[str, str]] = None,
+                 mirror_dir: Optional[str] = None, mirror_max_age: float = 300.0,
+                 mirror_full_refresh: float = 3600.0):
+        self.client = client or httpx.AsyncClient(verify=False, timeout=timeout, mounts=proxy_mounts(proxies))
+        self.owns_client = client is None
+        self.max_per_host = max_per_host
+        self.host_semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.mirror_dir = mirror_dir
+        self.mirror_max_age = mirror_max_age
+        self.mirror_full_refresh = mirror_full_refresh
+        self.mirrors: Dict[str, AddressBookMirror] = {}
+        self.mirror_locks: Dict[str, asyncio.Lock] = {}
+
+    @classmethod
+    def from_config(cls, proxies: Optional[Dict[str, str]] = None) -> "AddressBookClient":
+        """Create a client with the Config per-host request limit and address book mirror."""
+        return cls(max_per_host=Config.MAX_REQUESTS_PER_HOST, proxies=proxies,
+                   mirror_dir=Config.ADDRESS_BOOK_MIRROR_DIR or None, mirror_max_age=Config.ADDRESS_BOOK_MIRROR_MAX_AGE,
+                   mirror_full_refresh=Config.ADDRESS_BOOK_MIRROR_FULL_REFRESH)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def close(self):
+        """Close the connection pool if the client created it."""
+        if self.owns_client:
+            await self.client.aclose()
+
+    def host_semaphore(self, printer_ip: str) -> asyncio.Semaphore:
+        """Per-printer request limit."""
+        if printer_ip not in self.host_semaphores:
+            self.host_semaphores[printer_ip] = asyncio.Semaphore(self.max_per_host)
+        return self.host_semaphores[printer_ip]
+
+    async def get(self, printer_ip: str, path: str, referer: str) -> Optional[str]:
+        """GET a model.htm; returns the body, or None unless the status is 200."""
+        async with self.host_semaphore(printer_ip):
+            response = await self.client.get(f"https://{printer_ip}{path}", headers=model_headers(printer_ip, referer))
+        return response.text if response.status_code == 200 else None
+
+    async def post(self, printer_ip: str, form: Dict[str, str], referer: Optional[str] = None) -> httpx.Response:
+        """POST a form to set.cgi."""
+        async with self.host_semaphore(printer_ip):
+            return await self.client.post(f"https://{printer_ip}/basic/set.cgi", content=urlencode(form),
+                                          headers=form_headers(printer_ip, referer))
+
+    async def fetch_available_id(self, printer_ip: str) -> Optional[str]:
+        """First available contact ID, or None."""
+        try:
+            text = await self.get(
+                printer_ip,
+                "/js/jssrc/model/basic/AddrBook_Addr_NewCntct_Prpty.model.htm?arg1=1&arg2=0&arg3=&arg4=0&arg5=&arg6=1&arg50=0",
+                "/basic/AddrBook_Addr_NewCntct_Prpty.htm?arg1=1&arg2=0&arg3=&arg4=0&arg5=&arg6=1&arg50=0"
+            )
+            return parse_available_id(text) if text is not None else None
+        except (httpx.HTTPError, IndexError):
+            return None
+
+    async def fetch_address_book_page(self, printer_ip: str, page: int = 1) -> Tuple[int, List[Dict[str, str]]]:
+        """One page of the address book: (total entries, [{'id', 'name'}]), (0, []) on failure."""
+        try:
+            text = await self.get(printer_ip, LIST_PAGE_PATH.format(page=page), LIST_PAGE_REFERER.format(page=page))
+            return parse_address_book_page(text) if text is not None else (0, [])
+        except (httpx.HTTPError, ValueError, IndexError):
+            return 0, []
+
+    async def get_all_entries(self, printer_ip: str) -> List[Dict[str, str]]:
+        """All address book entries: the first page, then every other page at once."""
+        total, entries = await self.fetch_address_book_page(printer_ip, 1)
+        if not entries:
+            return []
+        
+        pages = math.ceil(total / len(entries))
+        for _, page_entries in await asyncio.gather(
+                *(self.fetch_address_book_page(printer_ip, page) for page in range(2, pages + 1))):
+            entries.extend(page_entries)
+        return entries[:total]  # Trim if overfetched
+
+    async def fetch_entry_detail(self, printer_ip: str, entry_id: str) -> Tuple[bool, Optional[str], Optional[str], Optional[str]]:
+        """Details of an entry: (success, number, name, smb_host)."""
+        try:
+            text = await self.get(printer_ip, DETAIL_PATH.format(entry_id=entry_id), DETAIL_REFERER.format(entry_id=entry_id))
+            return parse_entry_detail(text) if text is not None else (False, None, None, None)
+        except httpx.HTTPError:
+            return False, None, None, None
+
+    async def list_entries(self, printer_ip: str) -> Optional[Dict[str, str]]:
+        """Name of every entry by ID, or None unless every list page could be read."""
+        try:
+            text = await self.get(printer_ip, LIST_PAGE_PATH.format(page=1), LIST_PAGE_REFERER.format(page=1))
+            if text is None:
+                return None
+            total, entries = parse_address_book_page(text)
+            pages = math.ceil(total / len(entries)) if entries else 1
+            texts = await asyncio.gather(*(
+                self.get(printer_ip, LIST_PAGE_PATH.format(page=page), LIST_PAGE_REFERER.format(page=page))
+                for page in range(2, pages + 1)))
+            if None in texts:
+                return None
+            for text in texts:
+                entries.extend(parse_address_book_page(text)[1])
+        except (httpx.HTTPError, ValueError, IndexError):
+            return None
+        
+        listed = {entry['id']: entry['name'] for entry in entries[:total]}
+        return listed if len(listed) == total else None
+
+    async def sync_mirror(self, printer_ip: str, mirror: AddressBookMirror, full: bool = False) -> bool:
+        """
+        Bring a mirror up to date: drop deleted entries, fetch the details of new or renamed
+        ones (with full, of every entry). Returns False (leaving the mirror as it was) if the
+        printer could not be read, including a detail that did not parse.
+        """
+        listed = await self.list_entries(printer_ip)
+        if listed is None:
+            return False
         
-        if response.status_code != 200 or 'Progress_1.gif' not in response.text:
-            return False, "Add failed (unexpected response)", response.text, None
+        changed = [entry_id for entry_id, name in listed.items()
+                   if full or entry_id not in mirror.entries or mirror.entries[entry_id]['name'] != name]
+        try:
+            texts = await asyncio.gather(*(
+                self.get(printer_ip, DETAIL_PATH.format(entry_id=entry_id), DETAIL_REFERER.format(entry_id=entry_id))
+                for entry_id in changed))
+        except httpx.HTTPError:
+            return False
+        if None in texts:
+            return False
+        details = [parse_entry_detail(text) for text in texts]
+        if not all(success for success, _, _, _ in details):
+            return False
+        
+        for entry_id in set(mirror.entries) - set(listed):
+            mirror.remove(entry_id)
+        for entry_id, (_, _, _, smb_host) in zip(changed, details):
+            mirror.put(entry_id, listed[entry_id], smb_host)
+        mirror.synced_at = time.time()
+        if len(changed) == len(listed):
+            mirror.refreshed_at = mirror.synced_at
+        mirror.save()
+        return True
+
+    async def recheck_entries(self, printer_ip: str, book: AddressBookMirror, entry_ids: List[str]) -> bool:
+        """
+        Read the details of entries of a book again and update their SMB host, which
+        a sync misses if it was edited in place. Returns False (leaving the book as
+        it was) if any could not be read.
+        """
+        details = await asyncio.gather(*(self.fetch_entry_detail(printer_ip, entry_id) for entry_id in entry_ids))
+        if not all(success for success, _, _, _ in details):
+            return False
+        
+        async with self.mirror_locks.setdefault(printer_ip, asyncio.Lock()):
+            for entry_id, (_, _, _, smb_host) in zip(entry_ids, details):
+                if entry_id in book.entries:
+                    book.put(entry_id, book.entries[entry_id]['name'], smb_host)
+            book.save()
+        return True
+
+    async def mirror(self, printer_ip: str, refresh: bool = False) -> Optional[AddressBookMirror]:
+        """
+        The printer's mirror, synced first if older than mirror_max_age (or refresh).
+        None without a mirror_dir or if it could not be synced.
+        """
+        if not self.mirror_dir:
+            return None
+        
+        async with self.mirror_locks.setdefault(printer_ip, asyncio.Lock()):
+            if printer_ip not in self.mirrors:
+                self.mirrors[printer_ip] = AddressBookMirror.load(self.mirror_dir, printer_ip)
+            mirror = self.mirrors[printer_ip]
+            full = bool(self.mirror_full_refresh) and time.time() - mirror.refreshed_at >= self.mirror_full_refresh
+            if (refresh or full or time.time() - mirror.synced_at >= self.mirror_max_age) \
+                    and not await self.sync_mirror(printer_ip, mirror, full):
+                return None
+            return mirror
+
+    async def update_mirror(self, printer_ip: str, update: Callable[[AddressBookMirror], None]):
+        """
+        Apply one of our own writes to the printer's mirror and save it, loading the
+        mirror first if this client has not used it yet (no-op without a mirror_dir).
+        """
+        if not self.mirror_dir:
+            return
+        
+        async with self.mirror_locks.setdefault(printer_ip, asyncio.Lock()):
+            if printer_ip not in self.mirrors:
+                self.mirrors[printer_ip] = AddressBookMirror.load(self.mirror_dir, printer_ip)
+            update(self.mirrors[printer_ip])
+            self.mirrors[printer_ip].save()
+
+    async def read_book(self, printer_ip: str) -> Optional[AddressBookMirror]:
+        """
+        The printer's address book as it is now: its mirror, synced, or without a
+        mirror_dir a full read into an in-memory one. None if it could not be read.
+        """
+        if self.mirror_dir:
+            return await self.mirror(printer_ip, refresh=True)
+        book = AddressBookMirror()
+        return book if await self.sync_mirror(printer_ip, book) else None
+
+    async def check_duplicates(self, printer_ip: str, target_smb_ip: str) -> List[Dict[str, str]]:
+        """Entries whose SMB host is target_smb_ip, as [{'id', 'name'}]."""
+        mirror = await self.mirror(printer_ip)
+        if mirror is not None:
+            hits = [entry['id'] for entry in mirror.find(target_smb_ip)]
+            if not hits or await self.recheck_entries(printer_ip, mirror, hits):
+                return mirror.find(target_smb_ip)
+        
+        entries = await self.get_all_entries(printer_ip)
+        details = await asyncio.gather(*(self.fetch_entry_detail(printer_ip, entry['id']) for entry in entries))
+        return [
+            {'id': number, 'name': name}
+            for success, number, name, smb_host in details
+            if success and smb_host and smb_host == target_smb_ip
+        ]
+
+    async def delete_entry(self, printer_ip: str, entry_id: str) -> Tuple[bool, str, Optional[str]]:
+        """Delete an entry: (success, message, response text)."""
+        try:
+            response = await self.post(printer_ip, delete_form(entry_id))
+            
+            # Debug: Print status and response preview (to stderr, stdout is for results)
+            print(f"Delete response for ID {entry_id}: Status {response.status_code}", file=sys.stderr)
+            
+            # For delete, success if status 200 (no progress gif needed, as delete is immediate)
+            if response.status_code != 200:
+                return False, f"Delete failed HTTP {response.status_code}", response.text
+            
+            await self.update_mirror(printer_ip, lambda mirror: mirror.remove(entry_id))
+            return True, f"Successfully deleted entry with ID: {entry_id}", response.text
+            
+        except httpx.HTTPError as e:
+            return False, f"Connection error: {str(e)}", None
+
+    async def delete_entries(self, printer_ip: str, entry_ids: List[str]) -> Dict[str, Tuple[Optional[bool], str]]:
+        """
+        Delete entries DELETE_BATCH_SIZE per request, then check with one read of the list
+        which ones are gone.
+        
+        :return: (deleted, message) by ID. An ID is deleted (True) once it is no longer listed;
+                 if the list could not be read, IDs whose request succeeded are unverified (None)
+        """
+        outcomes: Dict[str, Tuple[Optional[bool], str]] = {}
+        
+        # One request at a time: they are writes to the same address book
+        for start in range(0, len(entry_ids), DELETE_BATCH_SIZE):
+            batch = entry_ids[start:start + DELETE_BATCH_SIZE]
+            try:
+                response = await self.post(printer_ip, batch_delete_form(batch))
+                outcome = (response.status_code == 200, f"Delete failed HTTP {response.status_code}")
+            except httpx.HTTPError as e:
+                outcome = (False, f"Connection error: {str(e)}")
+            outcomes.update({entry_id: outcome for entry_id in batch})
+        
+        listed = await self.list_entries(printer_ip)
+        for entry_id, (sent, message) in outcomes.items():
+            if listed is None:
+                outcomes[entry_id] = (None, "Delete sent, not verified (address book could not be read)") if sent \
+                    else (False, message)
+            elif entry_id not in listed:
+                outcomes[entry_id] = (True, f"Successfully deleted entry with ID: {entry_id}")
+            else:
+                outcomes[entry_id] = (False, message if not sent else "Entry still listed after delete")
+        
+        def remove_deleted(mirror: AddressBookMirror):
+            for entry_id, (deleted, _) in outcomes.items():
+                if deleted:
+                    mirror.remove(entry_id)
+            if listed is None:
+                mirror.synced_at = 0.0  # Unverified deletes: sync before the next use
+        await self.update_mirror(printer_ip, remove_deleted)
+        return outcomes
+
+    async def cleanup_duplicates(self, printer_ip: str, target_smb_ip: str) -> Dict[str, Any]:
+        """Delete all duplicates of target_smb_ip but the one with the smallest ID (see cleanup_duplicates)."""
+        # Retrieve duplicates
+        duplicates = await self.check_duplicates(printer_ip, target_smb_ip)
+        if not duplicates:
+            return {
+                'success': False,
+                'kept_id': None,
+                'entry_name': None,
+                'smb_address': None,
+                'message': 'No duplicates found.'
+            }
+        
+        # Find the duplicate with the smallest ID (convert to int for comparison)
+        min_dup = min(duplicates, key=lambda x: int(x['id']))
+        min_id = min_dup['id']
+        
+        # Delete all other duplicates, DELETE_BATCH_SIZE per request
+        outcomes = await self.delete_entries(printer_ip, [dup['id'] for dup in duplicates if dup['id'] != min_id])
+        for entry_id, (deleted, msg) in outcomes.items():
+            if deleted is None:
+                print(f"Delete of duplicate ID {entry_id} not verified: {msg}", file=sys.stderr)
+            elif not deleted:
+                # Log error but continue
+                print(f"Failed to delete duplicate ID {entry_id}: {msg}", file=sys.stderr)
+        
+        # Fetch details of the kept entry
+        success, number, name, smb_host = await self.fetch_entry_detail(printer_ip, min_id)
+        if success and smb_host == target_smb_ip:
+            return {
+                'success': True,
+                'kept_id': number,
+                'entry_name': name,
+                'smb_address': smb_host,
+                'message': f'Cleaned up {sum(deleted is True for deleted, _ in outcomes.values())} of {len(outcomes)} duplicates. Kept ID: {number}'
+            }
+        else:
+            return {
+                'success': False,
+                'kept_id': None,
+                'entry_name': None,
+                'smb_address': None,
+                'message': 'Failed to fetch details of kept entry after cleanup.'
+            }
+
+    async def add_smb_contact(self, printer_ip: str, smb_address: str, smb_password: str = 'scanner#oki',
+                              check_duplicates_first: bool = True) -> Tuple[bool, str, Optional[str], Optional[List[Dict[str, str]]]]:
+        """Add an SMB contact (see add_smb_contact)."""
+        if check_duplicates_first:
+            dups = await self.check_duplicates(printer_ip, smb_address)
+            if dups:
+                return False, f"Duplicates found: {dups}", None, dups
         
-        return True, available_id, response.text, None
+        available_id = await self.fetch_available_id(printer_ip)
+        if not available_id:
+            return False, "Failed to fetch available ID", None, None
         
-    except requests.RequestException as e:
-        return False, f"Connection error: {str(e)}", None, None
+        form = smb_contact_form(available_id, smb_address, smb_password)
+        try:
+            response = await self.post(
+                printer_ip, form,
+                "/basic/AddrBook_Addr_NewCntct_Prpty.htm?arg1=1&arg2=0&arg3=&arg4=0&arg5=&arg6=1&arg50=0"
+            )
+            
+            if response.status_code != 200 or 'Progress_1.gif' not in response.text:
+                return False, "Add failed (unexpected response)", response.text, None
+            
+            await self.update_mirror(
+                printer_ip, lambda mirror: mirror.put(available_id, form['arg07_Name'], smb_address))
+            return True, available_id, response.text, None
+            
+        except httpx.HTTPError as e:
+            return False, f"Connection error: {str(e)}", None, None
+
+def run_address_book(call: Callable[[AddressBookClient], Awaitable[Any]], proxies=None):
+    """
+    Run call on a new AddressBookClient and return its result.
+    For synchronous callers only: it runs its own event loop.
+    """
+    async def run():
+        async with AddressBookClient.from_config(proxies) as book:
+            return await call(book)
+    return asyncio.run(run())
+
+def fetch_available_id(printer_ip, proxies=None):
+    """
+    Fetch and parse the first available contact ID from the printer's model.
+    """
+    return run_address_book(lambda book: book.fetch_available_id(printer_ip), proxies)
+
+def fetch_address_book_page(printer_ip, page=1, proxies=None):
+    """
+    Fetch a page of the address book entries.
+    Returns (total_entries: int, page_entries: list of {'id': str, 'name': str})
+    """
+    return run_address_book(lambda book: book.fetch_address_book_page(printer_ip, page), proxies)
+
+def get_all_entries(printer_ip, proxies=None):
+    """
+    Fetch all address book entries, the pages after the first one concurrently.
+    Returns list of {'id': str, 'name': str}
+    """
+    return run_address_book(lambda book: book.get_all_entries(printer_ip), proxies)
+
+def fetch_entry_detail(printer_ip, entry_id, proxies=None):
+    """
+    Fetch details for a specific entry ID.
+    Returns (success: bool, number: str, name: str, smb_host: str or None)
+    """
+    return run_address_book(lambda book: book.fetch_entry_detail(printer_ip, entry_id), proxies)
+
+def check_duplicates(printer_ip, target_smb_ip, proxies=None):
+    """
+    Check for duplicate SMB entries matching the target IP.
+    Entry details are fetched concurrently (see AddressBookClient).
+    Returns list of {'id': str, 'name': str} for duplicates.
+    """
+    return run_address_book(lambda book: book.check_duplicates(printer_ip, target_smb_ip), proxies)
+
+def delete_entry(printer_ip, entry_id, proxies=None):
+    """
+    Delete a specified entry from the printer's address book.
+    Returns (success: bool, message: str, response_text: str or None)
+    """
+    return run_address_book(lambda book: book.delete_entry(printer_ip, entry_id), proxies)
+
+def delete_entries(printer_ip, entry_ids, proxies=None):
+    """
+    Delete several entries, up to 10 per request, and verify with one read of the list.
+    Returns {id: (deleted: bool, or None if it could not be verified, message: str)}
+    """
+    return run_address_book(lambda book: book.delete_entries(printer_ip, entry_ids), proxies)
+
+def cleanup_duplicates(printer_ip, target_smb_ip, proxies=None):
+    """
+    Retrieve duplicates for the target SMB IP, delete all except the one with the smallest ID,
+    and return the details of the kept entry.
+    Returns {'success': bool, 'kept_id': str or None, 'entry_name': str or None, 'smb_address': str or None, 'message': str}
+    """
+    return run_address_book(lambda book: book.cleanup_duplicates(printer_ip, target_smb_ip), proxies)
+
+def add_smb_contact(printer_ip, smb_address, smb_password='scanner#oki', proxies=None, check_duplicates_first=True):
+    """
+    Add an SMB contact to the printer's address book.
+    Optionally checks for duplicates first.
+    Returns (success: bool, id: str or error: str, response_text: str or None, duplicates: list or None)
+    """
+    return run_address_book(
+        lambda book: book.add_smb_contact(printer_ip, smb_address, smb_password, check_duplicates_first), proxies
+    )
 
 def get_printer_hostname(ip_address):
     url = f"https://{ip_address}/js/jssrc/model/startwlm/Start_Wlm.model.htm"
@@ -368,9 +724,9 @@ def get_printer_hostname(ip_address):
         response = requests.get(url, headers=headers, verify=False, timeout=10)
         response.raise_for_status()
         
-        match = re.search(r"_pp\.f_getHostName\s*=\s*'([^']*)';", response.text)
-        if match:
-            return match.group(1)
+        hostname = pp_str(parse_pp_assignments(response.text, ('f_getHostName',)), 'f_getHostName')
+        if hostname is not None:
+            return hostname
         else:
             return "Hostname not found"
             
@@ -392,7 +748,7 @@ def get_printer_toner_level(ip_address):
         response = requests.get(url, headers=headers, verify=False, timeout=10)
         response.raise_for_status()
         
-        matches = re.findall(r"_pp\.Renaming\.push\(parseInt\('(\d+)',\s*10\)\);", response.text)
+        matches = [value for value in pp_list(parse_pp_assignments(response.text, ('Renaming',)), 'Renaming') if value.isdigit()]
         
         if matches:
             return int(matches[0])
@@ -0,0 +1,65 @@
+import re
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Pattern, Tuple, TypedDict
+
+# Matches the statement forms the Kyocera embedded web server emits in its
+# *.model.htm bodies, all of which carry a single-quoted literal:
+#   _pp.name = 'value';                  _pp.name = ('value').toString();
+#   _pp.name = parseInt('value', 10);    _pp.Name[index] = 'value';
+#   _pp.Name.push(parseInt('value', 10));
+_PP_STATEMENT = r"_pp\.({names})\s*(\[\w*\])?\s*(=|\.push\()\s*(?:parseInt\(|\()?'([^']*)'"
+
+class PPAssignments(TypedDict):
+    """Result of parse_pp_assignments."""
+    scalars: Dict[str, str]
+    arrays: Dict[str, List[str]]
+
+@lru_cache(maxsize=64)
+def _statement_pattern(names: Optional[Tuple[str, ...]]) -> Pattern[str]:
+    """Compile (once) the statement pattern, optionally restricted to some names."""
+    if names is None:
+        return re.compile(_PP_STATEMENT.format(names=r"\w+"))
+    # The trailing \b keeps e.g. "scanCopy" from matching "scanCopyTotal"
+    return re.compile(_PP_STATEMENT.format(names="(?:" + "|".join(map(re.escape, names)) + r")\b"))
+
+def parse_pp_assignments(text: str, names: Optional[Iterable[str]] = None) -> PPAssignments:
+    """
+    Scan a model.htm body once and collect its _pp assignments.
+
+    Plain assignments go to "scalars" (first occurrence wins, as with re.search).
+    Indexed assignments and .push() calls go to "arrays", in document order.
+
+    :param text: Response body of a *.model.htm endpoint
+    :param names: Only collect these _pp names (default: every assignment)
+    :return: Dictionary with "scalars" and "arrays"
+    """
+    pattern = _statement_pattern(None if names is None else tuple(names))
+    scalars: Dict[str, str] = {}
+    arrays: Dict[str, List[str]] = {}
+
+    for name, index, operator, value in pattern.findall(text):
+        if index or operator != '=':
+            if name in arrays:
+                arrays[name].append(value)
+            else:
+                arrays[name] = [value]
+        elif name not in scalars:
+            scalars[name] = value
+
+    return {"scalars": scalars, "arrays": arrays}
+
+def pp_str(assignments: PPAssignments, name: str, allow_empty: bool = True) -> Optional[str]:
+    """Return a scalar string value, or None if missing (or empty and not allowed)."""
+    value = assignments["scalars"].get(name)
+    if value is None or (not allow_empty and value == ''):
+        return None
+    return value
+
+def pp_int(assignments: PPAssignments, name: str) -> Optional[int]:
+    """Return a scalar value as int, or None if missing or not a number."""
+    value = assignments["scalars"].get(name)
+    return int(value) if value is not None and value.isdigit() else None
+
+def pp_list(assignments: PPAssignments, name: str) -> List[str]:
+    """Return the values of an indexed/pushed array, or an empty list."""
+    return assignments["arrays"].get(name, [])
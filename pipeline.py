@@ -0,0 +1,276 @@
+import asyncio
+import sqlite3
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional, Union
+import psycopg
+import psycopg2
+from alerts import AlertEngine
+from async_database import AsyncDatabase
+from config import Config
+from database import Database
+from device_cache import DeviceCache
+from fetcher import stream_printers_data_async
+from logger import get_logger
+from metrics import get_registry
+from ship import UpstreamShipper
+from spool import Spool, get_spool
+from sqlite_database import SQLiteDatabase
+from storage import Storage, create_storage
+
+# Marks the end of the scrape on the pipeline queue
+END_OF_STREAM = None
+
+# Errors of an unreachable, stalled or locked database: the batch is spooled and replayed later.
+# Any other error is a problem with the batch itself and is raised as before
+UNAVAILABLE_ERRORS = (ConnectionError, psycopg2.OperationalError, psycopg2.InterfaceError,
+                      psycopg.OperationalError, sqlite3.OperationalError)
+
+@asynccontextmanager
+async def open_database(device_cache: Optional[DeviceCache] = None) -> AsyncIterator[Union[Storage, AsyncDatabase]]:
+    """
+    Open the configured storage: a pooled AsyncDatabase if Config.DB_ASYNC (PostgreSQL only),
+    else the Config.DB_BACKEND storage. PostgreSQL records alert transitions on save unless
+    Config.ALERT_EVENTS is off.
+
+    With a spool (Config.SPOOL_DIR), an unreachable database does not fail the open:
+    saves are spooled until it is back.
+
+    :param device_cache: Cache for the psycopg2 Database (AsyncDatabase does not use one)
+    """
+    alert_engine = AlertEngine.from_config() if Config.ALERT_EVENTS else None
+    if Config.DB_ASYNC and Config.DB_BACKEND == "postgres":
+        db = AsyncDatabase.from_config(alert_engine)
+        await db.open(wait=not Config.SPOOL_DIR)
+        try:
+            yield db
+        finally:
+            await db.close()
+    else:
+        with create_storage(device_cache=device_cache, alert_engine=alert_engine) as db:
+            yield db
+
+def _reconnect_and_save(db: Storage, batch: List[Dict[str, Any]], timestamp: Optional[datetime] = None,
+                        bulk: Optional[bool] = None, batch_id: Optional[str] = None) -> int:
+    """Reopen the connection if it was dropped, then save the batch."""
+    db.connect()
+    if db.conn is None:
+        raise ConnectionError("Database connection is not established")
+    return db.save_printer_data(batch, bulk, timestamp, batch_id)
+
+async def _save(db: Union[Storage, AsyncDatabase], batch: List[Dict[str, Any]], timestamp: Optional[datetime] = None,
+                bulk: Optional[bool] = None, batch_id: Optional[str] = None) -> int:
+    """Save a batch without blocking the event loop: natively on the pool, or in a worker thread."""
+    if isinstance(db, AsyncDatabase):
+        return await db.save_printer_data(batch, bulk, timestamp=timestamp, batch_id=batch_id)
+    return await asyncio.to_thread(_reconnect_and_save, db, batch, timestamp, bulk, batch_id)
+
+async def save_batch(db: Union[Storage, AsyncDatabase], batch: List[Dict[str, Any]]) -> int:
+    """
+    Save a batch, or spool it if the database is unavailable (Config.SPOOL_DIR).
+
+    Spooled batches are replayed before the next batch is saved, so they reach the
+    database in the order they were scraped.
+
+    :param db: Connected database
+    :param batch: Printer data dictionaries
+    :return: Number of printers saved (0 if the batch was spooled)
+    """
+    spool = get_spool()
+    if spool is None:
+        return await _save(db, batch)
+
+    timestamp = datetime.now()
+    try:
+        if not spool.replaying and spool.pending():
+            try:
+                await replay_spool(db, spool)
+            except UNAVAILABLE_ERRORS:
+                raise
+            except Exception as e:
+                # Not this batch's problem: it is still saved (or spooled) below
+                get_logger().error(f"Failed to replay the spool: {e}")
+        return await _save(db, batch, timestamp)
+    except UNAVAILABLE_ERRORS as e:
+        spool.append(batch, timestamp)
+        get_logger().warning(f"Database unavailable, spooled a batch of {len(batch)} printers: {e}")
+        return 0
+
+async def replay_spool(db: Union[Storage, AsyncDatabase], spool: Spool) -> int:
+    """
+    Save the spooled batches, oldest first, each with the time it was scraped.
+
+    A segment is removed once all its batches are saved. Each batch is saved
+    under its batch_id, so if the database fails again halfway, the batches of
+    the segment that were already saved are skipped when it is replayed again. A segment with a batch
+    the database rejects for any other reason is moved aside (*.failed) and
+    logged, and the replay goes on with the next one.
+
+    :param db: Connected database
+    :param spool: Spool to drain
+    :return: Number of printers saved
+    """
+    logger = get_logger()
+    saved = 0
+    spool.replaying = True
+    try:
+        for segment in spool.segments():
+            try:
+                for timestamp, batch, batch_id in spool.read(segment):
+                    saved += await _save(db, batch, timestamp, bulk=True, batch_id=batch_id)
+                    spool.close()  # The database is back: batches spooled from now on go to a new segment
+            except UNAVAILABLE_ERRORS:
+                raise
+            except Exception as e:
+                failed = spool.quarantine(segment)
+                logger.error(f"Spool segment {segment.name} cannot be replayed, moved aside as {failed.name}: {e}")
+                continue
+            spool.remove(segment)
+            logger.info(f"Replayed spool segment {segment.name}")
+    finally:
+        spool.replaying = False
+    get_registry().inc("kyoscan_spool_replayed_printers_total", saved)
+    return saved
+
+def _apply_retention() -> List[str]:
+    with create_storage() as db:
+        return db.apply_retention()
+
+async def apply_retention() -> List[str]:
+    """Drop expired partitions and rollups on a short-lived connection of its own, off the event loop."""
+    return await asyncio.to_thread(_apply_retention)
+
+def _refresh_usage() -> int:
+    with create_storage() as db:
+        return db.refresh_usage()
+
+async def refresh_usage() -> int:
+    """Bring the usage summary up to date on a short-lived connection of its own, off the event loop."""
+    return await asyncio.to_thread(_refresh_usage)
+
+def _refresh_forecast() -> int:
+    with create_storage() as db:
+        return db.refresh_forecast()
+
+async def refresh_forecast() -> int:
+    """Recompute the toner forecast on a short-lived connection of its own, off the event loop."""
+    return await asyncio.to_thread(_refresh_forecast)
+
+def _export_history() -> Dict[str, int]:
+    with create_storage() as db:
+        return db.export_history()
+
+async def export_history() -> Dict[str, int]:
+    """Append new history rows to the Parquet/Arrow export on a short-lived connection of its own, off the event loop."""
+    return await asyncio.to_thread(_export_history)
+
+def _ship_upstream() -> Dict[str, Any]:
+    alert_engine = AlertEngine.from_config() if Config.ALERT_EVENTS else None
+    with SQLiteDatabase.from_config() as local, Database(Config(), alert_engine=alert_engine) as upstream:
+        if local.conn is None or upstream.conn is None:
+            raise ConnectionError("Database connection is not established")
+        return UpstreamShipper.from_config().ship(local, upstream)
+
+async def ship_upstream() -> Dict[str, Any]:
+    """Ship the rows saved locally to the PostgreSQL server on short-lived connections of their own, off the event loop."""
+    return await asyncio.to_thread(_ship_upstream)
+
+async def write_batches(queue: asyncio.Queue, db: Union[Storage, AsyncDatabase], batch_size: int,
+                        flush_seconds: float) -> int:
+    """
+    Drain scrape results from the queue and save them in micro-batches.
+
+    A batch is flushed when it reaches batch_size results, when flush_seconds have
+    passed since its first result, or when the end-of-stream marker arrives.
+    Saving runs in a worker thread so the blocking psycopg2 calls don't stall scraping.
+    With an AsyncDatabase, up to one batch per pooled connection is saved at once.
+
+    :param queue: Queue of printer data dictionaries, terminated by END_OF_STREAM
+    :param db: Connected database
+    :param batch_size: Maximum printers per save_printer_data call
+    :param flush_seconds: Maximum time a result waits in a partial batch
+    :return: Number of printers saved
+    """
+    logger = get_logger()
+    metrics = get_registry()
+    saved = 0
+    batch: List[Dict[str, Any]] = []
+    deadline: Optional[float] = None
+    finished = False
+    writers = asyncio.Semaphore(db.max_size if isinstance(db, AsyncDatabase) else 1)
+    pending = set()
+
+    async def flush(items: List[Dict[str, Any]]):
+        nonlocal saved
+        try:
+            count = await save_batch(db, items)
+            saved += count  # Not "saved += await ...", which reads saved before other writers finish
+        except Exception as e:
+            logger.error(f"Failed to save a batch of {len(items)} printers: {e}")
+        finally:
+            writers.release()
+
+    try:
+        while not finished:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                pass  # The partial batch is due, flush it below
+            else:
+                if item is END_OF_STREAM:
+                    finished = True
+                else:
+                    batch.append(item)
+                    if deadline is None:
+                        deadline = time.monotonic() + flush_seconds
+
+            metrics.set_gauge("kyoscan_pipeline_queue_depth", queue.qsize())
+            if batch and (finished or len(batch) >= batch_size or time.monotonic() >= deadline):
+                # Waiting for a free writer is what pushes back on the queue
+                await writers.acquire()
+                task = asyncio.create_task(flush(batch))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+                batch = []
+                deadline = None
+
+        await asyncio.gather(*pending)
+    except BaseException:
+        for task in pending:
+            task.cancel()
+        raise
+
+    return saved
+
+async def run_streaming_pipeline(printer_dict: Dict[str, Optional[str]], db: Union[Storage, AsyncDatabase], max_concurrent: int = 20,
+                                 max_per_host: int = 4, queue_size: int = 200, batch_size: int = 50,
+                                 flush_seconds: float = 2.0) -> int:
+    """
+    Scrape all printers and save them to the database while the scrape is running.
+
+    Results go through a bounded queue: when the writer falls behind, the queue
+    fills up and the scraper waits before handing over more results.
+
+    :param printer_dict: Printer name to IP mapping
+    :param db: Connected database
+    :param max_concurrent: Maximum printers scraped at once
+    :param max_per_host: Maximum concurrent requests per printer
+    :param queue_size: Maximum results waiting to be saved
+    :param batch_size: Maximum printers per database transaction
+    :param flush_seconds: Maximum time a result waits in a partial batch
+    :return: Number of printers saved
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+    writer = asyncio.create_task(write_batches(queue, db, batch_size, flush_seconds))
+
+    try:
+        async for result in stream_printers_data_async(printer_dict, max_concurrent, max_per_host):
+            await queue.put(result)
+        await queue.put(END_OF_STREAM)
+    except BaseException:
+        writer.cancel()
+        raise
+
+    return await writer
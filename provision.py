@@ -0,0 +1,267 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+import httpx
+from config import Config
+from methods import AddressBookClient, AddressBookMirror
+from metrics import get_registry
+
+metrics = get_registry()
+
+def load_spec(path: str) -> Dict[str, Any]:
+    """
+    Read a desired-state spec:
+
+        {"smb_password": "scanner#oki", "prune": false,
+         "printers": {"192.168.11.253": ["192.168.11.235"], ...}}
+
+    Every printer gets exactly one contact for each SMB address listed for it.
+    With prune, SMB contacts for addresses that are not listed are deleted too.
+    """
+    spec = json.loads(Path(path).read_text(encoding="utf-8"))
+    if not isinstance(spec.get('printers'), dict):
+        raise ValueError(f"{path}: expected a 'printers' object of printer IP -> list of SMB addresses")
+    return spec
+
+def spec_digest(spec: Dict[str, Any]) -> str:
+    """Identifies a spec in the progress file, so progress is only resumed for the same spec."""
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode("utf-8")).hexdigest()
+
+def diff_book(book: AddressBookMirror, smb_addresses: List[str], prune: bool = False) -> Dict[str, List]:
+    """
+    Changes that bring an address book to the desired SMB addresses.
+
+    :return: 'adds' (SMB addresses without a contact) and 'deletes' ({'id', 'name', 'smb_host'}
+             of every duplicate but the one with the smallest ID, and with prune of unlisted addresses)
+    """
+    adds = []
+    deletes = []
+    for smb_address in dict.fromkeys(smb_addresses):
+        entries = book.find(smb_address)
+        if not entries:
+            adds.append(smb_address)
+        deletes += [{**entry, 'smb_host': smb_address} for entry in entries[1:]]
+    if prune:
+        for smb_host in sorted(set(book.by_host) - set(smb_addresses)):
+            deletes += [{**entry, 'smb_host': smb_host} for entry in book.find(smb_host)]
+    return {'adds': adds, 'deletes': deletes}
+
+class Provisioner:
+    """
+    Brings the address books of a fleet to a desired-state spec.
+
+    plan reads every printer's address book concurrently and diffs it with the
+    spec; apply then runs each printer's deletes (ten per request) and adds.
+    At most concurrency printers are worked on at once, and the client limits
+    the requests in flight per printer. Changes to one printer are made one at
+    a time: each add takes the printer's first free ID. A failed operation is
+    retried up to retries times, after re-reading the address book, so an add
+    that did reach the printer is not made twice.
+
+    Printers are recorded in the progress file as they are completed; a rerun
+    with the same spec skips them and re-plans the others from their current
+    address book. Once every printer is completed the progress file is removed,
+    so the next run checks every printer again.
+    """
+
+    def __init__(self, client: AddressBookClient, concurrency: int = 20, retries: int = 2,
+                 retry_backoff: float = 0.5, progress_path: Optional[str] = None):
+        self.client = client
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.progress_path = Path(progress_path) if progress_path else None
+
+    @classmethod
+    def from_config(cls, client: AddressBookClient, progress_path: Optional[str] = None) -> "Provisioner":
+        """Create a provisioner with the Config provisioning settings."""
+        return cls(client, Config.PROVISION_CONCURRENCY, Config.PROVISION_RETRIES, Config.RETRY_BACKOFF, progress_path)
+
+    async def backoff(self, attempt: int):
+        """Full jitter, as for endpoint retries."""
+        await asyncio.sleep(random.uniform(0, self.retry_backoff * 2 ** attempt))
+
+    def load_progress(self, digest: str) -> Dict[str, Any]:
+        """Reports of the printers completed by earlier runs of the same spec."""
+        if self.progress_path is None or not self.progress_path.exists():
+            return {}
+        progress = json.loads(self.progress_path.read_text(encoding="utf-8"))
+        return progress['printers'] if progress.get('spec') == digest else {}
+
+    def save_progress(self, digest: str, completed: Dict[str, Any]):
+        """Replace the progress file atomically."""
+        if self.progress_path is None:
+            return
+        temporary = self.progress_path.with_suffix(".tmp")
+        temporary.write_text(json.dumps({'spec': digest, 'printers': completed}, indent=2), encoding="utf-8")
+        os.replace(temporary, self.progress_path)
+
+    def clear_progress(self):
+        """Remove the progress file once a run has completed every printer."""
+        if self.progress_path is not None and self.progress_path.exists():
+            self.progress_path.unlink()
+
+    async def plan_printer(self, printer_ip: str, smb_addresses: List[str], prune: bool) -> Dict[str, Any]:
+        """Diff one printer; status is 'unchanged', 'planned' or 'unreachable'."""
+        book = await self.client.read_book(printer_ip)
+        if book is None:
+            return {'status': 'unreachable', 'entries': None, 'adds': [], 'deletes': []}
+        
+        # A mirror can miss SMB hosts edited in place: re-read the entries the diff relies on
+        changes = diff_book(book, smb_addresses, prune)
+        relied_on = {entry['id'] for smb_address in smb_addresses for entry in book.find(smb_address)}
+        relied_on |= {entry['id'] for entry in changes['deletes']}
+        if relied_on:
+            if not await self.client.recheck_entries(printer_ip, book, sorted(relied_on, key=int)):
+                return {'status': 'unreachable', 'entries': None, 'adds': [], 'deletes': []}
+            changes = diff_book(book, smb_addresses, prune)
+        status = 'planned' if changes['adds'] or changes['deletes'] else 'unchanged'
+        return {'status': status, 'entries': len(book.entries), **changes}
+
+    async def apply_deletes(self, printer_ip: str, deletes: List[Dict[str, str]]) -> List[Dict[str, Any]]:
+        """Delete entries, retrying the ones still listed or not verified; one result per entry."""
+        results = {entry['id']: {**entry, 'ok': False, 'message': None, 'attempts': 0} for entry in deletes}
+        pending = list(results)
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await self.backoff(attempt - 1)
+            outcomes = await self.client.delete_entries(printer_ip, pending)
+            for entry_id, (deleted, message) in outcomes.items():
+                results[entry_id].update(ok=deleted is True, message=message, attempts=attempt + 1)
+            pending = [entry_id for entry_id, (deleted, _) in outcomes.items() if deleted is not True]
+            if not pending:
+                break
+        for result in results.values():
+            metrics.inc("kyoscan_provision_operations_total", kind="delete", outcome="ok" if result['ok'] else "failed")
+        return list(results.values())
+
+    async def apply_add(self, printer_ip: str, smb_address: str, smb_password: str) -> Dict[str, Any]:
+        """Add one SMB contact; before a retry, the address book is re-read in case the add went through."""
+        result = {'smb_address': smb_address, 'ok': False, 'id': None, 'message': None, 'attempts': 0}
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await self.backoff(attempt - 1)
+                book = await self.client.read_book(printer_ip)
+                if book is None:
+                    # The add may have reached the printer: leave it to the next run to plan from a fresh read
+                    result['message'] = f"{result['message']}; not retried, the address book could not be re-read"
+                    break
+                existing = book.find(smb_address)
+                if existing:
+                    result.update(ok=True, id=existing[0]['id'], message="Found after a failed attempt")
+                    break
+            success, outcome, _, _ = await self.client.add_smb_contact(
+                printer_ip, smb_address, smb_password, check_duplicates_first=False)
+            result.update(attempts=attempt + 1)
+            if success:
+                result.update(ok=True, id=outcome, message="Added")
+                break
+            result['message'] = outcome
+        metrics.inc("kyoscan_provision_operations_total", kind="add", outcome="ok" if result['ok'] else "failed")
+        return result
+
+    async def apply_printer(self, printer_ip: str, smb_addresses: List[str], smb_password: str,
+                            prune: bool) -> Dict[str, Any]:
+        """Plan and apply one printer; status is 'unchanged', 'done', 'failed' or 'unreachable'."""
+        report = await self.plan_printer(printer_ip, smb_addresses, prune)
+        if report['status'] != 'planned':
+            return report
+
+        # Deletes first: they free the IDs the adds take
+        report['deletes'] = await self.apply_deletes(printer_ip, report['deletes']) if report['deletes'] else []
+        report['adds'] = [await self.apply_add(printer_ip, smb_address, smb_password) for smb_address in report['adds']]
+        succeeded = all(result['ok'] for result in report['deletes'] + report['adds'])
+        report['status'] = 'done' if succeeded else 'failed'
+        return report
+
+    async def run(self, spec: Dict[str, Any], apply: bool = False) -> Dict[str, Any]:
+        """
+        Plan (or with apply, plan and apply) every printer of the spec.
+
+        :return: Report: mode, start and end times, a summary of statuses and
+                 operations, and the report of each printer
+        """
+        started_at = datetime.now()
+        smb_password = spec.get('smb_password', 'scanner#oki')
+        prune = spec.get('prune', False)
+        digest = spec_digest(spec)
+        completed = self.load_progress(digest) if apply else {}
+        printers: Dict[str, Any] = {}
+
+        async def work(printer_ip: str, smb_addresses: List[str]):
+            if printer_ip in completed:
+                # Its operations were made by an earlier run and are only reported under 'earlier'
+                printers[printer_ip] = {'status': 'resumed', 'entries': completed[printer_ip]['entries'],
+                                        'adds': [], 'deletes': [], 'earlier': completed[printer_ip]}
+                return
+            async with self.semaphore:
+                if apply:
+                    report = await self.apply_printer(printer_ip, smb_addresses, smb_password, prune)
+                else:
+                    report = await self.plan_printer(printer_ip, smb_addresses, prune)
+            printers[printer_ip] = report
+            if apply and report['status'] in ('unchanged', 'done'):
+                completed[printer_ip] = report
+                self.save_progress(digest, completed)
+
+        await asyncio.gather(*(work(printer_ip, smb_addresses) for printer_ip, smb_addresses in spec['printers'].items()))
+        if apply and all(report['status'] in ('unchanged', 'done', 'resumed') for report in printers.values()):
+            self.clear_progress()
+
+        statuses: Dict[str, int] = {}
+        for report in printers.values():
+            statuses[report['status']] = statuses.get(report['status'], 0) + 1
+        return {
+            'mode': 'apply' if apply else 'plan',
+            'started_at': started_at.isoformat(),
+            'finished_at': datetime.now().isoformat(),
+            'summary': {
+                'printers': len(printers),
+                'statuses': statuses,
+                'adds': sum(len(report['adds']) for report in printers.values()),
+                'deletes': sum(len(report['deletes']) for report in printers.values()),
+                'failed_operations': sum(
+                    not result['ok'] for report in printers.values() if report['status'] != 'planned'
+                    for result in report['adds'] + report['deletes']),
+            },
+            'printers': dict(sorted(printers.items())),
+        }
+
+async def provision(spec: Dict[str, Any], apply: bool = False, progress_path: Optional[str] = None,
+                    transport: Optional[httpx.AsyncBaseTransport] = None) -> Dict[str, Any]:
+    """Run a Provisioner on a client sized for its concurrency (transport is for simulated printers)."""
+    connections = Config.PROVISION_CONCURRENCY * Config.MAX_REQUESTS_PER_HOST
+    limits = httpx.Limits(max_keepalive_connections=connections, max_connections=connections)
+    async with httpx.AsyncClient(verify=False, timeout=10.0, limits=limits, transport=transport) as http:
+        client = AddressBookClient(http, Config.MAX_REQUESTS_PER_HOST,
+                                   mirror_dir=Config.ADDRESS_BOOK_MIRROR_DIR or None,
+                                   mirror_max_age=Config.ADDRESS_BOOK_MIRROR_MAX_AGE,
+                                   mirror_full_refresh=Config.ADDRESS_BOOK_MIRROR_FULL_REFRESH)
+        return await Provisioner.from_config(client, progress_path).run(spec, apply)
+
+def main():
+    """Bring the address books of the printers in a spec to the desired SMB contacts."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("spec", help="JSON spec: {\"printers\": {printer IP: [SMB addresses]}, ...}")
+    parser.add_argument("--apply", action="store_true", help="make the changes (default: only plan them)")
+    parser.add_argument("--report", default="-", help="where to write the JSON report (default: stdout)")
+    parser.add_argument("--progress", default="provision_progress.json",
+                        help="progress file, to resume an interrupted --apply")
+    args = parser.parse_args()
+
+    report = asyncio.run(provision(load_spec(args.spec), args.apply, args.progress))
+    text = json.dumps(report, indent=2)
+    if args.report == "-":
+        print(text)
+    else:
+        Path(args.report).write_text(text, encoding="utf-8")
+        print(json.dumps(report['summary']))
+
+if __name__ == "__main__":
+    main()
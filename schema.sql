@@ -5,20 +5,41 @@ CREATE TABLE IF NOT EXISTS devices (
     first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Installs created before partitioning: move the plain tables aside,
+-- their rows are copied into the partitioned tables at the end of this file
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_class WHERE oid = to_regclass('device_history') AND relkind = 'r') THEN
+        ALTER TABLE device_history RENAME TO device_history_unpartitioned;
+        ALTER SEQUENCE IF EXISTS device_history_id_seq RENAME TO device_history_unpartitioned_id_seq;
+        DROP INDEX IF EXISTS idx_history_device_time, idx_history_device_timestamp;
+    END IF;
+    IF EXISTS (SELECT 1 FROM pg_class WHERE oid = to_regclass('device_logs') AND relkind = 'r') THEN
+        ALTER TABLE device_logs RENAME TO device_logs_unpartitioned;
+        ALTER SEQUENCE IF EXISTS device_logs_id_seq RENAME TO device_logs_unpartitioned_id_seq;
+        DROP INDEX IF EXISTS idx_logs_device_time, idx_logs_device_timestamp;
+    END IF;
+END $$;
+
+-- device_history and device_logs are partitioned by month (see kyoscan_ensure_partitions);
+-- rows outside every monthly partition land in the _default partition
 CREATE TABLE IF NOT EXISTS device_history (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     device_id INTEGER REFERENCES devices(id),
-    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
     device_name VARCHAR(255),
     ip_address INET,
     mac_address VARCHAR(17),
-    hostname VARCHAR(255)
-);
+    hostname VARCHAR(255),
+    PRIMARY KEY (id, timestamp)
+) PARTITION BY RANGE (timestamp);
+
+CREATE TABLE IF NOT EXISTS device_history_default PARTITION OF device_history DEFAULT;
 
 CREATE TABLE IF NOT EXISTS device_logs (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     device_id INTEGER REFERENCES devices(id),
-    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
     status VARCHAR(20),
     toner_level SMALLINT,
     printer_copy_bw INTEGER,
@@ -26,8 +47,15 @@ CREATE TABLE IF NOT EXISTS device_logs (
     printer_fax_bw INTEGER,
     scanner_copy INTEGER,
     scanner_bw INTEGER,
-    scanner_other INTEGER
-);
+    scanner_other INTEGER,
+    -- Change-only logging (Config.DB_DELTA_LOGS): last poll that read the same values
+    valid_until TIMESTAMP,
+    PRIMARY KEY (id, timestamp)
+) PARTITION BY RANGE (timestamp);
+
+CREATE TABLE IF NOT EXISTS device_logs_default PARTITION OF device_logs DEFAULT;
+
+ALTER TABLE device_logs ADD COLUMN IF NOT EXISTS valid_until TIMESTAMP;
 
 CREATE TABLE IF NOT EXISTS device_current_state (
     device_id INTEGER PRIMARY KEY REFERENCES devices(id),
@@ -43,18 +71,502 @@ CREATE TABLE IF NOT EXISTS device_current_state (
     scanner_copy INTEGER,
     scanner_bw INTEGER,
     scanner_other INTEGER,
-    last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,  -- Last time a value changed
     toner_alert BOOLEAN DEFAULT FALSE,
     offline_alert BOOLEAN DEFAULT FALSE
+) WITH (fillfactor = 80);
+
+-- Free space on each page lets the remaining updates stay HOT (no index entries, pruned in place);
+-- only device_id is indexed, so any column may change without touching an index
+ALTER TABLE device_current_state SET (fillfactor = 80);
+DROP INDEX IF EXISTS idx_current_toner, idx_current_status;
+
+-- Time of the latest poll of each device, touched on every save while
+-- device_current_state is only rewritten when a value changes
+CREATE TABLE IF NOT EXISTS device_last_seen (
+    device_id INTEGER PRIMARY KEY REFERENCES devices(id),
+    last_seen TIMESTAMP NOT NULL
+) WITH (fillfactor = 50);
+
+INSERT INTO device_last_seen (device_id, last_seen)
+SELECT device_id, last_updated FROM device_current_state WHERE last_updated IS NOT NULL
+ON CONFLICT (device_id) DO NOTHING;
+
+-- Hourly and daily rollups of device_logs, maintained by trg_device_logs_rollup;
+-- *_last is the latest non-null reading in the bucket
+CREATE TABLE IF NOT EXISTS device_logs_hourly (
+    device_id INTEGER REFERENCES devices(id),
+    bucket TIMESTAMP NOT NULL,
+    samples INTEGER NOT NULL,
+    last_at TIMESTAMP NOT NULL,
+    last_status VARCHAR(20),
+    toner_level_min SMALLINT, toner_level_max SMALLINT, toner_level_last SMALLINT,
+    printer_copy_bw_min INTEGER, printer_copy_bw_max INTEGER, printer_copy_bw_last INTEGER,
+    printer_printer_bw_min INTEGER, printer_printer_bw_max INTEGER, printer_printer_bw_last INTEGER,
+    printer_fax_bw_min INTEGER, printer_fax_bw_max INTEGER, printer_fax_bw_last INTEGER,
+    scanner_copy_min INTEGER, scanner_copy_max INTEGER, scanner_copy_last INTEGER,
+    scanner_bw_min INTEGER, scanner_bw_max INTEGER, scanner_bw_last INTEGER,
+    scanner_other_min INTEGER, scanner_other_max INTEGER, scanner_other_last INTEGER,
+    PRIMARY KEY (device_id, bucket)
+);
+
+CREATE TABLE IF NOT EXISTS device_logs_daily (
+    device_id INTEGER REFERENCES devices(id),
+    bucket TIMESTAMP NOT NULL,
+    samples INTEGER NOT NULL,
+    last_at TIMESTAMP NOT NULL,
+    last_status VARCHAR(20),
+    toner_level_min SMALLINT, toner_level_max SMALLINT, toner_level_last SMALLINT,
+    printer_copy_bw_min INTEGER, printer_copy_bw_max INTEGER, printer_copy_bw_last INTEGER,
+    printer_printer_bw_min INTEGER, printer_printer_bw_max INTEGER, printer_printer_bw_last INTEGER,
+    printer_fax_bw_min INTEGER, printer_fax_bw_max INTEGER, printer_fax_bw_last INTEGER,
+    scanner_copy_min INTEGER, scanner_copy_max INTEGER, scanner_copy_last INTEGER,
+    scanner_bw_min INTEGER, scanner_bw_max INTEGER, scanner_bw_last INTEGER,
+    scanner_other_min INTEGER, scanner_other_max INTEGER, scanner_other_last INTEGER,
+    PRIMARY KEY (device_id, bucket)
+);
+
+-- Pages (and scans) per device and day: the counter increases between consecutive non-null
+-- readings, a reading below the previous one counting as a reset to zero. *_last is the latest
+-- reading up to the end of the day, carried over days without one, so a day can be recomputed
+-- from the previous row alone. Refreshed by kyoscan_refresh_usage()
+CREATE TABLE IF NOT EXISTS device_usage_daily (
+    device_id INTEGER REFERENCES devices(id),
+    day DATE NOT NULL,
+    samples INTEGER NOT NULL,
+    resets INTEGER NOT NULL,
+    printer_copy_bw BIGINT, printer_copy_bw_last INTEGER,
+    printer_printer_bw BIGINT, printer_printer_bw_last INTEGER,
+    printer_fax_bw BIGINT, printer_fax_bw_last INTEGER,
+    scanner_copy BIGINT, scanner_copy_last INTEGER,
+    scanner_bw BIGINT, scanner_bw_last INTEGER,
+    scanner_other BIGINT, scanner_other_last INTEGER,
+    PRIMARY KEY (device_id, day)
+);
+
+-- device_usage_daily summed per month, for month/quarter/year queries
+CREATE TABLE IF NOT EXISTS device_usage_monthly (
+    device_id INTEGER REFERENCES devices(id),
+    month DATE NOT NULL,
+    samples INTEGER NOT NULL,
+    resets INTEGER NOT NULL,
+    printer_copy_bw BIGINT,
+    printer_printer_bw BIGINT,
+    printer_fax_bw BIGINT,
+    scanner_copy BIGINT,
+    scanner_bw BIGINT,
+    scanner_other BIGINT,
+    PRIMARY KEY (device_id, month)
+);
+
+-- Spooled batches already saved, by the id spool.py gives each one (see CLAIM_BATCH in database.py)
+CREATE TABLE IF NOT EXISTS saved_batches (
+    batch_id VARCHAR(32) PRIMARY KEY,
+    saved_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS device_usage_refresh (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    refreshed_at TIMESTAMP NOT NULL
 );
 
 CREATE INDEX IF NOT EXISTS idx_history_device_time ON device_history(device_id, timestamp DESC);
-CREATE INDEX IF NOT EXISTS idx_history_device_timestamp ON device_history(timestamp DESC);
+-- A device can have several readings at the same time (e.g. twice in one batch). Installs that
+-- got a unique index here get the plain one back; replays are deduplicated by saved_batches
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_index WHERE indexrelid = to_regclass('idx_logs_device_time') AND indisunique) THEN
+        DROP INDEX idx_logs_device_time;
+    END IF;
+END $$;
 CREATE INDEX IF NOT EXISTS idx_logs_device_time ON device_logs(device_id, timestamp DESC);
-CREATE INDEX IF NOT EXISTS idx_logs_device_timestamp ON device_logs(timestamp DESC);
-CREATE INDEX IF NOT EXISTS idx_current_toner ON device_current_state(toner_level) WHERE toner_level IS NOT NULL;
-CREATE INDEX IF NOT EXISTS idx_current_status ON device_current_state(status);
+-- Rows arrive in time order, so a BRIN index covers time ranges at a fraction of a B-tree's size
+CREATE INDEX IF NOT EXISTS idx_history_timestamp_brin ON device_history USING BRIN (timestamp);
+CREATE INDEX IF NOT EXISTS idx_logs_timestamp_brin ON device_logs USING BRIN (timestamp);
+CREATE INDEX IF NOT EXISTS idx_usage_day ON device_usage_daily(day);
+CREATE INDEX IF NOT EXISTS idx_usage_month ON device_usage_monthly(month);
+
+-- Create the monthly partition of parent holding month (e.g. device_logs_p2024_05),
+-- moving any rows that already landed in the default partition into it
+CREATE OR REPLACE FUNCTION kyoscan_ensure_partition(parent TEXT, month DATE) RETURNS TEXT AS $$
+DECLARE
+    month_start DATE := date_trunc('month', month)::DATE;
+    month_end DATE := (date_trunc('month', month) + INTERVAL '1 month')::DATE;
+    partition_name TEXT := format('%s_p%s', parent, to_char(month, 'YYYY_MM'));
+BEGIN
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN partition_name;
+    END IF;
+
+    PERFORM pg_advisory_xact_lock(hashtext(partition_name));
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN partition_name;  -- Created by a concurrent collector while we waited
+    END IF;
+
+    EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', partition_name, parent);
+    EXECUTE format('WITH moved AS (DELETE FROM %I WHERE timestamp >= %L AND timestamp < %L RETURNING *) '
+                   'INSERT INTO %I SELECT * FROM moved',
+                   parent || '_default', month_start, month_end, partition_name);
+    EXECUTE format('ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                   parent, partition_name, month_start, month_end);
+    RETURN partition_name;
+END $$ LANGUAGE plpgsql;
+
+-- Partitions of both time-series tables for the month of ts and months_ahead months after it
+CREATE OR REPLACE FUNCTION kyoscan_ensure_partitions(ts TIMESTAMP, months_ahead INTEGER DEFAULT 1) RETURNS VOID AS $$
+DECLARE
+    parent TEXT;
+    month_offset INTEGER;
+BEGIN
+    FOREACH parent IN ARRAY ARRAY['device_history', 'device_logs'] LOOP
+        FOR month_offset IN 0..months_ahead LOOP
+            PERFORM kyoscan_ensure_partition(parent, (ts + make_interval(months => month_offset))::DATE);
+        END LOOP;
+    END LOOP;
+END $$ LANGUAGE plpgsql;
+
+-- Drop the monthly partitions of parent that end before the start of
+-- the current month minus keep_months; returns the dropped tables
+CREATE OR REPLACE FUNCTION kyoscan_drop_partitions(parent TEXT, keep_months INTEGER) RETURNS SETOF TEXT AS $$
+DECLARE
+    cutoff DATE := (date_trunc('month', now()) - make_interval(months => keep_months))::DATE;
+    partition_name TEXT;
+BEGIN
+    FOR partition_name IN
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = parent::regclass
+          AND c.relname ~ ('^' || parent || '_p\d{4}_\d{2}$')
+          AND to_date(right(c.relname, 7), 'YYYY_MM') < cutoff
+        ORDER BY c.relname
+    LOOP
+        EXECUTE format('DROP TABLE %I', partition_name);
+        RETURN NEXT partition_name;
+    END LOOP;
+END $$ LANGUAGE plpgsql;
+
+-- Statement folding the rows of one INSERT or UPDATE (the new_rows transition table) into a
+-- rollup table, one bucket of time_column per device and unit; run by the trigger itself,
+-- which alone can see new_rows
+DROP FUNCTION IF EXISTS kyoscan_rollup_sql(TEXT, TEXT);
+CREATE OR REPLACE FUNCTION kyoscan_rollup_sql(rollup TEXT, unit TEXT, time_column TEXT) RETURNS TEXT AS $$
+DECLARE
+    metrics TEXT[] := ARRAY['toner_level', 'printer_copy_bw', 'printer_printer_bw', 'printer_fax_bw',
+                            'scanner_copy', 'scanner_bw', 'scanner_other'];
+    columns TEXT := '';
+    aggregates TEXT := '';
+    updates TEXT := '';
+    metric TEXT;
+BEGIN
+    FOREACH metric IN ARRAY metrics LOOP
+        columns := columns || format(', %1$I, %2$I, %3$I', metric || '_min', metric || '_max', metric || '_last');
+        aggregates := aggregates || format(
+            ', min(%1$I), max(%1$I), (array_agg(%1$I ORDER BY %2$I DESC, id DESC) FILTER (WHERE %1$I IS NOT NULL))[1]',
+            metric, time_column);
+        updates := updates || format(
+            ', %1$I = LEAST(r.%1$I, EXCLUDED.%1$I), %2$I = GREATEST(r.%2$I, EXCLUDED.%2$I), '
+            '%3$I = CASE WHEN EXCLUDED.last_at >= r.last_at THEN COALESCE(EXCLUDED.%3$I, r.%3$I) '
+            'ELSE COALESCE(r.%3$I, EXCLUDED.%3$I) END',
+            metric || '_min', metric || '_max', metric || '_last');
+    END LOOP;
+
+    RETURN format(
+        'INSERT INTO %1$I AS r (device_id, bucket, samples, last_at, last_status%2$s) '
+        'SELECT device_id, date_trunc(%3$L, %6$I), count(*), max(%6$I), '
+        '(array_agg(status ORDER BY %6$I DESC, id DESC))[1]%4$s '
+        'FROM new_rows WHERE device_id IS NOT NULL AND %6$I IS NOT NULL GROUP BY 1, 2 '
+        'ON CONFLICT (device_id, bucket) DO UPDATE SET samples = r.samples + EXCLUDED.samples, '
+        'last_status = CASE WHEN EXCLUDED.last_at >= r.last_at THEN EXCLUDED.last_status ELSE r.last_status END, '
+        'last_at = GREATEST(r.last_at, EXCLUDED.last_at)%5$s',
+        rollup, columns, unit, aggregates, updates, time_column);
+END $$ LANGUAGE plpgsql IMMUTABLE;
+
+-- Inserted rows count at their timestamp; a poll that only extended a row
+-- (change-only logging) counts at the row's new valid_until
+CREATE OR REPLACE FUNCTION kyoscan_device_logs_rollup() RETURNS TRIGGER AS $$
+DECLARE
+    time_column TEXT := CASE TG_OP WHEN 'UPDATE' THEN 'valid_until' ELSE 'timestamp' END;
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM new_rows) THEN
+        RETURN NULL;
+    END IF;
+    EXECUTE kyoscan_rollup_sql('device_logs_hourly', 'hour', time_column);
+    EXECUTE kyoscan_rollup_sql('device_logs_daily', 'day', time_column);
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_device_logs_rollup ON device_logs;
+CREATE TRIGGER trg_device_logs_rollup
+    AFTER INSERT ON device_logs
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION kyoscan_device_logs_rollup();
+
+DROP TRIGGER IF EXISTS trg_device_logs_rollup_extend ON device_logs;
+CREATE TRIGGER trg_device_logs_rollup_extend
+    AFTER UPDATE ON device_logs
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION kyoscan_device_logs_rollup();
+
+-- Each logged reading and the period it is known to have held: from its timestamp to the last
+-- poll that read the same values (valid_until), or only at its timestamp when every poll is logged
+CREATE OR REPLACE VIEW device_log_intervals AS
+SELECT
+    l.id,
+    l.device_id,
+    l.timestamp AS valid_from,
+    COALESCE(l.valid_until, l.timestamp) AS valid_until,
+    lead(l.timestamp) OVER (PARTITION BY l.device_id ORDER BY l.timestamp, l.id) AS next_change,
+    l.status,
+    l.toner_level,
+    l.printer_copy_bw,
+    l.printer_printer_bw,
+    l.printer_fax_bw,
+    l.scanner_copy,
+    l.scanner_bw,
+    l.scanner_other
+FROM device_logs l;
+
+-- The full time series of one device, sampled every step: the reading in effect at each
+-- point in time, whichever logging mode wrote it. last_seen tells how fresh it was
+CREATE OR REPLACE FUNCTION kyoscan_log_series(device INTEGER, start_at TIMESTAMP, end_at TIMESTAMP, step INTERVAL)
+RETURNS TABLE (
+    at TIMESTAMP, last_seen TIMESTAMP, status VARCHAR(20), toner_level SMALLINT,
+    printer_copy_bw INTEGER, printer_printer_bw INTEGER, printer_fax_bw INTEGER,
+    scanner_copy INTEGER, scanner_bw INTEGER, scanner_other INTEGER
+) AS $$
+    SELECT t, CASE WHEN l.id IS NOT NULL THEN LEAST(COALESCE(l.valid_until, l.timestamp), t) END, l.status, l.toner_level,
+           l.printer_copy_bw, l.printer_printer_bw, l.printer_fax_bw,
+           l.scanner_copy, l.scanner_bw, l.scanner_other
+    FROM generate_series(start_at, end_at, step) AS t
+    LEFT JOIN LATERAL (
+        SELECT * FROM device_logs
+        WHERE device_id = device AND timestamp <= t
+        ORDER BY timestamp DESC, id DESC
+        LIMIT 1
+    ) l ON TRUE
+    ORDER BY t;
+$$ LANGUAGE sql STABLE;
+
+-- Recompute device_usage_daily for one day from its device_logs rows and each device's previous
+-- summary row; returns the number of devices with readings that day
+CREATE OR REPLACE FUNCTION kyoscan_refresh_usage_day(refresh_day DATE) RETURNS INTEGER AS $$
+DECLARE
+    refreshed INTEGER;
+BEGIN
+    INSERT INTO device_usage_daily AS u (
+        device_id, day, samples, resets,
+        printer_copy_bw, printer_copy_bw_last, printer_printer_bw, printer_printer_bw_last,
+        printer_fax_bw, printer_fax_bw_last, scanner_copy, scanner_copy_last,
+        scanner_bw, scanner_bw_last, scanner_other, scanner_other_last
+    )
+    WITH day_rows AS (
+        SELECT * FROM device_logs
+        WHERE timestamp >= refresh_day AND timestamp < refresh_day + 1 AND device_id IS NOT NULL
+    ), previous AS (
+        SELECT p.*
+        FROM (SELECT DISTINCT device_id FROM day_rows) d
+        CROSS JOIN LATERAL (
+            SELECT * FROM device_usage_daily
+            WHERE device_id = d.device_id AND day < refresh_day
+            ORDER BY day DESC
+            LIMIT 1
+        ) p
+    ), readings AS (
+        -- One row per non-null counter reading, the previous day's last readings first
+        SELECT p.device_id, NULL::TIMESTAMP AS timestamp, 0 AS id, c.counter, c.value
+        FROM previous p
+        CROSS JOIN LATERAL (VALUES
+            ('printer_copy_bw', p.printer_copy_bw_last), ('printer_printer_bw', p.printer_printer_bw_last),
+            ('printer_fax_bw', p.printer_fax_bw_last), ('scanner_copy', p.scanner_copy_last),
+            ('scanner_bw', p.scanner_bw_last), ('scanner_other', p.scanner_other_last)
+        ) c(counter, value)
+        WHERE c.value IS NOT NULL
+        UNION ALL
+        SELECT l.device_id, l.timestamp, l.id, c.counter, c.value
+        FROM day_rows l
+        CROSS JOIN LATERAL (VALUES
+            ('printer_copy_bw', l.printer_copy_bw), ('printer_printer_bw', l.printer_printer_bw),
+            ('printer_fax_bw', l.printer_fax_bw), ('scanner_copy', l.scanner_copy),
+            ('scanner_bw', l.scanner_bw), ('scanner_other', l.scanner_other)
+        ) c(counter, value)
+        WHERE c.value IS NOT NULL
+    ), deltas AS (
+        SELECT device_id, timestamp, id, counter, value,
+               lag(value) OVER (PARTITION BY device_id, counter ORDER BY timestamp NULLS FIRST, id) AS previous
+        FROM readings
+    ), usage AS (
+        SELECT device_id, counter,
+               sum(CASE WHEN previous IS NULL THEN 0 WHEN value >= previous THEN value - previous ELSE value END) AS pages,
+               (array_agg(value ORDER BY timestamp DESC NULLS LAST, id DESC))[1] AS last_value,
+               count(*) FILTER (WHERE value < previous) AS resets
+        FROM deltas
+        GROUP BY device_id, counter
+    )
+    SELECT d.device_id, refresh_day,
+           (SELECT count(*) FROM day_rows l WHERE l.device_id = d.device_id),
+           COALESCE(sum(u.resets), 0),
+           max(u.pages) FILTER (WHERE u.counter = 'printer_copy_bw'), max(u.last_value) FILTER (WHERE u.counter = 'printer_copy_bw'),
+           max(u.pages) FILTER (WHERE u.counter = 'printer_printer_bw'), max(u.last_value) FILTER (WHERE u.counter = 'printer_printer_bw'),
+           max(u.pages) FILTER (WHERE u.counter = 'printer_fax_bw'), max(u.last_value) FILTER (WHERE u.counter = 'printer_fax_bw'),
+           max(u.pages) FILTER (WHERE u.counter = 'scanner_copy'), max(u.last_value) FILTER (WHERE u.counter = 'scanner_copy'),
+           max(u.pages) FILTER (WHERE u.counter = 'scanner_bw'), max(u.last_value) FILTER (WHERE u.counter = 'scanner_bw'),
+           max(u.pages) FILTER (WHERE u.counter = 'scanner_other'), max(u.last_value) FILTER (WHERE u.counter = 'scanner_other')
+    FROM (SELECT DISTINCT device_id FROM day_rows) d
+    LEFT JOIN usage u ON u.device_id = d.device_id
+    GROUP BY d.device_id
+    ON CONFLICT (device_id, day) DO UPDATE SET
+        samples = EXCLUDED.samples,
+        resets = EXCLUDED.resets,
+        printer_copy_bw = EXCLUDED.printer_copy_bw, printer_copy_bw_last = EXCLUDED.printer_copy_bw_last,
+        printer_printer_bw = EXCLUDED.printer_printer_bw, printer_printer_bw_last = EXCLUDED.printer_printer_bw_last,
+        printer_fax_bw = EXCLUDED.printer_fax_bw, printer_fax_bw_last = EXCLUDED.printer_fax_bw_last,
+        scanner_copy = EXCLUDED.scanner_copy, scanner_copy_last = EXCLUDED.scanner_copy_last,
+        scanner_bw = EXCLUDED.scanner_bw, scanner_bw_last = EXCLUDED.scanner_bw_last,
+        scanner_other = EXCLUDED.scanner_other, scanner_other_last = EXCLUDED.scanner_other_last;
+
+    GET DIAGNOSTICS refreshed = ROW_COUNT;
+    RETURN refreshed;
+END $$ LANGUAGE plpgsql;
+
+-- Bring device_usage_daily and device_usage_monthly up to date: every day from since (default: the day of the previous
+-- refresh, less an hour for saves that committed late; on the first run, the first log) to today.
+-- Returns the number of device-days written
+CREATE OR REPLACE FUNCTION kyoscan_refresh_usage(since DATE DEFAULT NULL) RETURNS INTEGER AS $$
+DECLARE
+    started TIMESTAMP := LOCALTIMESTAMP;
+    refresh_day DATE;
+    refreshed INTEGER := 0;
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('kyoscan_refresh_usage'));
+
+    IF since IS NULL THEN
+        SELECT (refreshed_at - INTERVAL '1 hour')::DATE INTO since FROM device_usage_refresh;
+    END IF;
+    IF since IS NULL THEN
+        SELECT min(timestamp)::DATE INTO since FROM device_logs;
+    END IF;
+
+    refresh_day := since;
+    WHILE refresh_day <= started::DATE LOOP
+        refreshed := refreshed + kyoscan_refresh_usage_day(refresh_day);
+        refresh_day := refresh_day + 1;
+    END LOOP;
+
+    INSERT INTO device_usage_monthly AS m (
+        device_id, month, samples, resets,
+        printer_copy_bw, printer_printer_bw, printer_fax_bw, scanner_copy, scanner_bw, scanner_other
+    )
+    SELECT device_id, date_trunc('month', day)::DATE, sum(samples), sum(resets),
+           sum(printer_copy_bw), sum(printer_printer_bw), sum(printer_fax_bw),
+           sum(scanner_copy), sum(scanner_bw), sum(scanner_other)
+    FROM device_usage_daily
+    WHERE day >= date_trunc('month', since)
+    GROUP BY 1, 2
+    ON CONFLICT (device_id, month) DO UPDATE SET
+        samples = EXCLUDED.samples,
+        resets = EXCLUDED.resets,
+        printer_copy_bw = EXCLUDED.printer_copy_bw,
+        printer_printer_bw = EXCLUDED.printer_printer_bw,
+        printer_fax_bw = EXCLUDED.printer_fax_bw,
+        scanner_copy = EXCLUDED.scanner_copy,
+        scanner_bw = EXCLUDED.scanner_bw,
+        scanner_other = EXCLUDED.scanner_other;
+
+    INSERT INTO device_usage_refresh (id, refreshed_at) VALUES (TRUE, started)
+    ON CONFLICT (id) DO UPDATE SET refreshed_at = EXCLUDED.refreshed_at;
+    RETURN refreshed;
+END $$ LANGUAGE plpgsql;
+
+SELECT kyoscan_ensure_partitions(CURRENT_TIMESTAMP::TIMESTAMP);
+
+-- Copy the rows of pre-partitioning tables (also backfilling the rollups) and drop the old tables
+DO $$
+DECLARE
+    first_month DATE;
+    last_month DATE;
+BEGIN
+    IF to_regclass('device_history_unpartitioned') IS NOT NULL THEN
+        SELECT date_trunc('month', min(timestamp)), max(timestamp) INTO first_month, last_month FROM device_history_unpartitioned;
+        WHILE first_month <= last_month LOOP
+            PERFORM kyoscan_ensure_partition('device_history', first_month);
+            first_month := first_month + INTERVAL '1 month';
+        END LOOP;
+        INSERT INTO device_history (id, device_id, timestamp, device_name, ip_address, mac_address, hostname)
+        SELECT id, device_id, COALESCE(timestamp, CURRENT_TIMESTAMP), device_name, ip_address, mac_address, hostname
+        FROM device_history_unpartitioned;
+        PERFORM setval(pg_get_serial_sequence('device_history', 'id'), COALESCE((SELECT max(id) FROM device_history), 0) + 1, false);
+        DROP TABLE device_history_unpartitioned;
+    END IF;
+
+    IF to_regclass('device_logs_unpartitioned') IS NOT NULL THEN
+        SELECT date_trunc('month', min(timestamp)), max(timestamp) INTO first_month, last_month FROM device_logs_unpartitioned;
+        WHILE first_month <= last_month LOOP
+            PERFORM kyoscan_ensure_partition('device_logs', first_month);
+            first_month := first_month + INTERVAL '1 month';
+        END LOOP;
+        INSERT INTO device_logs (id, device_id, timestamp, status, toner_level,
+                                 printer_copy_bw, printer_printer_bw, printer_fax_bw,
+                                 scanner_copy, scanner_bw, scanner_other)
+        SELECT id, device_id, COALESCE(timestamp, CURRENT_TIMESTAMP), status, toner_level,
+               printer_copy_bw, printer_printer_bw, printer_fax_bw,
+               scanner_copy, scanner_bw, scanner_other
+        FROM device_logs_unpartitioned
+        ORDER BY timestamp, id;
+        PERFORM setval(pg_get_serial_sequence('device_logs', 'id'), COALESCE((SELECT max(id) FROM device_logs), 0) + 1, false);
+        DROP TABLE device_logs_unpartitioned;
+    END IF;
+END $$;
+
+-- Toner depletion forecast per device, recomputed from device_logs_daily by forecast.py;
+-- fitted on the readings since the last cartridge change, NULL estimates when there are too few
+CREATE TABLE IF NOT EXISTS device_toner_forecast (
+    device_id INTEGER PRIMARY KEY REFERENCES devices(id),
+    computed_at TIMESTAMP NOT NULL,
+    samples INTEGER NOT NULL,       -- Days fitted
+    toner_level SMALLINT,           -- Latest reading
+    depletion_per_day REAL,         -- Toner percent used per day
+    days_to_empty REAL,
+    empty_at TIMESTAMP,
+    pages_per_percent REAL          -- Pages printed per percent of toner
+);
+
+CREATE INDEX IF NOT EXISTS idx_forecast_empty_at ON device_toner_forecast(empty_at);
+
+-- Alerts raised per device, kept by the alert engine (alerts.py); one row per device and alert
+-- ('toner_low', 'offline', 'offline_sustained'), since = when it was last raised or cleared
+CREATE TABLE IF NOT EXISTS alert_state (
+    device_id INTEGER NOT NULL REFERENCES devices(id),
+    alert TEXT NOT NULL,
+    active BOOLEAN NOT NULL,
+    since TIMESTAMP NOT NULL,
+    PRIMARY KEY (device_id, alert)
+);
+
+-- The sustained-offline check runs on every save and only looks at active offline alerts
+CREATE INDEX IF NOT EXISTS idx_alert_state_offline ON alert_state(since) WHERE alert = 'offline' AND active;
+
+-- Every raised/cleared transition; consumers read the events after the last id they handled
+CREATE TABLE IF NOT EXISTS alert_events (
+    id BIGSERIAL PRIMARY KEY,
+    device_id INTEGER NOT NULL REFERENCES devices(id),
+    alert TEXT NOT NULL,
+    event TEXT NOT NULL CHECK (event IN ('raised', 'cleared')),
+    at TIMESTAMP NOT NULL,
+    value TEXT
+);
+
+CREATE INDEX IF NOT EXISTS idx_alert_events_device ON alert_events(device_id, id);
+
+-- Alerts already raised before the engine ran start out active, without an event
+INSERT INTO alert_state (device_id, alert, active, since)
+SELECT device_id, 'toner_low', TRUE, last_updated FROM device_current_state WHERE toner_alert
+UNION ALL
+SELECT device_id, 'offline', TRUE, last_updated FROM device_current_state WHERE offline_alert
+ON CONFLICT (device_id, alert) DO NOTHING;
 
+-- toner_alert and offline_alert are computed on save with Config.ALERT_TONER_THRESHOLD;
+-- offline_sustained is set once a device has been offline for Config.ALERT_OFFLINE_HOURS
 CREATE OR REPLACE VIEW devices_alert_view AS
 SELECT
     d.serial_number,
@@ -63,15 +575,14 @@ SELECT
     dcs.hostname,
     dcs.toner_level,
     dcs.status,
-    dcs.last_updated,
-    CASE
-        WHEN dcs.toner_level IS NOT NULL AND dcs.toner_level < 10 THEN TRUE
-        ELSE FALSE
-    END AS toner_alert,
-    CASE
-        WHEN dcs.status = 'Offline' THEN TRUE
-        ELSE FALSE
-    END AS offline_alert
+    COALESCE(ls.last_seen, dcs.last_updated) AS last_updated,
+    COALESCE(dcs.toner_alert, FALSE) AS toner_alert,
+    COALESCE(dcs.offline_alert, FALSE) AS offline_alert,
+    off.since AS offline_since,
+    COALESCE(sus.active, FALSE) AS offline_sustained
 FROM device_current_state dcs
 JOIN devices d ON d.id = dcs.device_id
-WHERE (dcs.toner_level IS NOT NULL AND dcs.toner_level < 10) OR dcs.status = 'Offline';
\ No newline at end of file
+LEFT JOIN device_last_seen ls ON ls.device_id = dcs.device_id
+LEFT JOIN alert_state off ON off.device_id = dcs.device_id AND off.alert = 'offline' AND off.active
+LEFT JOIN alert_state sus ON sus.device_id = dcs.device_id AND sus.alert = 'offline_sustained' AND sus.active
+WHERE dcs.toner_alert OR dcs.offline_alert;
@@ -0,0 +1,97 @@
+-- Embedded storage for edge collectors (SQLiteDatabase): the tables a save writes, with the
+-- same columns and meaning as schema.sql. Partitions, rollups, usage summaries, forecasts and
+-- alert events stay on the PostgreSQL side, where ship.py sends the rows saved here.
+-- Applied on every connect, so it must stay rerunnable.
+
+CREATE TABLE IF NOT EXISTS devices (
+    id INTEGER PRIMARY KEY,
+    serial_number TEXT UNIQUE NOT NULL,
+    mac_address TEXT,
+    first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS device_history (
+    id INTEGER PRIMARY KEY,
+    device_id INTEGER REFERENCES devices(id),
+    timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    device_name TEXT,
+    ip_address TEXT,
+    mac_address TEXT,
+    hostname TEXT
+);
+
+CREATE TABLE IF NOT EXISTS device_logs (
+    id INTEGER PRIMARY KEY,
+    device_id INTEGER REFERENCES devices(id),
+    timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    status TEXT,
+    toner_level INTEGER,
+    printer_copy_bw INTEGER,
+    printer_printer_bw INTEGER,
+    printer_fax_bw INTEGER,
+    scanner_copy INTEGER,
+    scanner_bw INTEGER,
+    scanner_other INTEGER,
+    -- Change-only logging (Config.DB_DELTA_LOGS): last poll that read the same values
+    valid_until TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS device_current_state (
+    device_id INTEGER PRIMARY KEY REFERENCES devices(id),
+    device_name TEXT,
+    ip_address TEXT,
+    mac_address TEXT,
+    hostname TEXT,
+    status TEXT,
+    toner_level INTEGER,
+    printer_copy_bw INTEGER,
+    printer_printer_bw INTEGER,
+    printer_fax_bw INTEGER,
+    scanner_copy INTEGER,
+    scanner_bw INTEGER,
+    scanner_other INTEGER,
+    last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,  -- Last time a value changed
+    toner_alert BOOLEAN DEFAULT FALSE,
+    offline_alert BOOLEAN DEFAULT FALSE
+);
+
+CREATE TABLE IF NOT EXISTS device_last_seen (
+    device_id INTEGER PRIMARY KEY REFERENCES devices(id),
+    last_seen TIMESTAMP NOT NULL
+);
+
+-- Spooled batches already saved, by the id spool.py gives each one
+CREATE TABLE IF NOT EXISTS saved_batches (
+    batch_id TEXT PRIMARY KEY,
+    saved_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Highest id of device_history and device_logs shipped to the PostgreSQL server (ship.py)
+CREATE TABLE IF NOT EXISTS ship_watermarks (
+    table_name TEXT PRIMARY KEY,
+    last_id INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_history_device_time ON device_history(device_id, timestamp DESC);
+CREATE INDEX IF NOT EXISTS idx_history_name_time ON device_history(device_name, timestamp DESC);
+-- A device can have several readings at the same time; idx_logs_device_time was unique in
+-- some installs and is replaced, replays are deduplicated by saved_batches
+DROP INDEX IF EXISTS idx_logs_device_time;
+CREATE INDEX IF NOT EXISTS idx_logs_device_timestamp ON device_logs(device_id, timestamp DESC);
+CREATE INDEX IF NOT EXISTS idx_logs_timestamp ON device_logs(timestamp);
+
+CREATE VIEW IF NOT EXISTS devices_alert_view AS
+SELECT
+    d.serial_number,
+    dcs.device_name,
+    dcs.ip_address,
+    dcs.hostname,
+    dcs.toner_level,
+    dcs.status,
+    COALESCE(ls.last_seen, dcs.last_updated) AS last_updated,
+    COALESCE(dcs.toner_alert, FALSE) AS toner_alert,
+    COALESCE(dcs.offline_alert, FALSE) AS offline_alert
+FROM device_current_state dcs
+JOIN devices d ON d.id = dcs.device_id
+LEFT JOIN device_last_seen ls ON ls.device_id = dcs.device_id
+WHERE dcs.toner_alert OR dcs.offline_alert;
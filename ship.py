@@ -0,0 +1,333 @@
+from datetime import date, datetime
+from typing import Any, Dict, List, Optional, Tuple
+import psycopg2.extras
+from config import Config
+from metrics import get_registry
+
+metrics = get_registry()
+
+# Tables shipped by id watermark; both are append-only on the edge
+SHIPPED_TABLES = ('device_history', 'device_logs')
+
+### Local reads (SQLiteDatabase, see schema_sqlite.sql)
+
+SELECT_WATERMARKS = "SELECT table_name, last_id FROM ship_watermarks"
+
+SAVE_WATERMARK = """
+    INSERT INTO ship_watermarks (table_name, last_id) VALUES (?, ?)
+    ON CONFLICT (table_name) DO UPDATE SET last_id = excluded.last_id
+"""
+
+SELECT_MONTHS = "SELECT DISTINCT substr(timestamp, 1, 7) FROM {table} WHERE id > ?"
+
+SELECT_LOCAL_DEVICES = "SELECT id, serial_number, mac_address, first_seen FROM devices"
+
+# Rows after the watermark, in id order, chunk by chunk; the id is the first column
+SELECT_NEW_ROWS = {
+    'device_history': """
+        SELECT id, device_id, timestamp, device_name, ip_address, mac_address, hostname, id
+        FROM device_history WHERE id > ? ORDER BY id LIMIT ?
+    """,
+    'device_logs': """
+        SELECT id, device_id, timestamp, status, toner_level,
+               printer_copy_bw, printer_printer_bw, printer_fax_bw,
+               scanner_copy, scanner_bw, scanner_other, id, valid_until
+        FROM device_logs WHERE id > ? ORDER BY id LIMIT ?
+    """,
+}
+
+# Change-only logging keeps moving valid_until on the latest row of each device after it was
+# shipped; those rows are sent again on every shipment so the server catches up
+SELECT_EXTENDED_LOGS = """
+    SELECT device_id, timestamp, valid_until
+    FROM device_logs l
+    WHERE id <= ? AND valid_until IS NOT NULL
+      AND NOT EXISTS (SELECT 1 FROM device_logs n WHERE n.device_id = l.device_id AND n.timestamp > l.timestamp)
+"""
+
+SELECT_LOCAL_CURRENT_STATE = """
+    SELECT device_id, device_name, ip_address, mac_address, hostname, status, toner_level,
+           printer_copy_bw, printer_printer_bw, printer_fax_bw, scanner_copy, scanner_bw, scanner_other,
+           last_updated, toner_alert, offline_alert
+    FROM device_current_state
+"""
+
+SELECT_LOCAL_LAST_SEEN = "SELECT device_id, last_seen FROM device_last_seen"
+
+### Upstream writes (Database); every statement can run twice without adding rows
+
+# Same rule as UPSERT_STAGED_DEVICES: a known serial only changes to a non-empty MAC
+UPSERT_DEVICES = """
+    INSERT INTO devices (serial_number, mac_address, first_seen) VALUES %s
+    ON CONFLICT (serial_number) DO UPDATE SET mac_address = EXCLUDED.mac_address
+    WHERE NULLIF(EXCLUDED.mac_address, '') IS NOT NULL
+      AND devices.mac_address IS DISTINCT FROM EXCLUDED.mac_address
+"""
+
+SELECT_DEVICE_IDS = "SELECT serial_number, id FROM devices WHERE serial_number = ANY(%s)"
+
+INSERT_ROWS = {
+    # A printer seen twice in one batch can have two entries at the same time, so an entry
+    # is only skipped if the same one is already there; ord keeps the local order
+    'device_history': """
+        INSERT INTO device_history (device_id, timestamp, device_name, ip_address, mac_address, hostname)
+        SELECT v.device_id, v.timestamp, v.device_name, v.ip_address::inet, v.mac_address, v.hostname
+        FROM (VALUES %s) AS v (device_id, timestamp, device_name, ip_address, mac_address, hostname, ord)
+        WHERE NOT EXISTS (
+            SELECT 1 FROM device_history h
+            WHERE h.device_id = v.device_id AND h.timestamp = v.timestamp
+              AND (h.device_name, h.ip_address, h.mac_address, h.hostname)
+                  IS NOT DISTINCT FROM (v.device_name, v.ip_address::inet, v.mac_address, v.hostname)
+        )
+        ORDER BY v.ord
+    """,
+    # Same rule as for device_history. valid_until is set by EXTEND_LOGS afterwards, so the
+    # rollups count the extension as the server would have when saving the same polls itself
+    'device_logs': """
+        INSERT INTO device_logs (
+            device_id, timestamp, status, toner_level,
+            printer_copy_bw, printer_printer_bw, printer_fax_bw,
+            scanner_copy, scanner_bw, scanner_other
+        )
+        SELECT v.device_id, v.timestamp, v.status, v.toner_level,
+               v.printer_copy_bw, v.printer_printer_bw, v.printer_fax_bw,
+               v.scanner_copy, v.scanner_bw, v.scanner_other
+        FROM (VALUES %s) AS v (
+            device_id, timestamp, status, toner_level,
+            printer_copy_bw, printer_printer_bw, printer_fax_bw,
+            scanner_copy, scanner_bw, scanner_other, ord
+        )
+        WHERE NOT EXISTS (
+            SELECT 1 FROM device_logs l
+            WHERE l.device_id = v.device_id AND l.timestamp = v.timestamp
+              AND (l.status, l.toner_level, l.printer_copy_bw, l.printer_printer_bw, l.printer_fax_bw,
+                   l.scanner_copy, l.scanner_bw, l.scanner_other)
+                  IS NOT DISTINCT FROM
+                  (v.status, v.toner_level, v.printer_copy_bw, v.printer_printer_bw, v.printer_fax_bw,
+                   v.scanner_copy, v.scanner_bw, v.scanner_other)
+        )
+        ORDER BY v.ord
+    """,
+}
+
+INSERT_TEMPLATES = {
+    'device_history': "(%s::integer, %s::timestamp, %s::text, %s::text, %s::text, %s::text, %s::integer)",
+    'device_logs': ("(%s::integer, %s::timestamp, %s::varchar, %s::smallint, %s::integer, %s::integer, "
+                    "%s::integer, %s::integer, %s::integer, %s::integer, %s::integer)"),
+}
+
+EXTEND_LOGS = """
+    UPDATE device_logs l SET valid_until = v.valid_until
+    FROM (VALUES %s) AS v (device_id, timestamp, valid_until)
+    WHERE l.device_id = v.device_id AND l.timestamp = v.timestamp
+      AND (l.valid_until IS NULL OR l.valid_until < v.valid_until)
+"""
+
+# Same guard as UPSERT_CURRENT_STATE: an older row never overwrites a newer one, and a row that
+# holds the same values is left alone, unless the edge changed it and back since the last shipment
+UPSERT_CURRENT_STATE = """
+    INSERT INTO device_current_state (
+        device_id, device_name, ip_address, mac_address, hostname, status, toner_level,
+        printer_copy_bw, printer_printer_bw, printer_fax_bw, scanner_copy, scanner_bw, scanner_other,
+        last_updated, toner_alert, offline_alert
+    )
+    SELECT v.device_id, v.device_name, v.ip_address::inet, v.mac_address, v.hostname, v.status, v.toner_level,
+           v.printer_copy_bw, v.printer_printer_bw, v.printer_fax_bw, v.scanner_copy, v.scanner_bw, v.scanner_other,
+           v.last_updated, v.toner_alert, v.offline_alert
+    FROM (VALUES %s) AS v (
+        device_id, device_name, ip_address, mac_address, hostname, status, toner_level,
+        printer_copy_bw, printer_printer_bw, printer_fax_bw, scanner_copy, scanner_bw, scanner_other,
+        last_updated, toner_alert, offline_alert
+    )
+    ON CONFLICT (device_id) DO UPDATE SET
+        device_name = EXCLUDED.device_name,
+        ip_address = EXCLUDED.ip_address,
+        mac_address = EXCLUDED.mac_address,
+        hostname = EXCLUDED.hostname,
+        status = EXCLUDED.status,
+        toner_level = EXCLUDED.toner_level,
+        printer_copy_bw = EXCLUDED.printer_copy_bw,
+        printer_printer_bw = EXCLUDED.printer_printer_bw,
+        printer_fax_bw = EXCLUDED.printer_fax_bw,
+        scanner_copy = EXCLUDED.scanner_copy,
+        scanner_bw = EXCLUDED.scanner_bw,
+        scanner_other = EXCLUDED.scanner_other,
+        last_updated = EXCLUDED.last_updated,
+        toner_alert = EXCLUDED.toner_alert,
+        offline_alert = EXCLUDED.offline_alert
+    WHERE NOT device_current_state.last_updated > EXCLUDED.last_updated
+      AND (device_current_state.device_name, device_current_state.ip_address, device_current_state.mac_address,
+           device_current_state.hostname, device_current_state.status, device_current_state.toner_level,
+           device_current_state.printer_copy_bw, device_current_state.printer_printer_bw,
+           device_current_state.printer_fax_bw, device_current_state.scanner_copy, device_current_state.scanner_bw,
+           device_current_state.scanner_other, device_current_state.toner_alert, device_current_state.offline_alert,
+           device_current_state.last_updated)
+          IS DISTINCT FROM
+          (EXCLUDED.device_name, EXCLUDED.ip_address, EXCLUDED.mac_address, EXCLUDED.hostname, EXCLUDED.status,
+           EXCLUDED.toner_level, EXCLUDED.printer_copy_bw, EXCLUDED.printer_printer_bw, EXCLUDED.printer_fax_bw,
+           EXCLUDED.scanner_copy, EXCLUDED.scanner_bw, EXCLUDED.scanner_other, EXCLUDED.toner_alert,
+           EXCLUDED.offline_alert, EXCLUDED.last_updated)
+    RETURNING device_id
+"""
+
+# VALUES columns that are NULL on every row would otherwise be typed as text
+CURRENT_STATE_TEMPLATE = ("(%s::integer, %s::text, %s::text, %s::text, %s::text, %s::text, %s::smallint, "
+                          "%s::integer, %s::integer, %s::integer, %s::integer, %s::integer, %s::integer, "
+                          "%s::timestamp, %s::boolean, %s::boolean)")
+
+EXTEND_TEMPLATE = "(%s::integer, %s::timestamp, %s::timestamp)"
+
+TOUCH_LAST_SEEN = """
+    INSERT INTO device_last_seen (device_id, last_seen) VALUES %s
+    ON CONFLICT (device_id) DO UPDATE SET last_seen = GREATEST(device_last_seen.last_seen, EXCLUDED.last_seen)
+"""
+
+class UpstreamShipper:
+    """
+    Bulk shipment of an edge collector's SQLite database to the central PostgreSQL one.
+
+    The rows of device_history and device_logs added since the last shipment (the
+    highest id shipped, kept in the local ship_watermarks table) are read chunk_rows
+    at a time and written upstream with one multi-row statement per chunk and
+    table, one transaction per chunk; the watermark is moved after each commit.
+    Devices are matched by serial number, and the current state and last-seen
+    times of every device are then merged with the same guards as a save, so the
+    server ends up as if it had saved the same polls itself. Alert transitions
+    are evaluated on the shipped state, usage is refreshed from the first day
+    shipped, and partitions are created for the months shipped.
+
+    Every statement is idempotent: a shipment that fails is retried from the last
+    committed chunk, and a chunk that was committed upstream but not marked
+    shipped adds nothing when it is sent again.
+    """
+
+    def __init__(self, chunk_rows: int = 10000):
+        self.chunk_rows = chunk_rows
+
+    @classmethod
+    def from_config(cls) -> "UpstreamShipper":
+        """Create a shipper with the Config shipping settings."""
+        return cls(Config.SHIP_CHUNK_ROWS)
+
+    @staticmethod
+    def watermarks(local) -> Dict[str, int]:
+        """Highest id shipped so far, by table."""
+        return dict(local.conn.execute(SELECT_WATERMARKS).fetchall())
+
+    def ship_devices(self, local, upstream) -> Dict[int, int]:
+        """Make sure every local device exists upstream; returns the upstream id of each local one."""
+        devices = local.conn.execute(SELECT_LOCAL_DEVICES).fetchall()
+        if not devices:
+            return {}
+
+        with upstream.conn.cursor() as cursor:
+            upstream.save_timeout(cursor)
+            psycopg2.extras.execute_values(
+                cursor, UPSERT_DEVICES, [(serial, mac, first_seen) for _, serial, mac, first_seen in devices],
+                template="(%s, %s, %s::timestamp)", page_size=len(devices))
+            cursor.execute(SELECT_DEVICE_IDS, ([serial for _, serial, _, _ in devices],))
+            upstream_ids = dict(cursor.fetchall())
+        upstream.conn.commit()
+        return {local_id: upstream_ids[serial] for local_id, serial, _, _ in devices}
+
+    def ship_table(self, local, upstream, table: str, device_ids: Dict[int, int],
+                   after_id: int) -> Tuple[int, Optional[str]]:
+        """
+        Ship the rows of table after after_id, one transaction per chunk.
+
+        :return: Number of rows shipped, and the earliest timestamp among them
+        """
+        shipped = 0
+        earliest = None
+        while rows := local.conn.execute(SELECT_NEW_ROWS[table], (after_id, self.chunk_rows)).fetchall():
+            values = [(device_ids[row[1]],) + tuple(row[2:]) for row in rows]
+            with upstream.conn.cursor() as cursor:
+                upstream.save_timeout(cursor)
+                if table == 'device_logs':
+                    psycopg2.extras.execute_values(cursor, INSERT_ROWS[table], [value[:-1] for value in values],
+                                                   template=INSERT_TEMPLATES[table], page_size=len(values))
+                    extended = [(value[0], value[1], value[-1]) for value in values if value[-1] is not None]
+                    if extended:
+                        psycopg2.extras.execute_values(cursor, EXTEND_LOGS, extended,
+                                                       template=EXTEND_TEMPLATE,
+                                                       page_size=len(extended))
+                else:
+                    psycopg2.extras.execute_values(cursor, INSERT_ROWS[table], values,
+                                                   template=INSERT_TEMPLATES[table], page_size=len(values))
+            upstream.conn.commit()
+
+            after_id = rows[-1][0]
+            local.conn.execute(SAVE_WATERMARK, (table, after_id))
+            shipped += len(rows)
+            first = min(row[2] for row in rows)
+            earliest = first if earliest is None else min(earliest, first)
+            metrics.inc("kyoscan_ship_rows_total", len(rows), table=table)
+        return shipped, earliest
+
+    def ship_state(self, local, upstream, device_ids: Dict[int, int], logs_after_id: int) -> Tuple[int, int]:
+        """
+        Ship the valid_until of extended rows, the current state and the last-seen times
+        in one transaction, and evaluate alerts on the current state rows that changed.
+
+        :return: Number of current state rows changed upstream, and of alert events written
+        """
+        extended = [(device_ids[device_id], timestamp, valid_until) for device_id, timestamp, valid_until
+                    in local.conn.execute(SELECT_EXTENDED_LOGS, (logs_after_id,)).fetchall()]
+        states = [(device_ids[row[0]],) + tuple(row[1:14]) + (bool(row[14]), bool(row[15]))
+                  for row in local.conn.execute(SELECT_LOCAL_CURRENT_STATE).fetchall()]
+        last_seen = [(device_ids[device_id], seen) for device_id, seen
+                     in local.conn.execute(SELECT_LOCAL_LAST_SEEN).fetchall()]
+
+        changed: List[int] = []
+        with upstream.conn.cursor() as cursor:
+            upstream.save_timeout(cursor)
+            if extended:
+                psycopg2.extras.execute_values(cursor, EXTEND_LOGS, extended,
+                                               template=EXTEND_TEMPLATE, page_size=len(extended))
+            if states:
+                changed = [row[0] for row in psycopg2.extras.execute_values(
+                    cursor, UPSERT_CURRENT_STATE, states, template=CURRENT_STATE_TEMPLATE,
+                    page_size=len(states), fetch=True)]
+            if last_seen:
+                psycopg2.extras.execute_values(cursor, TOUCH_LAST_SEEN, last_seen,
+                                               template="(%s, %s::timestamp)", page_size=len(last_seen))
+
+            # Events are recorded at the edge's latest save, not at each poll that caused them
+            latest_save = max((seen for _, seen in last_seen), default=None)
+            events = upstream.evaluate_alerts(
+                cursor, changed, datetime.fromisoformat(latest_save) if latest_save else datetime.now())
+        upstream.conn.commit()
+        return len(changed), events
+
+    def ship(self, local, upstream) -> Dict[str, Any]:
+        """
+        Ship everything the edge saved since the last shipment.
+
+        :param local: Connected SQLiteDatabase
+        :param upstream: Connected Database
+        :return: Rows shipped by table, current state rows changed and alert events written
+        """
+        watermarks = self.watermarks(local)
+        try:
+            months = {month for table in SHIPPED_TABLES for (month,) in local.conn.execute(
+                SELECT_MONTHS.format(table=table), (watermarks.get(table, 0),)).fetchall()}
+            for month in sorted(months):
+                upstream.ensure_partitions(datetime.strptime(month, "%Y-%m"))
+
+            device_ids = self.ship_devices(local, upstream)
+            report: Dict[str, Any] = {}
+            earliest_log = None
+            for table in SHIPPED_TABLES:
+                report[table], earliest = self.ship_table(local, upstream, table, device_ids, watermarks.get(table, 0))
+                if table == 'device_logs':
+                    earliest_log = earliest
+            report['current_state_changed'], report['alert_events'] = self.ship_state(
+                local, upstream, device_ids, self.watermarks(local).get('device_logs', 0))
+        except Exception:
+            upstream.conn.rollback()
+            raise
+
+        # Days before the server's last refresh are only recomputed when asked for
+        if earliest_log is not None:
+            upstream.refresh_usage(date.fromisoformat(earliest_log[:10]))
+        return report
@@ -0,0 +1,137 @@
+import asyncio
+import random
+import time
+from typing import Dict, List, Optional, Tuple
+import httpx
+
+# model.htm bodies as served by the printers' embedded web server
+CONFIG_BODY = """// Model:DvcConfig_Config
+var _pp = new Object();
+_pp.hostName = '{hostname}';
+_pp.modelName = 'ECOSYS M3655idn';
+_pp.serialNumber = '{serial}';
+_pp.assetNumber = '';
+_pp.macAddress = '{mac}';
+_pp.firmwareVersion = '2S0_2F00.004.103';
+_pp.ipv4Address = '{ip}';
+_pp.dhcpEnabled = parseInt('0', 10);
+"""
+
+TONER_BODY = """// Model:Hme_Toner
+var _pp = new Object();
+_pp.Renaming = new Array();
+_pp.TonerName = new Array();
+_pp.TonerName.push('TK-3182');
+_pp.Renaming.push(parseInt('{toner}', 10));
+_pp.TonerStatus = 'Normal';
+"""
+
+PRINT_COUNTER_BODY = """// Model:DvcInfo_Counter_PrnCounter
+var _pp = new Object();
+_pp.copyBlackWhite = ('{copy_bw}').toString();
+_pp.copyFullColor = ('0').toString();
+_pp.printerBlackWhite = ('{printer_bw}').toString();
+_pp.printerFullColor = ('0').toString();
+_pp.faxBlackWhite = ('{fax_bw}').toString();
+_pp.totalBlackWhite = ('{total_bw}').toString();
+"""
+
+SCAN_COUNTER_BODY = """// Model:DvcInfo_Counter_ScanCounter
+var _pp = new Object();
+_pp.scanCopy = parseInt('{scan_copy}', 10);
+_pp.scanFax = parseInt('0', 10);
+_pp.scanBlackWhite = parseInt('{scan_bw}', 10);
+_pp.scanOther = parseInt('{scan_other}', 10);
+"""
+
+BODIES = {
+    "DvcConfig_Config.model.htm": CONFIG_BODY,
+    "Hme_Toner.model.htm": TONER_BODY,
+    "DvcInfo_Counter_PrnCounter.model.htm": PRINT_COUNTER_BODY,
+    "DvcInfo_Counter_ScanCounter.model.htm": SCAN_COUNTER_BODY,
+}
+
+class SimulatedFleet:
+    """
+    In-process fleet of virtual Kyocera printers behind an httpx mock transport.
+
+    Every response is delayed by latency +/- jitter seconds. A request times out
+    (after timeout_after seconds) with probability timeout_rate and gets a 503
+    with probability error_rate. Printers listed in dead_ips never answer.
+    """
+
+    def __init__(self, size: int, latency: float = 0.05, jitter: float = 0.02, timeout_rate: float = 0.0,
+                 error_rate: float = 0.0, timeout_after: float = 1.0, dead_rate: float = 0.0, seed: int = 0):
+        self.size = size
+        self.latency = latency
+        self.jitter = jitter
+        self.timeout_rate = timeout_rate
+        self.error_rate = error_rate
+        self.timeout_after = timeout_after
+        self.random = random.Random(seed)
+        self.devices: Dict[str, Dict[str, int | str]] = {}
+        self.dead_ips = set()
+        self.spans: Dict[str, Tuple[float, float]] = {}
+        self.requests = 0
+
+        for index in range(size):
+            ip = f"10.{100 + index // 65536}.{index // 256 % 256}.{index % 256}"
+            self.devices[ip] = {
+                'ip': ip,
+                'hostname': f"KM{index:06X}",
+                'serial': f"SIM{index:07d}",
+                'mac': "00:17:C8:{:02X}:{:02X}:{:02X}".format(index >> 16 & 255, index >> 8 & 255, index & 255),
+                'toner': self.random.randint(1, 100),
+                'copy_bw': self.random.randint(0, 500000),
+                'printer_bw': self.random.randint(0, 500000),
+                'fax_bw': self.random.randint(0, 5000),
+                'scan_copy': self.random.randint(0, 100000),
+                'scan_bw': self.random.randint(0, 100000),
+                'scan_other': self.random.randint(0, 20000),
+            }
+            if self.random.random() < dead_rate:
+                self.dead_ips.add(ip)
+
+    def printers(self) -> Dict[str, Optional[str]]:
+        """Printer name to IP mapping, as get_printers_from_server returns it."""
+        return {f"SIM-{device['serial']}": ip for ip, device in self.devices.items()}
+
+    def transport(self) -> httpx.MockTransport:
+        """Transport to pass to fetcher.create_client / get_all_printers_data_async."""
+        return httpx.MockTransport(self.handle)
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        """Serve one model.htm request for the virtual printer at request.url.host."""
+        started = time.perf_counter()
+        self.requests += 1
+        ip = request.url.host
+        device = self.devices.get(ip)
+
+        if device is None or ip in self.dead_ips or self.random.random() < self.timeout_rate:
+            await asyncio.sleep(self.timeout_after)
+            self._record_span(ip, started)
+            raise httpx.ConnectTimeout("simulated timeout", request=request)
+
+        await asyncio.sleep(max(self.latency + self.random.uniform(-self.jitter, self.jitter), 0))
+        self._record_span(ip, started)
+
+        if self.random.random() < self.error_rate:
+            return httpx.Response(503, text="Service Unavailable", request=request)
+
+        template = BODIES.get(request.url.path.rsplit('/', 1)[-1])
+        if template is None:
+            return httpx.Response(404, text="Not Found", request=request)
+
+        # Busy printers keep printing between polls
+        device['printer_bw'] += self.random.randint(0, 20)
+        body = template.format(total_bw=device['copy_bw'] + device['printer_bw'] + device['fax_bw'], **device)
+        return httpx.Response(200, text=body, request=request)
+
+    def _record_span(self, ip: str, started: float):
+        """Track the first request start and last response end per printer."""
+        first, _ = self.spans.get(ip, (started, started))
+        self.spans[ip] = (min(first, started), time.perf_counter())
+
+    def latencies(self) -> List[float]:
+        """Per-printer scrape latency in seconds (first request to last response)."""
+        return [end - start for start, end in self.spans.values()]
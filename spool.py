@@ -0,0 +1,138 @@
+import atexit
+import gzip
+import json
+import os
+import time
+import uuid
+import zlib
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from config import Config
+from metrics import get_registry
+
+metrics = get_registry()
+
+class Spool:
+    """
+    Append-only local spool of batches that could not be saved.
+
+    Each batch is one JSON line ({"timestamp": ..., "batch_id": ..., "printers": [...]})
+    written as its own gzip member, so the files stay valid gzip and a crash can
+    only tear the last batch. The batch_id lets the database save each batch once
+    however often it is replayed. Writes are fsynced at most every fsync_interval seconds
+    and on close, instead of once per batch. The current segment is closed and a
+    new one started past segment_bytes, and once a replay reaches the database.
+    """
+
+    def __init__(self, directory: str, fsync_interval: float = 1.0, segment_bytes: int = 16 * 1024 * 1024):
+        self.directory = Path(directory)
+        self.fsync_interval = fsync_interval
+        self.segment_bytes = segment_bytes
+        self.file = None
+        self.path: Optional[Path] = None
+        self.synced_at = 0.0
+        self.replaying = False
+
+    @classmethod
+    def from_config(cls) -> "Spool":
+        """Create a spool with the Config spool settings."""
+        return cls(Config.SPOOL_DIR, Config.SPOOL_FSYNC_INTERVAL, Config.SPOOL_SEGMENT_BYTES)
+
+    def append(self, batch: List[Dict[str, Any]], timestamp: datetime):
+        """
+        Spool one batch.
+
+        :param batch: Printer data dictionaries, as passed to save_printer_data
+        :param timestamp: Time of the scrape, used again when the batch is replayed
+        """
+
+        if self.file is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            # Names sort in creation order, which is the replay order
+            self.path = self.directory / f"spool-{time.time_ns():020d}.jsonl.gz"
+            self.file = open(self.path, "ab")
+
+        line = json.dumps({"timestamp": timestamp.isoformat(), "batch_id": uuid.uuid4().hex, "printers": batch},
+                          default=str) + "\n"
+        self.file.write(gzip.compress(line.encode("utf-8")))
+        self.file.flush()
+        if time.monotonic() - self.synced_at >= self.fsync_interval:
+            self.sync()
+        metrics.inc("kyoscan_spool_batches_total")
+        metrics.inc("kyoscan_spool_printers_total", len(batch))
+
+        if self.file.tell() >= self.segment_bytes:
+            self.close()
+
+    def sync(self):
+        """Make everything appended so far durable."""
+        if self.file is not None:
+            os.fsync(self.file.fileno())
+        self.synced_at = time.monotonic()
+
+    def close(self):
+        """Sync and close the current segment; the next append starts a new one."""
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+            self.path = None
+
+    def pending(self) -> bool:
+        """True if there are spooled batches to replay."""
+        return self.file is not None or any(self.directory.glob("spool-*.jsonl.gz"))
+
+    def segments(self) -> List[Path]:
+        """
+        Segments, oldest first. The current one is included and stays open, so
+        a replay that fails while the database is down does not start a new
+        segment per batch; close it once a replayed batch is saved.
+        """
+        return sorted(self.directory.glob("spool-*.jsonl.gz"))
+
+    def read(self, segment: Path) -> Iterator[Tuple[datetime, List[Dict[str, Any]], Optional[str]]]:
+        """
+        Read the batches of a segment, in the order they were spooled.
+
+        :param segment: Path returned by segments
+        :return: (timestamp, batch, batch_id) tuples; a batch torn by a crash ends the segment
+        """
+
+        with gzip.open(segment, "rt", encoding="utf-8") as lines:
+            try:
+                for line in lines:
+                    record = json.loads(line)
+                    yield datetime.fromisoformat(record["timestamp"]), record["printers"], record.get("batch_id")
+            except (EOFError, zlib.error, gzip.BadGzipFile, json.JSONDecodeError) as e:
+                print(f"Spool segment {segment.name} ends with a torn batch: {e}")
+
+    def quarantine(self, segment: Path) -> Path:
+        """
+        Move a segment that cannot be replayed aside as *.failed, so it no longer
+        blocks the replay of the others; it is kept for inspection.
+
+        :return: New path of the segment
+        """
+        if segment == self.path:
+            self.close()
+        failed = segment.with_name(segment.name + ".failed")
+        os.replace(segment, failed)
+        metrics.inc("kyoscan_spool_failed_segments_total")
+        return failed
+
+    def remove(self, segment: Path):
+        """Delete a segment once all its batches are saved."""
+        if segment == self.path:
+            self.close()
+        segment.unlink()
+
+spool: Optional[Spool] = None
+
+def get_spool() -> Optional[Spool]:
+    """Returns the process-wide spool, or None if Config.SPOOL_DIR is empty."""
+    global spool
+    if spool is None and Config.SPOOL_DIR:
+        spool = Spool.from_config()
+        atexit.register(spool.close)
+    return spool
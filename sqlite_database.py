@@ -0,0 +1,318 @@
+import sqlite3
+from datetime import date, datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from config import Config
+from database import MISSING_FIELD_COLUMNS, config_changed, log_params, current_state_params
+from metrics import get_registry
+from storage import Storage
+
+metrics = get_registry()
+
+SCHEMA_FILE = Path(__file__).with_name("schema_sqlite.sql")
+
+### SQL of the embedded backend (see schema_sqlite.sql); ? / :name placeholders
+
+SELECT_DEVICE_BY_SERIAL = "SELECT id FROM devices WHERE serial_number = ?"
+
+UPDATE_DEVICE_MAC = "UPDATE devices SET mac_address = ? WHERE id = ?"
+
+INSERT_DEVICE = "INSERT INTO devices (serial_number, mac_address, first_seen) VALUES (?, ?, ?) RETURNING id"
+
+SELECT_DEVICE_BY_NAME = """
+    SELECT device_id
+    FROM device_history
+    WHERE device_name = ?
+    ORDER BY timestamp DESC, id DESC LIMIT 1
+"""
+
+SELECT_LAST_CONFIG = """
+    SELECT device_name, ip_address, hostname, mac_address
+    FROM device_history
+    WHERE device_id = ?
+    ORDER BY timestamp DESC, id DESC LIMIT 1
+"""
+
+INSERT_HISTORY = """
+    INSERT INTO device_history (device_id, device_name, ip_address, mac_address, hostname, timestamp)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+# Columns of log_params, in order
+LOG_COLUMNS = (
+    'device_id', 'timestamp', 'status', 'toner_level',
+    'printer_copy_bw', 'printer_printer_bw', 'printer_fax_bw',
+    'scanner_copy', 'scanner_bw', 'scanner_other'
+)
+
+INSERT_LOG = f"""
+    INSERT INTO device_logs ({', '.join(LOG_COLUMNS)})
+    VALUES ({', '.join(':' + column for column in LOG_COLUMNS)})
+"""
+
+# Change-only logging: extend the device's latest row of the month if it read the same values;
+# INSERT_LOG runs when no row was extended
+EXTEND_LOG = f"""
+    UPDATE device_logs SET valid_until = :timestamp
+    WHERE id = (
+        SELECT id FROM device_logs
+        WHERE device_id = :device_id AND timestamp >= :month
+        ORDER BY timestamp DESC, id DESC
+        LIMIT 1
+    )
+      AND timestamp < :timestamp
+      AND {' AND '.join(f'{column} IS :{column}' for column in LOG_COLUMNS[2:])}
+"""
+
+# device_current_state column -> current_state_params key
+STATE_COLUMNS = {
+    'device_name': 'name', 'ip_address': 'ip', 'mac_address': 'mac', 'hostname': 'hostname',
+    'status': 'status', 'toner_level': 'toner',
+    'printer_copy_bw': 'copy_bw', 'printer_printer_bw': 'printer_bw', 'printer_fax_bw': 'fax_bw',
+    'scanner_copy': 'scan_copy', 'scanner_bw': 'scan_bw', 'scanner_other': 'scan_other',
+    'toner_alert': 'toner_alert', 'offline_alert': 'offline_alert',
+}
+
+KEPT_COLUMNS = {column for columns in MISSING_FIELD_COLUMNS.values() for column in columns}
+
+def _kept(column: str, value: str) -> str:
+    """Expression keeping the stored value of column when the scrape could not read it (:kept is ',a,b,')."""
+    if column not in KEPT_COLUMNS:
+        return value
+    return f"CASE WHEN instr(:kept, ',{column},') THEN device_current_state.{column} ELSE {value} END"
+
+# Same semantics as UPSERT_CURRENT_STATE: kept columns keep their value, unchanged rows are not rewritten
+UPSERT_CURRENT_STATE = f"""
+    INSERT INTO device_current_state (device_id, {', '.join(STATE_COLUMNS)}, last_updated)
+    VALUES (:device_id, {', '.join(':' + key for key in STATE_COLUMNS.values())}, :timestamp)
+    ON CONFLICT (device_id) DO UPDATE SET
+        {', '.join(f'{column} = {_kept(column, "excluded." + column)}' for column in STATE_COLUMNS)},
+        last_updated = excluded.last_updated
+    WHERE NOT device_current_state.last_updated > excluded.last_updated
+      AND ({' OR '.join(f'{_kept(column, "excluded." + column)} IS NOT device_current_state.{column}' for column in STATE_COLUMNS)})
+"""
+
+TOUCH_LAST_SEEN = """
+    INSERT INTO device_last_seen (device_id, last_seen) VALUES (?, ?)
+    ON CONFLICT (device_id) DO UPDATE SET last_seen = max(device_last_seen.last_seen, excluded.last_seen)
+"""
+
+# Same as Database's CLAIM_BATCH: a replayed batch is saved once
+CLAIM_BATCH = "INSERT INTO saved_batches (batch_id) VALUES (?) ON CONFLICT DO NOTHING"
+
+DELETE_EXPIRED = "DELETE FROM {table} WHERE timestamp < ?"
+
+# With SHIP_UPSTREAM, rows past the table's ship watermark (ship.py) are kept until they are shipped
+DELETE_EXPIRED_SHIPPED = """
+    DELETE FROM {table}
+    WHERE timestamp < ?
+      AND id <= COALESCE((SELECT last_id FROM ship_watermarks WHERE table_name = ?), 0)
+"""
+
+class SQLiteDatabase(Storage):
+    """
+    Embedded storage for collectors on slow links, with the save semantics of Database.
+
+    Every batch is written in one transaction on a local file in WAL mode, so a
+    save costs no network round-trip and readers never block the writer. Only the
+    tables a save writes exist here (schema_sqlite.sql): usage summaries,
+    forecasts and alert events are computed on the PostgreSQL server that
+    ship.UpstreamShipper sends the rows to.
+    """
+
+    def __init__(self, path: str = "kyoscan.db", timeout: float = 30.0):
+        self.path = path
+        self.timeout = timeout
+        self.conn = None
+
+    @classmethod
+    def from_config(cls) -> "SQLiteDatabase":
+        """Open the file at Config.SQLITE_PATH."""
+        return cls(Config.SQLITE_PATH)
+
+    def connect(self):
+        """Open the database file, creating the schema if needed."""
+
+        if self.conn is None:
+            try:
+                # Autocommit; transactions are opened explicitly with BEGIN IMMEDIATE.
+                # Saves may come from different worker threads, one at a time
+                self.conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                                            check_same_thread=False)
+                self.conn.execute("PRAGMA journal_mode = WAL")
+                self.conn.execute("PRAGMA synchronous = NORMAL")  # Durable at checkpoints, never corrupt
+                self.conn.execute("PRAGMA foreign_keys = ON")
+                self.conn.executescript(SCHEMA_FILE.read_text(encoding="utf-8"))
+            except Exception as e:
+                print(f"Database connection error: {e}")
+                self.conn = None
+
+    def close(self):
+        """Close the database file."""
+
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def resolve_device_id(self, cursor: sqlite3.Cursor, serial: Optional[str], name: str | Any,
+                          mac: Optional[str], timestamp: str) -> Optional[int]:
+        """
+        Resolve device ID, inserting or updating as needed (see Database.resolve_device_id).
+
+        :param cursor: Database cursor
+        :param serial: Serial number
+        :param name: Device name
+        :param mac: MAC address
+        :param timestamp: Timestamp of the save
+        :return: Device ID or None if unable to resolve
+        """
+
+        if serial:
+            result_row = cursor.execute(SELECT_DEVICE_BY_SERIAL, (serial,)).fetchone()
+            if result_row:
+                if mac:
+                    cursor.execute(UPDATE_DEVICE_MAC, (mac, result_row[0]))
+                return result_row[0]
+            return cursor.execute(INSERT_DEVICE, (serial, mac, timestamp)).fetchone()[0]
+
+        result_row = cursor.execute(SELECT_DEVICE_BY_NAME, (name,)).fetchone()
+        return result_row[0] if result_row else None
+
+    def save_printer_data(self, data_list: List[Dict[str, Any]], bulk: Optional[bool] = None,
+                          timestamp: Optional[datetime] = None, batch_id: Optional[str] = None) -> int:
+        """
+        Save printer data to the local database in one transaction.
+
+        Same steps and results as Database.save_printer_data. Statements run
+        in-process, so there is no separate bulk path and bulk is ignored.
+
+        :param data_list: List of printer data dictionaries
+        :param bulk: Ignored
+        :param timestamp: Time of the scrape (default: now)
+        :param batch_id: Id of a spooled batch; the batch is skipped if it was already saved
+        :return: Number of printers saved
+        """
+
+        if self.conn is None:
+            print("Database connection is not established.")
+            return 0
+
+        now = timestamp or datetime.now()
+        timestamp = now.isoformat(sep=" ")
+        month = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0).isoformat(sep=" ")
+        cursor = self.conn.cursor()
+        saved_count = 0
+        changed_count = 0
+        not_resolved = []
+
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            if batch_id is not None and not cursor.execute(CLAIM_BATCH, (batch_id,)).rowcount:
+                cursor.execute("ROLLBACK")
+                print(f"Batch {batch_id} was already saved, skipping it.")
+                return 0
+            for data in data_list:
+                name = data.get('Name')
+                ip = data.get('IP')
+                hostname = data.get('Hostname')
+                mac = data.get('Mac')
+
+                with metrics.timer("kyoscan_db_phase_seconds", phase="resolve"):
+                    device_id = self.resolve_device_id(cursor, data.get('Serial'), name, mac, timestamp)
+
+                if not device_id:
+                    not_resolved.append(name)
+                    continue
+
+                with metrics.timer("kyoscan_db_phase_seconds", phase="history"):
+                    last_config = cursor.execute(SELECT_LAST_CONFIG, (device_id,)).fetchone()
+                    if config_changed(last_config, name, ip, mac, hostname):
+                        cursor.execute(INSERT_HISTORY, (device_id, name, ip, mac, hostname, timestamp))
+
+                with metrics.timer("kyoscan_db_phase_seconds", phase="logs"):
+                    log = dict(zip(LOG_COLUMNS, log_params(device_id, data, timestamp)))
+                    if not Config.DB_DELTA_LOGS or not cursor.execute(EXTEND_LOG, {**log, 'month': month}).rowcount:
+                        cursor.execute(INSERT_LOG, log)
+
+                with metrics.timer("kyoscan_db_phase_seconds", phase="upsert"):
+                    state = current_state_params(device_id, data, timestamp)
+                    state['kept'] = ',' + ','.join(state['kept']) + ','
+                    changed_count += cursor.execute(UPSERT_CURRENT_STATE, state).rowcount
+                    cursor.execute(TOUCH_LAST_SEEN, (device_id, timestamp))
+
+                saved_count += 1
+
+            with metrics.timer("kyoscan_db_phase_seconds", phase="commit"):
+                cursor.execute("COMMIT")
+            metrics.inc("kyoscan_db_printers_saved_total", saved_count)
+            metrics.inc("kyoscan_db_printers_unresolved_total", len(not_resolved))
+            metrics.inc("kyoscan_db_current_state_changed_total", changed_count)
+            print(f"\nSaved data for {saved_count} printers.")
+            print(f"Could not resolve device IDs for {len(not_resolved)} printers.")
+            print(f"Current state changed for {changed_count} printers.")
+            return saved_count
+
+        except Exception as e:
+            if self.conn.in_transaction:
+                self.conn.rollback()
+            metrics.inc("kyoscan_db_save_errors_total")
+            print(f"Error saving printer data: {e}")
+            raise
+        finally:
+            cursor.close()
+
+    def apply_retention(self, log_months: Optional[int] = None, history_months: Optional[int] = None,
+                        hourly_months: Optional[int] = None) -> List[str]:
+        """
+        Delete logs and history older than their retention, by whole months as Database does.
+        With Config.SHIP_UPSTREAM, rows not shipped yet are kept whatever their age.
+
+        :param log_months: Months of device_logs to keep (default: Config.LOG_RETENTION_MONTHS, 0 keeps all)
+        :param history_months: Months of device_history to keep (default: Config.HISTORY_RETENTION_MONTHS)
+        :param hourly_months: Ignored, there are no rollups here
+        :return: 'table < cutoff' for each table rows were deleted from
+        """
+
+        if self.conn is None:
+            print("Database connection is not established.")
+            return []
+
+        retention = (
+            ('device_logs', Config.LOG_RETENTION_MONTHS if log_months is None else log_months),
+            ('device_history', Config.HISTORY_RETENTION_MONTHS if history_months is None else history_months),
+        )
+        today = date.today()
+        deleted = []
+
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+            for table, months in retention:
+                if months > 0:
+                    months_back = today.year * 12 + today.month - 1 - months
+                    cutoff = date(months_back // 12, months_back % 12 + 1, 1).isoformat()
+                    if Config.SHIP_UPSTREAM:
+                        removed = self.conn.execute(DELETE_EXPIRED_SHIPPED.format(table=table), (cutoff, table))
+                    else:
+                        removed = self.conn.execute(DELETE_EXPIRED.format(table=table), (cutoff,))
+                    if removed.rowcount:
+                        deleted.append(f"{table} < {cutoff}")
+            self.conn.execute("COMMIT")
+        except Exception as e:
+            if self.conn.in_transaction:
+                self.conn.rollback()
+            print(f"Error applying retention: {e}")
+            raise
+
+        return deleted
+
+    def refresh_usage(self, since: Optional[date] = None) -> int:
+        """No usage summary is kept locally; it is refreshed upstream when the rows are shipped."""
+        return 0
+
+    def refresh_forecast(self) -> int:
+        """No forecast is kept locally; the PostgreSQL server computes it from the shipped rows."""
+        return 0
+
+    def export_history(self) -> Dict[str, int]:
+        """Nothing is exported locally; the PostgreSQL server exports the shipped rows."""
+        return {}
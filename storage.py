@@ -0,0 +1,84 @@
+from abc import ABC, abstractmethod
+from datetime import date, datetime
+from typing import Any, Dict, List, Optional
+from config import Config
+
+class Storage(ABC):
+    """
+    What the pipeline needs from a storage backend.
+
+    Database (PostgreSQL) and SQLiteDatabase (embedded, for edge collectors)
+    implement it with the same save semantics. AsyncDatabase is the asyncio
+    counterpart of Database and is used through pipeline.save_batch instead.
+    """
+
+    @abstractmethod
+    def connect(self):
+        """Open the connection if it is not open (also used to reconnect)."""
+
+    @abstractmethod
+    def close(self):
+        """Close the connection."""
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @abstractmethod
+    def save_printer_data(self, data_list: List[Dict[str, Any]], bulk: Optional[bool] = None,
+                          timestamp: Optional[datetime] = None, batch_id: Optional[str] = None) -> int:
+        """
+        Save one batch of printer data in one transaction.
+
+        A batch saved with a batch_id is recorded in saved_batches in the same
+        transaction, and saving it again under that id does nothing.
+
+        :param data_list: List of printer data dictionaries
+        :param bulk: Use the backend's set-based path if it has one (default: Config.DB_BULK_WRITE)
+        :param timestamp: Time of the scrape (default: now)
+        :param batch_id: Id of a spooled batch (see spool.py)
+        :return: Number of printers saved (0 if the batch was already saved)
+        """
+
+    @abstractmethod
+    def apply_retention(self, log_months: Optional[int] = None, history_months: Optional[int] = None,
+                        hourly_months: Optional[int] = None) -> List[str]:
+        """
+        Remove logs and history past their retention (Config.*_RETENTION_MONTHS).
+
+        :return: Names of what was removed
+        """
+
+    @abstractmethod
+    def refresh_usage(self, since: Optional[date] = None) -> int:
+        """Bring the usage summary up to date; returns the number of device-days written."""
+
+    @abstractmethod
+    def refresh_forecast(self) -> int:
+        """Recompute the toner forecast; returns the number of devices forecast."""
+
+    @abstractmethod
+    def export_history(self) -> Dict[str, int]:
+        """Append the rows added since the last export to the history export; returns rows exported, by table."""
+
+def create_storage(config: Optional[Config] = None, device_cache=None, alert_engine=None) -> Storage:
+    """
+    Build the storage backend selected by Config.DB_BACKEND.
+
+    :param config: Connection settings for PostgreSQL (default: Config())
+    :param device_cache: DeviceCache for PostgreSQL (SQLite reads are in-process and need none)
+    :param alert_engine: AlertEngine for PostgreSQL (alert events are kept on the server)
+    :return: A Database for 'postgres', a SQLiteDatabase on Config.SQLITE_PATH for 'sqlite'
+    """
+
+    # Imported here: both backends import this module
+    if Config.DB_BACKEND == "postgres":
+        from database import Database
+        return Database(config or Config(), device_cache=device_cache, alert_engine=alert_engine)
+    if Config.DB_BACKEND == "sqlite":
+        from sqlite_database import SQLiteDatabase
+        return SQLiteDatabase(Config.SQLITE_PATH)
+    raise ValueError(f"Unknown DB_BACKEND {Config.DB_BACKEND!r}, expected 'postgres' or 'sqlite'")
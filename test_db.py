@@ -1,6 +1,9 @@
-from database import Database
+from alerts import AlertEngine
 from config import Config
+from contextlib import closing
+from storage import create_storage
 import sys
+from datetime import datetime, timedelta
 
 def get_mock_printer_data():
     """Generate fake printer data for testing."""
@@ -37,6 +40,18 @@ def get_mock_printer_data():
             "Toner": 5, 
             "Print_Data": {"copy_bw": 5000, "printer_bw": 2000, "fax_bw": 100},
             "Scan_Data": {}
+        },
+        {
+            "Name": "KM-Test-Partial",
+            "IP": "10.0.0.100",
+            "Hostname": "printer123456",
+            "Serial": "TESTSERIAL123456",
+            "Mac": "00:11:22:33:44:57",
+            "Status": "Online",
+            "Toner": None,
+            "Print_Data": {"copy_bw": 110, "printer_bw": 230, "fax_bw": 5},
+            "Scan_Data": None,
+            "Missing": {"Toner": "timeout", "Scan_Data": "http 503"}
         }
     ]
 
@@ -47,7 +62,11 @@ def run_test():
     config = Config()
     db_conf = config.get_db_config()
     
-    print("Checking Configuration:")
+    # DB_BACKEND=sqlite runs the same checks against a local file, without a server
+    postgres = Config.DB_BACKEND == "postgres"
+    print(f"Checking Configuration ({Config.DB_BACKEND}):")
+    if not postgres:
+        db_conf = {"path": Config.SQLITE_PATH}
     for key, value in db_conf.items():
         # mask password for display
         display_val = "******" if key == "password" else value
@@ -55,7 +74,7 @@ def run_test():
 
     # 2. Test Connection
     try:
-        with Database(config) as db:
+        with create_storage(config, alert_engine=AlertEngine.from_config()) as db:
             if db.conn is None:
                 print("❌ Connection failed immediately after initialization.")
                 sys.exit(1)
@@ -71,7 +90,7 @@ def run_test():
             db.save_printer_data(mock_data)
             
             # 4. Verification
-            with db.conn.cursor() as cur:
+            with closing(db.conn.cursor()) as cur:
                 # Check Devices
                 cur.execute("SELECT COUNT(*) FROM devices WHERE serial_number LIKE 'TEST%' OR serial_number LIKE 'ALERT%'")
                 count = cur.fetchone()[0]
@@ -82,6 +101,19 @@ def run_test():
                 log_count = cur.fetchone()[0]
                 print(f"✔ Logs table: Found {log_count} total logs")
 
+                # Check partial results kept last-known values
+                cur.execute("""
+                    SELECT dcs.toner_level, dcs.scanner_copy, dcs.printer_copy_bw
+                    FROM device_current_state dcs
+                    JOIN devices d ON d.id = dcs.device_id
+                    WHERE d.serial_number = 'TESTSERIAL123456'
+                """)
+                partial_row = cur.fetchone()
+                if partial_row == (80, 50, 110):
+                    print("✔ Current state: Missing fields kept their last-known values")
+                else:
+                    print(f"✘ Current state: Unexpected values after partial result {partial_row}")
+
                 # Check Alert View
                 cur.execute("SELECT device_name, toner_alert FROM devices_alert_view WHERE toner_level < 10")
                 alert_row = cur.fetchone()
@@ -90,6 +122,39 @@ def run_test():
                 else:
                     print("✘ Alert View: Failed to find low toner alert")
 
+                # Check the alert engine recorded it
+                if not postgres:
+                    print("Alert events, usage and forecast are kept in PostgreSQL only.")
+                    return
+
+                cur.execute("""
+                    SELECT s.active FROM alert_state s
+                    JOIN devices d ON d.id = s.device_id
+                    WHERE d.serial_number LIKE 'ALERT%' AND s.alert = 'toner_low'
+                """)
+                state_row = cur.fetchone()
+                if state_row and state_row[0]:
+                    print(f"✔ Alert events: toner_low raised, {len(db.get_alert_events())} events to read")
+                else:
+                    print("✘ Alert events: toner_low was not raised")
+
+            # 5. Usage summary
+            db.refresh_usage()
+            today = datetime.now().date()
+            usage = db.get_usage(today, today + timedelta(days=1))
+            fleet = db.get_fleet_usage(today, today + timedelta(days=1))
+            if usage and fleet and fleet[0]['pages'] == sum(row['pages'] for row in usage):
+                print(f"✔ Usage: {fleet[0]['pages']} pages today across {fleet[0]['devices']} devices")
+            else:
+                print(f"✘ Usage: Unexpected summary {usage} / {fleet}")
+
+            # 6. Toner forecast
+            forecast_count = db.refresh_forecast()
+            if forecast_count >= count:
+                print(f"✔ Forecast: {forecast_count} devices forecast")
+            else:
+                print(f"✘ Forecast: only {forecast_count} devices forecast")
+
     except Exception as e:
         print(f"❌ Test Failed with Exception: {type(e).__name__}: {e}")
 